@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/connection_buffer.py
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    CPU cost per MB of Connection.queue/Connection.flush when relaying a
+    large download to a client slower than the server.  Compares the
+    previous bytes based buffering against the memoryview segment deque.
+
+    Usage: python benchmarks/connection_buffer.py [--mb 4 16 64]
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import proxy
+
+
+class SlowSocket(object):
+    """Accepts at most ``window`` bytes per send, like a slow client."""
+
+    def __init__(self, window):
+        self.window = window
+        self.received = 0
+
+    def send(self, data):
+        sent = min(len(data), self.window)
+        self.received += sent
+        return sent
+
+    def sendmsg(self, buffers):
+        sent, left = 0, self.window
+        for data in buffers:
+            n = min(len(data), left)
+            sent += n
+            left -= n
+            if not left:
+                break
+        self.received += sent
+        return sent
+
+
+class BytesConnection(proxy.Connection):
+    """Connection buffering as implemented before segment deques."""
+
+    def __init__(self, what):
+        super(BytesConnection, self).__init__(what)
+        self.bytes_buffer = b''
+
+    def buffer_size(self):
+        return len(self.bytes_buffer)
+
+    def queue(self, data):
+        self.bytes_buffer += data
+
+    def flush(self):
+        sent = self.send(self.bytes_buffer)
+        self.bytes_buffer = self.bytes_buffer[sent:]
+
+
+def relay(cls, megabytes, chunk=16384, window=8192):
+    """Queues ``megabytes`` of data in ``chunk`` sized packets while the
+    client drains ``window`` bytes per flush, then drains the backlog.
+    Returns CPU seconds spent per MB."""
+    conn = cls(b'client')
+    conn.conn = SlowSocket(window)
+    packet = os.urandom(chunk)
+    total = megabytes * 1024 * 1024
+
+    start = time.process_time()
+    queued = 0
+    while queued < total:
+        conn.queue(packet)
+        queued += chunk
+        conn.flush()
+    while conn.buffer_size() > 0:
+        conn.flush()
+    elapsed = time.process_time() - start
+
+    assert conn.conn.received == queued
+    return elapsed / megabytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Connection buffer benchmark')
+    parser.add_argument('--mb', type=int, nargs='+', default=[4, 16, 64],
+                        help='Download sizes in MB. Default: 4 16 64')
+    args = parser.parse_args()
+
+    print('%8s %18s %18s %8s' % ('size', 'bytes (ms/MB)', 'segments (ms/MB)', 'speedup'))
+    for megabytes in args.mb:
+        before = relay(BytesConnection, megabytes)
+        after = relay(proxy.Connection, megabytes)
+        print('%6dMB %18.3f %18.3f %7.1fx' % (megabytes, before * 1000, after * 1000, before / after))
+
+
+if __name__ == '__main__':
+    main()
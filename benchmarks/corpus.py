@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/corpus.py
+    ~~~~~~~~~~~~~~~~~~~~
+
+    HTTP messages shared by the parser benchmark and the differential
+    fuzzer: a fixed corpus of realistic requests and responses, random
+    well formed messages and mutations of them.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from proxy import CRLF, HTTP_REQUEST_PARSER, HTTP_RESPONSE_PARSER
+
+# segment sizes messages are parsed at, None for the whole message
+SEGMENTATIONS = (1, 1460, None)
+
+BROWSER_HEADERS = [
+    b'Host: www.example.com',
+    b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0',
+    b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+    b'Accept-Language: en-US,en;q=0.5',
+    b'Accept-Encoding: gzip, deflate, br',
+    b'Referer: http://www.example.com/articles/index.html',
+    b'Connection: keep-alive',
+    b'Upgrade-Insecure-Requests: 1',
+    b'Cache-Control: max-age=0',
+    b'If-None-Match: "5f3c2a1b-8d2e"',
+    b'If-Modified-Since: Tue, 15 Nov 1994 08:12:31 GMT',
+]
+
+
+def message(line, headers, body=b''):
+    return CRLF.join([line] + headers) + CRLF * 2 + body
+
+
+def chunked(body, size):
+    return b''.join(b'%x\r\n' % len(body[i:i + size]) + body[i:i + size] + CRLF
+                    for i in range(0, len(body), size)) + b'0\r\n\r\n'
+
+
+def realistic():
+    """Returns (name, parser type, message, method of the request for
+    responses) of the benchmark corpus."""
+    cookie = b'Cookie: ' + b'; '.join(b'session_%d=%s' % (i, b'a1b2c3d4' * 4) for i in range(12))
+    form = b'&'.join(b'field_%d=%s' % (i, b'value' * 4) for i in range(40))
+    html = (b'<html><body>' + b'<p>lorem ipsum dolor sit amet</p>' * 2000 + b'</body></html>')[:64 * 1024]
+    json = b'{"items": [' + b', '.join(b'{"id": %d, "name": "item %d"}' % (i, i) for i in range(400)) + b']}'
+    response_headers = [
+        b'Date: Tue, 15 Nov 1994 08:12:31 GMT',
+        b'Server: nginx/1.25.3',
+        b'Cache-Control: public, max-age=3600',
+        b'ETag: "5f3c2a1b-8d2e"',
+        b'Last-Modified: Tue, 15 Nov 1994 08:12:31 GMT',
+        b'Vary: Accept-Encoding',
+        b'X-Content-Type-Options: nosniff',
+        b'Connection: keep-alive',
+    ]
+    return [
+        ('GET browser', HTTP_REQUEST_PARSER,
+         message(b'GET http://www.example.com/articles/2023/performance.html?page=2 HTTP/1.1',
+                 BROWSER_HEADERS + [cookie]), None),
+        ('POST form', HTTP_REQUEST_PARSER,
+         message(b'POST http://www.example.com/login HTTP/1.1', BROWSER_HEADERS + [
+             b'Content-Type: application/x-www-form-urlencoded',
+             b'Content-Length: %d' % len(form)], form), None),
+        ('304 not modified', HTTP_RESPONSE_PARSER,
+         message(b'HTTP/1.1 304 Not Modified', response_headers), b'GET'),
+        ('200 html 64KB', HTTP_RESPONSE_PARSER,
+         message(b'HTTP/1.1 200 OK', response_headers + [
+             b'Content-Type: text/html; charset=utf-8',
+             b'Content-Length: %d' % len(html)], html), b'GET'),
+        ('200 chunked json', HTTP_RESPONSE_PARSER,
+         message(b'HTTP/1.1 200 OK', response_headers + [
+             b'Content-Type: application/json',
+             b'Transfer-Encoding: chunked'], chunked(json, 1000)), b'GET'),
+    ]
+
+
+def segments(data, size):
+    if size is None:
+        return [data]
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def random_segments(rng, data):
+    """Splits data at random offsets, or into one of ``SEGMENTATIONS``."""
+    choice = rng.randint(0, 3)
+    if choice < len(SEGMENTATIONS):
+        return segments(data, SEGMENTATIONS[choice])
+    cuts = sorted(rng.sample(range(1, len(data)), min(len(data) - 1, rng.randint(1, 8)))) if len(data) > 1 else []
+    return [data[i:j] for i, j in zip([0] + cuts, cuts + [len(data)])]
+
+
+def token(rng, alphabet=b'abcdefghijklmnopqrstuvwxyz0123456789-', size=None):
+    size = size or rng.randint(1, 12)
+    return bytes(bytearray(rng.choice(bytearray(alphabet)) for _ in range(size)))
+
+
+def random_bytes(rng, size):
+    return bytes(bytearray(rng.getrandbits(8) for _ in range(size)))
+
+
+def generate(rng):
+    """Returns a random well formed (parser type, message, method of the
+    request for responses), possibly followed by a pipelined message."""
+    type = rng.choice((HTTP_REQUEST_PARSER, HTTP_RESPONSE_PARSER))
+    headers = []
+    for _ in range(rng.randint(0, 12)):
+        name = token(rng)
+        if rng.random() < 0.3:
+            name = name.upper()
+        headers.append(name + b':' + b' ' * rng.randint(0, 2) + token(rng, size=rng.randint(0, 40)) +
+                       b' ' * rng.randint(0, 1))
+    body = random_bytes(rng, rng.choice((0, 1, 10, 100, 5000)))
+
+    framing = rng.choice(('length', 'chunked', 'none'))
+    if framing == 'length':
+        headers.append(rng.choice((b'Content-Length', b'content-length')) + b': %d' % len(body))
+    elif framing == 'chunked':
+        headers.append(b'Transfer-Encoding: ' + rng.choice((b'chunked', b'Chunked')))
+        extension = rng.choice((b'', b';name=value'))
+        body = b''.join(b'%x%s\r\n' % (len(body[i:i + 64]), extension) + body[i:i + 64] + CRLF
+                        for i in range(0, len(body), 64)) + b'0\r\n\r\n'
+    rng.shuffle(headers)
+
+    method = None
+    if type == HTTP_REQUEST_PARSER:
+        method = rng.choice((b'GET', b'POST', b'PUT', b'HEAD', b'DELETE', b'get'))
+        if framing == 'none':
+            body = b''
+        line = b'%s http://%s.example.com:%d/%s?%s HTTP/1.%d' % (
+            method, token(rng), rng.randint(1, 65535), token(rng), token(rng), rng.randint(0, 1))
+        if rng.random() < 0.1:
+            line = b'CONNECT %s.example.com:443 HTTP/1.1' % token(rng)
+        method = None
+    else:
+        code = rng.choice((b'200', b'204', b'206', b'304', b'404', b'500', b'100'))
+        method = rng.choice((b'GET', b'HEAD'))
+        line = b'HTTP/1.%d %s %s' % (rng.randint(0, 1), code, token(rng, b'abcdef ', rng.randint(0, 20)))
+
+    data = message(line, headers, body)
+    # pipelined data left beyond a delimited message
+    if framing != 'none' and rng.random() < 0.3:
+        data += b'GET / HTTP/1.1' + CRLF * 2
+    return type, data, method
+
+
+MUTATIONS = ('flip', 'delete', 'insert', 'duplicate', 'truncate', 'crlf', 'separator', 'digit')
+
+
+def mutate(rng, data):
+    """Returns data with a random mutation applied at a random offset."""
+    if not data:
+        return data
+    data = bytearray(data)
+    mutation = rng.choice(MUTATIONS)
+    offset = rng.randrange(len(data))
+    if mutation == 'flip':
+        data[offset] ^= 1 << rng.randrange(8)
+    elif mutation == 'delete':
+        del data[offset:offset + rng.randint(1, 4)]
+    elif mutation == 'insert':
+        data[offset:offset] = random_bytes(rng, rng.randint(1, 4))
+    elif mutation == 'duplicate':
+        data[offset:offset] = data[offset:offset + rng.randint(1, 32)]
+    elif mutation == 'truncate':
+        del data[offset:]
+    elif mutation == 'crlf':
+        data[offset:offset] = rng.choice((CRLF, b'\r', b'\n', CRLF * 2))
+    elif mutation == 'separator':
+        data[offset:offset] = rng.choice((b':', b' ', b';', b'\t'))
+    else:
+        data[offset:offset] = rng.choice((b'0', b'f', b'9', b'-', b'x'))
+    return bytes(data)
+
+
+def fuzzed(rng):
+    """Yields (parser type, message, method) forever, alternating well
+    formed messages and mutations of them."""
+    while True:
+        type, data, method = generate(rng)
+        yield type, data, method
+        for _ in range(rng.randint(1, 3)):
+            data = mutate(rng, data)
+        yield type, data, method
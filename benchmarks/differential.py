@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/differential.py
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Differential test of a candidate HttpParser/ChunkParser against the
+    reference implementation in proxy.py, on generated messages and
+    mutations of them (benchmarks/corpus.py).
+
+    The reference parses every message in one piece, the candidate at a
+    random segmentation, and both must end up in the same state: parsed
+    line, headers, body, data left beyond the message, or the same type
+    of exception.  Without a candidate, proxy.py parsers are checked
+    against themselves, i.e. for results independent of segmentation.
+
+    Usage: python benchmarks/differential.py [--candidate module:HttpParser]
+                                             [--chunk-candidate module:ChunkParser]
+                                             [--iterations 20000] [--seed 0] [--save-failures DIR]
+"""
+import os
+import sys
+import random
+import argparse
+import importlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import proxy
+import corpus
+
+
+def load(name):
+    module, _, attr = name.partition(':')
+    return getattr(importlib.import_module(module), attr)
+
+
+def observe(parser, error):
+    if error is not None:
+        return {'error': type(error).__name__}
+    return {
+        'state': parser.state,
+        'method': parser.method,
+        'url': tuple(parser.url) if parser.url is not None else None,
+        'code': parser.code,
+        'reason': parser.reason,
+        'version': parser.version,
+        'headers': parser.headers,
+        'header_list': parser.header_list,
+        'body': bytes(parser.body) if parser.body is not None else None,
+        'buffer': bytes(parser.buffer),
+    }
+
+
+def parse_message(cls, type, method, packets):
+    parser = cls(type)
+    parser.method = method
+    try:
+        for packet in packets:
+            parser.parse(packet)
+    except Exception as e:
+        return observe(parser, e)
+    return observe(parser, None)
+
+
+def parse_chunks(cls, packets):
+    parser = cls()
+    rest = b''
+    try:
+        for packet in packets:
+            rest += bytes(parser.parse(packet))
+    except Exception as e:
+        return {'error': type(e).__name__}
+    return {'state': parser.state, 'body': bytes(parser.body), 'rest': rest}
+
+
+def split(cls, data):
+    try:
+        line, rest = cls.split(data)
+    except Exception as e:
+        return {'error': type(e).__name__}
+    return {'line': line, 'rest': bytes(rest)}
+
+
+def differences(expected, actual):
+    return dict((key, (expected.get(key), actual.get(key)))
+                for key in set(expected) | set(actual) if expected.get(key) != actual.get(key))
+
+
+class Differential(object):
+    """Runs cases, recording and optionally saving mismatching inputs."""
+
+    def __init__(self, save_failures=None):
+        self.save_failures = save_failures
+        self.cases = 0
+        self.failures = 0
+
+    def check(self, kind, data, expected, actual, packets):
+        self.cases += 1
+        diff = differences(expected, actual)
+        if not diff:
+            return
+        self.failures += 1
+        print('%s mismatch on %r' % (kind, data[:200]))
+        print('  segment sizes: %r' % [len(packet) for packet in packets][:20])
+        for key, (want, got) in sorted(diff.items()):
+            print('  %s: expected %r, got %r' % (key, want, got))
+        if self.save_failures:
+            if not os.path.isdir(self.save_failures):
+                os.makedirs(self.save_failures)
+            with open(os.path.join(self.save_failures, '%s-%d.bin' % (kind, self.failures)), 'wb') as f:
+                f.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Differential parser test')
+    parser.add_argument('--candidate', default='proxy:HttpParser', help='Default: proxy:HttpParser')
+    parser.add_argument('--chunk-candidate', default='proxy:ChunkParser', help='Default: proxy:ChunkParser')
+    parser.add_argument('--iterations', type=int, default=20000, help='Default: 20000')
+    parser.add_argument('--seed', type=int, default=0, help='Default: 0')
+    parser.add_argument('--save-failures', default=None,
+                        help='Directory mismatching inputs are written to. Default: None')
+    args = parser.parse_args()
+
+    candidate = load(args.candidate)
+    chunk_candidate = load(args.chunk_candidate)
+    rng = random.Random(args.seed)
+    differential = Differential(args.save_failures)
+
+    for name, type, data, method in corpus.realistic():
+        for size in corpus.SEGMENTATIONS:
+            packets = corpus.segments(data, size)
+            differential.check('message', data, parse_message(proxy.HttpParser, type, method, [data]),
+                               parse_message(candidate, type, method, packets), packets)
+
+    messages = corpus.fuzzed(rng)
+    for _ in range(args.iterations):
+        type, data, method = next(messages)
+        packets = corpus.random_segments(rng, data)
+        differential.check('message', data, parse_message(proxy.HttpParser, type, method, [data]),
+                           parse_message(candidate, type, method, packets), packets)
+
+        # chunked body on its own, possibly mutated
+        body = corpus.random_bytes(rng, rng.choice((0, 1, 100, 3000)))
+        data = corpus.chunked(body, rng.choice((1, 16, 1000))) + rng.choice((b'', b'GET / HTTP/1.1'))
+        if rng.random() < 0.5:
+            data = corpus.mutate(rng, data)
+        packets = corpus.random_segments(rng, data)
+        differential.check('chunks', data, parse_chunks(proxy.ChunkParser, [data]),
+                           parse_chunks(chunk_candidate, packets), packets)
+
+        differential.check('split', data, split(proxy.HttpParser, data), split(candidate, data), [data])
+
+    print('%d cases, %d mismatches' % (differential.cases, differential.failures))
+    sys.exit(1 if differential.failures else 0)
+
+
+if __name__ == '__main__':
+    main()
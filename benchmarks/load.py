@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/load.py
+    ~~~~~~~~~~~~~~~~~~
+
+    Load test of proxy.py against local stand-ins for destination servers:
+    an HTTP origin and an echo endpoint reached through CONNECT, playing
+    the part of a TLS server since tunneled bytes are relayed as they are.
+
+    Every scenario starts a fresh proxy, drives it from concurrent client
+    threads and reports requests/sec, p50/p95/p99 latency, throughput and
+    peak RSS of the proxy (including its workers):
+
+    - small: keep-alive GET requests for small responses
+    - download: GET requests for large responses
+    - upload: POST requests with large bodies
+    - tunnels: many idle CONNECT tunnels, each echoing a message once all
+      are open
+
+    Arguments not recognized are passed to proxy.py, results are written
+    as JSON with --json (- for stdout).
+
+    Usage: python benchmarks/load.py [--scenarios small download upload tunnels]
+                                     [--engine eventloop] [--json results.json]
+                                     [proxy.py arguments]
+"""
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import proxy
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+PROXY_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'proxy.py')
+BLOCK = os.urandom(1024 * 1024)
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """GET /bytes/<n> responds with n bytes, POST responds with the size
+    of the request body."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        size = int(self.path.rsplit('/', 1)[-1])
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        while size > 0:
+            self.wfile.write(BLOCK[:min(size, len(BLOCK))])
+            size -= len(BLOCK)
+
+    def do_POST(self):
+        size = left = int(self.headers['Content-Length'])
+        while left > 0:
+            left -= len(self.rfile.read(min(left, 256 * 1024)))
+        body = str(size).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def echo(listener):
+    """Echoes back data of every accepted connection."""
+    def serve(conn):
+        try:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                conn.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    while True:
+        conn, addr = listener.accept()
+        thread = threading.Thread(target=serve, args=(conn,))
+        thread.daemon = True
+        thread.start()
+
+
+def start_origins():
+    """Starts the origin and echo servers, returns their ports."""
+    origin = ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler)
+    thread = threading.Thread(target=origin.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    thread = threading.Thread(target=echo, args=(listener,))
+    thread.daemon = True
+    thread.start()
+    return origin.server_address[1], listener.getsockname()[1]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(port, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('proxy did not start on port %d' % port)
+
+
+def peak_rss(pid):
+    """Peak resident set size in MB of process ``pid`` and its children,
+    None where /proc isn't available."""
+    def read(pid):
+        try:
+            with open('/proc/%d/status' % pid) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except (IOError, OSError):
+            pass
+        return 0
+
+    def children(pid):
+        try:
+            with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+                return [int(child) for child in f.read().split()]
+        except (IOError, OSError):
+            return []
+
+    if not os.path.exists('/proc/%d/status' % pid):
+        return None
+    return (read(pid) + sum(read(child) for child in children(pid))) / 1024.0
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def read_response(sock):
+    parser = proxy.HttpParser(proxy.HTTP_RESPONSE_PARSER, stream=True)
+    while parser.state != proxy.HTTP_PARSER_STATE_COMPLETE:
+        data = sock.recv(256 * 1024)
+        if not data:
+            raise socket.error('connection closed by proxy')
+        parser.parse(data)
+    return parser
+
+
+class Client(object):
+    """Keep-alive proxy client issuing requests until ``deadline`` or
+    ``count`` requests, recording latencies and bytes transferred."""
+
+    def __init__(self, proxy_port, request, deadline=None, count=None):
+        self.proxy_port = proxy_port
+        self.request = request
+        self.deadline = deadline
+        self.count = count
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+
+    def run(self):
+        sock = None
+        while (self.count is None or len(self.latencies) + self.errors < self.count) and \
+                (self.deadline is None or time.time() < self.deadline):
+            start = time.time()
+            try:
+                if sock is None:
+                    sock = socket.create_connection(('127.0.0.1', self.proxy_port))
+                for data in self.request:
+                    sock.sendall(data)
+                response = read_response(sock)
+                assert response.code == b'200', response.code
+            except (socket.error, AssertionError):
+                self.errors += 1
+                if sock:
+                    sock.close()
+                sock = None
+                continue
+            self.latencies.append(time.time() - start)
+            self.bytes += sum(len(data) for data in self.request) + response.received
+            if not response.is_keep_alive():
+                sock.close()
+                sock = None
+        if sock:
+            sock.close()
+
+
+def get(origin_port, size):
+    return [b'GET http://127.0.0.1:%d/bytes/%d HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n' % (origin_port, size)]
+
+
+def post(origin_port, size):
+    head = b'POST http://127.0.0.1:%d/upload HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: %d\r\n\r\n' % (
+        origin_port, size)
+    return [head] + [BLOCK[:min(len(BLOCK), size - offset)] for offset in range(0, size, len(BLOCK))]
+
+
+def load(proxy_port, request, concurrency, duration=None, count=None):
+    """Runs ``concurrency`` clients, each for ``duration`` seconds or
+    ``count`` requests."""
+    deadline = time.time() + duration if duration else None
+    clients = [Client(proxy_port, request, deadline, count) for _ in range(concurrency)]
+    threads = [threading.Thread(target=client.run) for client in clients]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies = [latency for client in clients for latency in client.latencies]
+    return {
+        'requests': len(latencies),
+        'errors': sum(client.errors for client in clients),
+        'seconds': elapsed,
+        'requests_per_sec': len(latencies) / elapsed,
+        'p50_ms': latency_ms(percentile(latencies, 50)),
+        'p95_ms': latency_ms(percentile(latencies, 95)),
+        'p99_ms': latency_ms(percentile(latencies, 99)),
+        'mb_per_sec': sum(client.bytes for client in clients) / elapsed / 1024 / 1024,
+    }
+
+
+def latency_ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def tunnels(proxy_port, echo_port, count, message=b'x' * 1024):
+    """Opens ``count`` tunnels, then sends ``message`` through each and
+    waits for it to be echoed. Latency is that of establishing a tunnel."""
+    socks, latencies, errors = [], [], 0
+    start = time.time()
+    for _ in range(count):
+        begin = time.time()
+        try:
+            sock = socket.create_connection(('127.0.0.1', proxy_port))
+            sock.sendall(b'CONNECT 127.0.0.1:%d HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n' % echo_port)
+            response = b''
+            while not response.endswith(b'\r\n\r\n'):
+                data = sock.recv(1)
+                if not data:
+                    raise socket.error('connection closed by proxy')
+                response += data
+            assert response.startswith(b'HTTP/1.1 200'), response
+        except (socket.error, AssertionError):
+            errors += 1
+            continue
+        latencies.append(time.time() - begin)
+        socks.append(sock)
+
+    for sock in socks:
+        sock.sendall(message)
+    for sock in socks:
+        received = 0
+        while received < len(message):
+            data = sock.recv(len(message))
+            if not data:
+                errors += 1
+                break
+            received += len(data)
+        sock.close()
+    elapsed = time.time() - start
+
+    return {
+        'requests': len(socks),
+        'errors': errors,
+        'seconds': elapsed,
+        'requests_per_sec': len(socks) / elapsed,
+        'p50_ms': latency_ms(percentile(latencies, 50)),
+        'p95_ms': latency_ms(percentile(latencies, 95)),
+        'p99_ms': latency_ms(percentile(latencies, 99)),
+        'mb_per_sec': 2 * len(socks) * len(message) / elapsed / 1024 / 1024,
+    }
+
+
+def run(scenario, args, origin_port, echo_port, proxy_args):
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, PROXY_PY, '--port', str(port), '--engine', args.engine,
+                             '--workers', str(args.workers), '--log-level', 'WARNING'] + proxy_args)
+    try:
+        wait_for(port)
+        if scenario == 'small':
+            result = load(port, get(origin_port, args.small_bytes), args.concurrency, duration=args.duration)
+        elif scenario == 'download':
+            result = load(port, get(origin_port, args.download_mb * 1024 * 1024), args.transfer_concurrency,
+                          count=args.transfer_count)
+        elif scenario == 'upload':
+            result = load(port, post(origin_port, args.upload_mb * 1024 * 1024), args.transfer_concurrency,
+                          count=args.transfer_count)
+        else:
+            result = tunnels(port, echo_port, args.tunnels)
+        result['peak_rss_mb'] = peak_rss(proc.pid)
+        return result
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='proxy.py load test')
+    parser.add_argument('--scenarios', nargs='+', default=['small', 'download', 'upload', 'tunnels'],
+                        choices=['small', 'download', 'upload', 'tunnels'], help='Default: all')
+    parser.add_argument('--engine', default='eventloop', help='Default: eventloop')
+    parser.add_argument('--workers', type=int, default=0, help='Default: 0')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='Clients issuing small requests. Default: 32')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds of small requests. Default: 5')
+    parser.add_argument('--small-bytes', type=int, default=128, help='Size of small responses. Default: 128')
+    parser.add_argument('--transfer-concurrency', type=int, default=4,
+                        help='Clients downloading or uploading. Default: 4')
+    parser.add_argument('--transfer-count', type=int, default=4,
+                        help='Downloads or uploads per client. Default: 4')
+    parser.add_argument('--download-mb', type=int, default=64, help='Size of downloads in MB. Default: 64')
+    parser.add_argument('--upload-mb', type=int, default=16, help='Size of uploads in MB. Default: 16')
+    parser.add_argument('--tunnels', type=int, default=500, help='Number of idle tunnels. Default: 500')
+    parser.add_argument('--json', default=None, help='File results are written to as JSON, - for stdout')
+    args, proxy_args = parser.parse_known_args()
+
+    origin_port, echo_port = start_origins()
+    results = {
+        'engine': args.engine,
+        'workers': args.workers,
+        'proxy_args': proxy_args,
+        'python': sys.version.split()[0],
+        'scenarios': {},
+    }
+
+    def number(value, format):
+        return '%*s' % (len(format % 0), '-') if value is None else format % value
+
+    if args.json != '-':
+        print('%-10s %9s %7s %10s %9s %9s %9s %9s %9s' % (
+            'scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'MB/s', 'RSS MB'))
+    for scenario in args.scenarios:
+        result = run(scenario, args, origin_port, echo_port, proxy_args)
+        results['scenarios'][scenario] = result
+        if args.json != '-':
+            print('%-10s %9d %7d %10.1f %9s %9s %9s %9.1f %9s' % (
+                scenario, result['requests'], result['errors'], result['requests_per_sec'],
+                number(result['p50_ms'], '%9.2f'), number(result['p95_ms'], '%9.2f'),
+                number(result['p99_ms'], '%9.2f'), result['mb_per_sec'], number(result['peak_rss_mb'], '%9.1f')))
+
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print('')
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/parser.py
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Throughput of HttpParser, ChunkParser and HttpParser.split on a
+    corpus of realistic requests and responses (benchmarks/corpus.py),
+    parsed in 1 byte segments, MTU sized segments and whole.
+
+    Compared against the previous implementation which re-joined and
+    re-scanned buffered data on every call (benchmarks/reference_parser.py)
+    and, with --candidate, against an alternative implementation.  Peak
+    memory allocated while parsing a message is traced with tracemalloc.
+
+    Usage: python benchmarks/parser.py [--seconds 0.2] [--candidate module:HttpParser]
+                                       [--chunk-candidate module:ChunkParser]
+"""
+import os
+import sys
+import time
+import argparse
+import importlib
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import proxy
+import corpus
+import reference_parser
+
+
+def load(name):
+    module, _, attr = name.partition(':')
+    return getattr(importlib.import_module(module), attr)
+
+
+def parse_message(cls, type, method, packets):
+    parser = cls(type)
+    parser.method = method
+    for packet in packets:
+        parser.parse(packet)
+    assert parser.state == proxy.HTTP_PARSER_STATE_COMPLETE
+
+
+def parse_chunks(cls, packets):
+    parser = cls()
+    for packet in packets:
+        parser.parse(packet)
+    assert parser.state == proxy.CHUNK_PARSER_STATE_COMPLETE
+
+
+def split_lines(cls, data):
+    line, data = cls.split(data)
+    while line:
+        line, data = cls.split(data)
+
+
+def measure(parse, size, seconds):
+    """Returns (MB/s, peak KB allocated per call) of ``parse()``
+    processing ``size`` bytes, None if it fails."""
+    try:
+        parse()
+    except Exception:
+        return None, None
+
+    calls, start = 0, time.process_time()
+    while True:
+        parse()
+        calls += 1
+        elapsed = time.process_time() - start
+        if elapsed >= seconds:
+            break
+
+    tracemalloc.start()
+    try:
+        parse()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return size * calls / elapsed / (1024 * 1024), peak / 1024.0
+
+
+def cases():
+    """Yields (name, segment size, message size, function parsing the
+    message given HttpParser and ChunkParser classes)."""
+    messages = corpus.realistic()
+    for name, type, data, method in messages:
+        for size in corpus.SEGMENTATIONS:
+            packets = corpus.segments(data, size)
+            yield name, size, len(data), lambda http, chunk, packets=packets, type=type, method=method: \
+                parse_message(http, type, method, packets)
+
+    body = dict((name, data) for name, _, data, _ in messages)['200 chunked json'].partition(proxy.CRLF * 2)[2]
+    for size in corpus.SEGMENTATIONS:
+        packets = corpus.segments(body, size)
+        yield 'chunks json', size, len(body), lambda http, chunk, packets=packets: parse_chunks(chunk, packets)
+
+    head = messages[0][2]
+    yield 'split GET browser', None, len(head), lambda http, chunk: split_lines(http, head)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP parser benchmark')
+    parser.add_argument('--seconds', type=float, default=0.2,
+                        help='CPU seconds spent on each case and parser. Default: 0.2')
+    parser.add_argument('--candidate', default=None, help='HttpParser compared, as module:class. Default: None')
+    parser.add_argument('--chunk-candidate', default=None,
+                        help='ChunkParser compared, as module:class. Default: None')
+    args = parser.parse_args()
+
+    parsers = [('previous', reference_parser.HttpParser, reference_parser.ChunkParser),
+               ('current', proxy.HttpParser, proxy.ChunkParser)]
+    if args.candidate or args.chunk_candidate:
+        parsers.append(('candidate', load(args.candidate) if args.candidate else proxy.HttpParser,
+                        load(args.chunk_candidate) if args.chunk_candidate else proxy.ChunkParser))
+
+    def number(value, format):
+        return '%*s' % (len(format % 0), '-') if value is None else format % value
+
+    print('%-20s %7s' % ('case', 'segment') +
+          ''.join(' %16s %8s' % ('%s MB/s' % name, 'peak KB') for name, _, _ in parsers))
+    for name, segment, size, parse in cases():
+        row = '%-20s %7s' % (name, segment or 'whole')
+        for _, http, chunk in parsers:
+            throughput, peak = measure(lambda: parse(http, chunk), size, args.seconds)
+            row += ' %s %s' % (number(throughput, '%16.2f'), number(peak, '%8.1f'))
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
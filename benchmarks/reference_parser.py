@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/reference_parser.py
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    HttpParser and ChunkParser as implemented before offset based
+    scanning, kept as a reference for benchmarks.  Helpers such as
+    ``is_chunked_encoded`` and ``build`` are inherited from proxy.py.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import proxy
+from proxy import CRLF, COLON, SP, urlparse
+from proxy import HTTP_REQUEST_PARSER, HTTP_RESPONSE_PARSER
+from proxy import HTTP_PARSER_STATE_INITIALIZED, HTTP_PARSER_STATE_LINE_RCVD, \
+    HTTP_PARSER_STATE_RCVING_HEADERS, HTTP_PARSER_STATE_HEADERS_COMPLETE, \
+    HTTP_PARSER_STATE_RCVING_BODY, HTTP_PARSER_STATE_COMPLETE
+from proxy import CHUNK_PARSER_STATE_WAITING_FOR_SIZE, \
+    CHUNK_PARSER_STATE_WAITING_FOR_DATA, CHUNK_PARSER_STATE_COMPLETE
+
+
+def split(data):
+    pos = data.find(CRLF)
+    if pos == -1: return False, data
+    line = data[:pos]
+    data = data[pos+len(CRLF):]
+    return line, data
+
+
+class ChunkParser(object):
+    """Chunked encoding parser re-slicing its input for every chunk."""
+
+    def __init__(self):
+        self.state = CHUNK_PARSER_STATE_WAITING_FOR_SIZE
+        self.body = b''
+        self.chunk = b''
+        self.size = None
+
+    def parse(self, data):
+        """Parses data upto the last chunk, returns any data beyond it."""
+        more = True if len(data) > 0 else False
+        while more and self.state != CHUNK_PARSER_STATE_COMPLETE:
+            more, data = self.process(data)
+        return data
+
+    def process(self, data):
+        if self.state == CHUNK_PARSER_STATE_WAITING_FOR_SIZE:
+            line, data = split(data)
+            self.size = int(line, 16)
+            self.state = CHUNK_PARSER_STATE_WAITING_FOR_DATA
+        elif self.state == CHUNK_PARSER_STATE_WAITING_FOR_DATA:
+            remaining = self.size - len(self.chunk)
+            self.chunk += data[:remaining]
+            data = data[remaining:]
+            if len(self.chunk) == self.size:
+                data = data[len(CRLF):]
+                self.body += self.chunk
+                if self.size == 0:
+                    self.state = CHUNK_PARSER_STATE_COMPLETE
+                else:
+                    self.state = CHUNK_PARSER_STATE_WAITING_FOR_SIZE
+                self.chunk = b''
+                self.size = None
+        return len(data) > 0, data
+
+
+class HttpParser(proxy.HttpParser):
+    """HTTP parser re-joining buffered data and re-scanning it from the
+    start on every call."""
+
+    def __init__(self, type=None):
+        self.state = HTTP_PARSER_STATE_INITIALIZED
+        self.type = type if type else HTTP_REQUEST_PARSER
+
+        self.raw = b''
+        self.buffer = b''
+
+        self.headers = dict()
+        # headers in the order received, including repeated ones
+        self.header_list = []
+        self.body = None
+
+        self.method = None
+        self.url = None
+        self.code = None
+        self.reason = None
+        self.version = None
+
+        self.chunker = None
+
+    def parse(self, data):
+        self.raw += data
+        data = self.buffer + data
+        self.buffer = b''
+
+        more = True if len(data) > 0 else False
+        while more and self.state != HTTP_PARSER_STATE_COMPLETE:
+            more, data = self.process(data)
+        # once complete, data beyond this message (e.g. a pipelined
+        # request) is left untouched in the buffer
+        self.buffer = data
+
+    def process(self, data):
+        if self.state >= HTTP_PARSER_STATE_HEADERS_COMPLETE and \
+        (self.method == b"POST" or self.type == HTTP_RESPONSE_PARSER):
+            if not self.body:
+                self.body = b''
+
+            if b'content-length' in self.headers:
+                self.state = HTTP_PARSER_STATE_RCVING_BODY
+                length = int(self.headers[b'content-length'][1])
+                remaining = length - len(self.body)
+                self.body += data[:remaining]
+                data = data[remaining:]
+                if len(self.body) >= length:
+                    self.state = HTTP_PARSER_STATE_COMPLETE
+            elif self.is_chunked_encoded():
+                if not self.chunker:
+                    self.chunker = ChunkParser()
+                data = self.chunker.parse(data)
+                if self.chunker.state == CHUNK_PARSER_STATE_COMPLETE:
+                    self.body = self.chunker.body
+                    self.state = HTTP_PARSER_STATE_COMPLETE
+            else:
+                data = b''
+
+            return len(data) > 0, data
+
+        line, data = split(data)
+        if line == False: return line, data
+
+        if self.state < HTTP_PARSER_STATE_LINE_RCVD:
+            self.process_line(line)
+        elif self.state < HTTP_PARSER_STATE_HEADERS_COMPLETE:
+            self.process_header(line)
+
+        if self.state == HTTP_PARSER_STATE_HEADERS_COMPLETE and \
+        self.type == HTTP_REQUEST_PARSER and \
+        not self.method == b"POST":
+            self.state = HTTP_PARSER_STATE_COMPLETE
+
+        if self.state == HTTP_PARSER_STATE_HEADERS_COMPLETE and \
+        self.type == HTTP_RESPONSE_PARSER and \
+        not self.is_body_expected():
+            self.state = HTTP_PARSER_STATE_COMPLETE
+
+        return len(data) > 0, data
+
+    def process_line(self, data):
+        line = data.split(SP)
+        if self.type == HTTP_REQUEST_PARSER:
+            self.method = line[0].upper()
+            # CONNECT carries an authority (host:port) rather than an url
+            if self.method == b"CONNECT":
+                self.url = urlparse.urlsplit(b'//' + line[1])
+            else:
+                self.url = urlparse.urlsplit(line[1])
+            self.version = line[2]
+        else:
+            self.version = line[0]
+            self.code = line[1]
+            self.reason = b' '.join(line[2:])
+        self.state = HTTP_PARSER_STATE_LINE_RCVD
+
+    def process_header(self, data):
+        if len(data) == 0:
+            if self.state == HTTP_PARSER_STATE_RCVING_HEADERS:
+                self.state = HTTP_PARSER_STATE_HEADERS_COMPLETE
+            elif self.state == HTTP_PARSER_STATE_LINE_RCVD:
+                self.state = HTTP_PARSER_STATE_RCVING_HEADERS
+        else:
+            self.state = HTTP_PARSER_STATE_RCVING_HEADERS
+            parts = data.split(COLON)
+            key = parts[0].strip()
+            value = COLON.join(parts[1:]).strip()
+            self.headers[key.lower()] = (key, value)
+            self.header_list.append((key, value))
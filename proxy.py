@@ -17,16 +17,53 @@ __author_email__ = 'mailsforabhinav@gmail.com'
 __homepage__ = 'https://github.com/abhinavsingh/proxy.py'
 __license__ = 'BSD'
 
+import os
 import sys
 import multiprocessing
-import datetime
 import argparse
 import logging
 import socket
 import select
+import errno
+import signal
+import time
+import collections
+import itertools
+import heapq
+import bisect
+import threading
+import email.utils
+import json
+import mmap
+import hashlib
+import tempfile
+import zlib
+
+try:
+    import selectors
+except ImportError:  # pragma: no cover
+    selectors = None
+
+try:
+    import asyncio
+except ImportError:  # pragma: no cover
+    asyncio = None
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
+# clock unaffected by system time changes, where available
+monotonic = getattr(time, 'monotonic', time.time)
+
 # True if we are running on Python 3.
 PY3 = sys.version_info[0] == 3
 
@@ -71,53 +108,155 @@ HTTP_PARSER_STATE_COMPLETE = 6
 
 CHUNK_PARSER_STATE_WAITING_FOR_SIZE = 1
 CHUNK_PARSER_STATE_WAITING_FOR_DATA = 2
-CHUNK_PARSER_STATE_COMPLETE = 3
+CHUNK_PARSER_STATE_WAITING_FOR_TRAILERS = 3
+CHUNK_PARSER_STATE_COMPLETE = 4
+
+PROXY_AGENT_HEADER = b'Proxy-agent: proxy.py v' + version
+
+PROXY_CONNECTION_ESTABLISHED_PKT = CRLF.join([
+    b'HTTP/1.1 200 Connection established',
+    PROXY_AGENT_HEADER,
+    CRLF
+])
+
+PROXY_BAD_GATEWAY_RESPONSE_PKT = CRLF.join([
+    b'HTTP/1.1 502 Bad Gateway',
+    PROXY_AGENT_HEADER,
+    b'Content-Length: 11',
+    b'Connection: close',
+    CRLF
+]) + b'Bad Gateway'
+
+PROXY_GATEWAY_TIMEOUT_RESPONSE_PKT = CRLF.join([
+    b'HTTP/1.1 504 Gateway Timeout',
+    PROXY_AGENT_HEADER,
+    b'Content-Length: 15',
+    b'Connection: close',
+    CRLF
+]) + b'Gateway Timeout'
+
+PROXY_SERVICE_UNAVAILABLE_RESPONSE_PKT = CRLF.join([
+    b'HTTP/1.1 503 Service Unavailable',
+    PROXY_AGENT_HEADER,
+    b'Content-Length: 19',
+    b'Connection: close',
+    CRLF
+]) + b'Service Unavailable'
+
+PROXY_NOT_FOUND_RESPONSE_PKT = CRLF.join([
+    b'HTTP/1.1 404 Not Found',
+    PROXY_AGENT_HEADER,
+    b'Content-Length: 9',
+    b'Connection: close',
+    CRLF
+]) + b'Not Found'
 
 
 class ChunkParser(object):
-    """HTTP chunked encoding response parser."""
+    """HTTP chunked encoding response parser.
     
-    def __init__(self):
+    Data is scanned in place, only an incomplete chunk size or trailer
+    line is held back until the rest of it arrives. Decoded data is
+    collected in ``body``, or if a ``callback`` is given passed to it
+    instead.  Trailer fields following the last chunk are collected in
+    ``trailers``.
+    """
+    
+    def __init__(self, callback=None):
         self.state = CHUNK_PARSER_STATE_WAITING_FOR_SIZE
-        self.body = b''
+        self.callback = callback
+        self.body = bytearray()
+        self.trailers = []
+        # incomplete chunk size or trailer line
         self.chunk = b''
+        # size of the chunk being received
         self.size = None
+        # bytes of the chunk, including its trailing CRLF, yet to be received
+        self.remaining = 0
     
     def parse(self, data):
-        more = True if len(data) > 0 else False
-        while more: more, data = self.process(data)
-    
-    def process(self, data):
-        if self.state == CHUNK_PARSER_STATE_WAITING_FOR_SIZE:
-            line, data = HttpParser.split(data)
-            self.size = int(line, 16)
-            self.state = CHUNK_PARSER_STATE_WAITING_FOR_DATA
-        elif self.state == CHUNK_PARSER_STATE_WAITING_FOR_DATA:
-            remaining = self.size - len(self.chunk)
-            self.chunk += data[:remaining]
-            data = data[remaining:]
-            if len(self.chunk) == self.size:
-                data = data[len(CRLF):]
-                self.body += self.chunk
-                if self.size == 0:
-                    self.state = CHUNK_PARSER_STATE_COMPLETE
+        """Parses data upto the last chunk, returns any data beyond it."""
+        offset = 0
+        while offset < len(data) and self.state != CHUNK_PARSER_STATE_COMPLETE:
+            offset = self.process(data, offset)
+        return data[offset:]
+    
+    def process(self, data, offset):
+        """Processes data starting at offset, returns offset upto which it was consumed."""
+        if self.state in (CHUNK_PARSER_STATE_WAITING_FOR_SIZE, CHUNK_PARSER_STATE_WAITING_FOR_TRAILERS):
+            # lines and their CRLF may be split across segments
+            pos = data.find(b'\n', offset)
+            if pos == -1:
+                self.chunk += bytes(data[offset:])
+                return len(data)
+            line, self.chunk = (self.chunk + bytes(data[offset:pos])).rstrip(b'\r'), b''
+            if self.state == CHUNK_PARSER_STATE_WAITING_FOR_TRAILERS:
+                # trailer section ends with an empty line
+                if line:
+                    self.trailers.append(line)
                 else:
-                    self.state = CHUNK_PARSER_STATE_WAITING_FOR_SIZE
-                self.chunk = b''
+                    self.state = CHUNK_PARSER_STATE_COMPLETE
+                return pos + 1
+            
+            self.size = int(line.split(b';')[0], 16)
+            if self.size < 0:
+                raise ValueError('Invalid chunk size %r' % line)
+            if self.size == 0:
+                self.state = CHUNK_PARSER_STATE_WAITING_FOR_TRAILERS
                 self.size = None
-        return len(data) > 0, data
+            else:
+                self.remaining = self.size + len(CRLF)
+                self.state = CHUNK_PARSER_STATE_WAITING_FOR_DATA
+            return pos + 1
+        
+        size = min(self.remaining, len(data) - offset)
+        content = min(size, self.remaining - len(CRLF))
+        if content > 0:
+            if self.callback:
+                self.callback(memoryview(data)[offset:offset + content])
+            else:
+                self.body += memoryview(data)[offset:offset + content]
+        self.remaining -= size
+        if self.remaining == 0:
+            self.state = CHUNK_PARSER_STATE_WAITING_FOR_SIZE
+            self.size = None
+        return offset + size
 
 class HttpParser(object):
-    """HTTP request/response parser."""
+    """HTTP request/response parser.
+    
+    Data is appended to a single buffer which is scanned from where the
+    previous call left off, parsing a message takes time linear to its
+    size however it is segmented. Received data is retained in ``raw``
+    only if ``keep_raw`` is set.
+    
+    Decoded body data is collected in ``body`` and passed to ``on_body``
+    if given, as a memoryview only valid during the call. In ``stream``
+    mode body isn't collected, the parser only tracks framing and byte
+    counters and uses constant memory whatever the size of body.
+    """
     
-    def __init__(self, type=None):
+    def __init__(self, type=None, keep_raw=False, stream=False, on_body=None):
         self.state = HTTP_PARSER_STATE_INITIALIZED
         self.type = type if type else HTTP_REQUEST_PARSER
         
-        self.raw = b''
-        self.buffer = b''
+        self.keep_raw = keep_raw
+        self.stream = stream
+        self.on_body = on_body
+        self.raw = bytearray()
+        # unparsed data, once complete data beyond this message
+        self.buffer = bytearray()
+        # offset upto which buffer has been scanned for a line end
+        self.scanned = 0
+        # bytes parsed so far, and of those the size of message head
+        self.received = 0
+        self.head_size = 0
+        # decoded body bytes received so far
+        self.body_size = 0
         
         self.headers = dict()
+        # headers in the order received, including repeated ones
+        self.header_list = []
         self.body = None
         
         self.method = None
@@ -129,57 +268,97 @@ class HttpParser(object):
         self.chunker = None
     
     def parse(self, data):
-        self.raw += data
-        data = self.buffer + data
-        self.buffer = b''
-        
-        more = True if len(data) > 0 else False
-        while more: 
-            more, data = self.process(data)
-        self.buffer = data
-    
-    def process(self, data):
-        if self.state >= HTTP_PARSER_STATE_HEADERS_COMPLETE and \
-        (self.method == b"POST" or self.type == HTTP_RESPONSE_PARSER):
-            if not self.body:
-                self.body = b''
-
-            if b'content-length' in self.headers:
-                self.state = HTTP_PARSER_STATE_RCVING_BODY
-                self.body += data
-                if len(self.body) >= int(self.headers[b'content-length'][1]):
-                    self.state = HTTP_PARSER_STATE_COMPLETE
-            elif b'transfer-encoding' in self.headers and self.headers[b'transfer-encoding'][1].lower() == b'chunked':
-                if not self.chunker:
-                    self.chunker = ChunkParser()
-                self.chunker.parse(data)
-                if self.chunker.state == CHUNK_PARSER_STATE_COMPLETE:
-                    self.body = self.chunker.body
-                    self.state = HTTP_PARSER_STATE_COMPLETE
-            
-            return False, b''
+        self.received += len(data)
+        if self.keep_raw:
+            self.raw += data
+        
+        # once complete, data beyond this message (e.g. a pipelined
+        # request) is left untouched in the buffer
+        if self.state == HTTP_PARSER_STATE_COMPLETE:
+            self.buffer += data
+            return
+        
+        # body is parsed straight from data, without buffering
+        if self.state >= HTTP_PARSER_STATE_HEADERS_COMPLETE:
+            self.buffer += self.process_body(data)
+            return
         
-        line, data = HttpParser.split(data)
-        if line == False: return line, data
+        self.buffer += data
+        self.process_head()
+        if self.state == HTTP_PARSER_STATE_HEADERS_COMPLETE and self.buffer:
+            data, self.buffer = self.buffer, bytearray()
+            self.buffer += self.process_body(data)
+    
+    def process_head(self):
+        """Processes complete lines in buffer until headers are complete."""
+        start = 0
+        end = self.buffer.find(CRLF, self.scanned)
+        while end != -1:
+            self.process(bytes(self.buffer[start:end]))
+            start = end + len(CRLF)
+            if self.state >= HTTP_PARSER_STATE_HEADERS_COMPLETE:
+                break
+            end = self.buffer.find(CRLF, start)
         
+        # discard processed lines
+        if start:
+            del self.buffer[:start]
+            self.head_size += start
+        # last byte may be the first half of a CRLF
+        self.scanned = max(len(self.buffer) - 1, 0)
+    
+    def process(self, line):
         if self.state < HTTP_PARSER_STATE_LINE_RCVD:
             self.process_line(line)
         elif self.state < HTTP_PARSER_STATE_HEADERS_COMPLETE:
             self.process_header(line)
         
         if self.state == HTTP_PARSER_STATE_HEADERS_COMPLETE and \
-        self.type == HTTP_REQUEST_PARSER and \
-        not self.method == b"POST" and \
-        self.raw.endswith(CRLF*2):
+        not self.is_body_expected():
             self.state = HTTP_PARSER_STATE_COMPLETE
+    
+    def process_body(self, data):
+        """Processes data upto the end of body, returns any data beyond it."""
+        if self.body is None and not self.stream:
+            self.body = bytearray()
+        
+        if b'content-length' in self.headers:
+            self.state = HTTP_PARSER_STATE_RCVING_BODY
+            length = int(self.headers[b'content-length'][1])
+            remaining = length - self.body_size
+            self.process_body_data(memoryview(data)[:remaining])
+            if self.body_size >= length:
+                self.state = HTTP_PARSER_STATE_COMPLETE
+            return data[remaining:]
+        
+        if self.is_chunked_encoded():
+            if not self.chunker:
+                self.chunker = ChunkParser(self.process_body_data)
+            data = self.chunker.parse(data)
+            if self.chunker.state == CHUNK_PARSER_STATE_COMPLETE:
+                self.state = HTTP_PARSER_STATE_COMPLETE
+            return data
         
-        return len(data) > 0, data
+        # body is delimited by the connection being closed
+        self.process_body_data(memoryview(data))
+        return b''
+    
+    def process_body_data(self, data):
+        self.body_size += len(data)
+        if not self.stream:
+            self.body += data
+        if self.on_body:
+            self.on_body(data)
     
     def process_line(self, data):
         line = data.split(SP)
         if self.type == HTTP_REQUEST_PARSER:
             self.method = line[0].upper()
-            self.url = urlparse.urlsplit(line[1])
+            # CONNECT carries an authority (host:port) rather than an url
+            if self.method == b"CONNECT":
+                self.url = urlparse.urlsplit(b'//' + line[1])
+            else:
+                self.url = urlparse.urlsplit(line[1])
             self.version = line[2]
         else:
             self.version = line[0]
@@ -192,41 +371,104 @@ class HttpParser(object):
             if self.state == HTTP_PARSER_STATE_RCVING_HEADERS:
                 self.state = HTTP_PARSER_STATE_HEADERS_COMPLETE
             elif self.state == HTTP_PARSER_STATE_LINE_RCVD:
-                self.state = HTTP_PARSER_STATE_RCVING_HEADERS
+                # a response may carry no headers at all, e.g. 100 Continue
+                if self.type == HTTP_RESPONSE_PARSER:
+                    self.state = HTTP_PARSER_STATE_HEADERS_COMPLETE
+                else:
+                    self.state = HTTP_PARSER_STATE_RCVING_HEADERS
         else:
             self.state = HTTP_PARSER_STATE_RCVING_HEADERS
-            parts = data.split(COLON)
-            key = parts[0].strip()
-            value = COLON.join(parts[1:]).strip()
+            key, _, value = data.partition(COLON)
+            key, value = key.strip(), value.strip()
             self.headers[key.lower()] = (key, value)
+            self.header_list.append((key, value))
+    
+    def is_chunked_encoded(self):
+        return b'transfer-encoding' in self.headers and \
+            self.headers[b'transfer-encoding'][1].lower() == b'chunked'
+    
+    def is_body_expected(self):
+        """False if a message carries no body.
+        
+        Requests of any method carry a body only if framed by content-length
+        or chunked encoding. For response parsers ``method`` may be set to
+        the method of the corresponding request, responses to HEAD requests
+        have no body.
+        """
+        if self.type == HTTP_REQUEST_PARSER:
+            if self.is_chunked_encoded():
+                return True
+            return int(self.headers.get(b'content-length', (None, b'0'))[1]) > 0
+        
+        if self.method == b"HEAD" or self.code in (b'204', b'304') or \
+        (self.code and self.code.startswith(b'1')) or \
+        (self.method == b"CONNECT" and self.code and self.code.startswith(b'2')):
+            return False
+        if b'content-length' in self.headers:
+            return int(self.headers[b'content-length'][1]) > 0
+        return True
+    
+    def is_keep_alive(self):
+        """True if the connection may be reused once this message is complete."""
+        tokens = [t.strip().lower() for t in self.headers.get(b'connection', (None, b''))[1].split(b',')]
+        if self.version == b'HTTP/1.1':
+            return b'close' not in tokens
+        return b'keep-alive' in tokens
+    
+    def address(self):
+        """Returns (host, port) of the server this request is addressed to,
+        given by Host header for requests with an url path only."""
+        if self.method == b"CONNECT":
+            return self.url.hostname, self.url.port if self.url.port else 443
+        url = self.url
+        if url.hostname is None and b'host' in self.headers:
+            url = urlparse.urlsplit(b'//' + self.headers[b'host'][1])
+        return url.hostname, url.port if url.port else 80
     
-    def build_url(self):
+    def build_url(self, absolute=False):
+        """Returns url of the request in origin form, or if ``absolute``
+        in absolute form (authority of CONNECT requests) as sent to
+        proxies."""
         if not self.url:
             return b'/None'
+        if absolute and self.method == b"CONNECT":
+            return self.url.netloc
         
         url = self.url.path
         if url == b'': url = b'/'
         if not self.url.query == b'': url += b'?' + self.url.query
         if not self.url.fragment == b'': url += b'#' + self.url.fragment
+        host, port = self.address() if absolute else (None, None)
+        if host:
+            url = b'http://' + host + (b'' if port == 80 else b':%d' % port) + url
         return url
     
     def build_header(self, k, v):
         return k + b": " + v + CRLF
     
-    def build(self, del_headers=None, add_headers=None):
-        req = b" ".join([self.method, self.build_url(), self.version])
-        req += CRLF
+    def build_line(self, absolute=False):
+        if self.type == HTTP_REQUEST_PARSER:
+            return b" ".join([self.method, self.build_url(absolute), self.version])
+        return b" ".join([self.version, self.code, self.reason])
+    
+    def build_head(self, del_headers=None, add_headers=None, absolute=False):
+        head = self.build_line(absolute)
+        head += CRLF
         
         if not del_headers: del_headers = []
-        for k in self.headers:
-            if not k in del_headers:
-                req += self.build_header(self.headers[k][0], self.headers[k][1])
+        for k, v in self.header_list:
+            if not k.lower() in del_headers:
+                head += self.build_header(k, v)
         
         if not add_headers: add_headers = []
         for k in add_headers:
-            req += self.build_header(k[0], k[1])
+            head += self.build_header(k[0], k[1])
         
-        req += CRLF
+        head += CRLF
+        return head
+    
+    def build(self, del_headers=None, add_headers=None):
+        req = self.build_head(del_headers, add_headers)
         if self.body:
             req += self.body
         
@@ -240,13 +482,64 @@ class HttpParser(object):
         data = data[pos+len(CRLF):]
         return line, data
 
+class BufferPool(object):
+    """Pool of preallocated receive buffers.
+    
+    Connections receive into pooled ``bytearray`` buffers with
+    ``recv_into``.  A buffer handed out along with received data returns
+    to the pool once all of its data has been flushed to the peer.
+    """
+    
+    def __init__(self, size=65536, max_free=64):
+        self.size = size
+        self.max_free = max_free
+        self.free = []
+        self.owned = set()
+    
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        buf = bytearray(self.size)
+        self.owned.add(id(buf))
+        return buf
+    
+    def release(self, buf):
+        if id(buf) not in self.owned:
+            return
+        if len(self.free) < self.max_free:
+            self.free.append(buf)
+        else:
+            self.owned.discard(id(buf))
+
+buffer_pool = BufferPool()
+
+# maximum segments passed to a single sendmsg call
+SENDMSG_MAX_SEGMENTS = 64
+
 class Connection(object):
-    """TCP server/client connection abstraction."""
+    """TCP server/client connection abstraction.
+    
+    Pending data is kept as a deque of ``memoryview`` segments, so that
+    queueing never copies data and partial sends only slice the first
+    segment.  Flushing passes multiple segments to ``sendmsg`` at once
+    where available.
+    """
     
     def __init__(self, what):
-        self.buffer = b''
+        self.conn = None
+        self.segments = collections.deque()
+        self.pending = 0
+        # bytes flushed so far
+        self.sent = 0
         self.closed = False
         self.what = what # server or client
+        # set once pending data exceeds the high watermark,
+        # until it drains down to the low watermark
+        self.congested = False
+    
+    @property
+    def buffer(self):
+        return b''.join(bytes(segment) for segment in self.segments)
     
     def send(self, data):
         return self.conn.send(data)
@@ -255,42 +548,239 @@ class Connection(object):
         try:
             data = self.conn.recv(bytes)
             if len(data) == 0:
-                logger.debug('recvd 0 bytes from %s' % self.what)
+                logger.debug('recvd 0 bytes from %s', self.what)
                 return None
-            logger.debug('rcvd %d bytes from %s' % (len(data), self.what))
+            logger.debug('rcvd %d bytes from %s', len(data), self.what)
             return data
         except Exception as e:
             logger.exception('Exception while receiving from connection %s %r with reason %r' % (self.what, self.conn, e))
             return None
     
+    def recv_view(self):
+        """Receives into a pooled buffer, returns a memoryview of received data.
+        
+        Used where data is only relayed to the peer.  Small reads are
+        copied out so that a mostly empty buffer isn't held while the
+        data is pending.
+        """
+        buf = buffer_pool.acquire()
+        try:
+            size = self.conn.recv_into(buf)
+        except Exception as e:
+            buffer_pool.release(buf)
+            logger.exception('Exception while receiving from connection %s %r with reason %r' % (self.what, self.conn, e))
+            return None
+        
+        if size == 0:
+            buffer_pool.release(buf)
+            logger.debug('recvd 0 bytes from %s', self.what)
+            return None
+        logger.debug('rcvd %d bytes from %s', size, self.what)
+        
+        if size < buffer_pool.size // 4:
+            data = memoryview(bytes(buf[:size]))
+            buffer_pool.release(buf)
+            return data
+        return memoryview(buf)[:size]
+    
     def close(self):
-        self.conn.close()
+        if self.conn is not None:
+            self.conn.close()
         self.closed = True
+        self._consume(self.pending)
     
     def buffer_size(self):
-        return len(self.buffer)
+        return self.pending
     
     def has_buffer(self):
-        return self.buffer_size() > 0
+        return self.pending > 0
+    
+    def is_congested(self, high_watermark, low_watermark):
+        """True if the peer is expected to stop reading data for this
+        connection until it drains."""
+        if self.pending > high_watermark:
+            self.congested = True
+        elif self.pending <= low_watermark:
+            self.congested = False
+        return self.congested
     
     def queue(self, data):
-        self.buffer += data
+        if len(data) > 0:
+            self.segments.append(memoryview(data))
+            self.pending += len(data)
     
     def flush(self):
-        sent = self.send(self.buffer)
-        self.buffer = self.buffer[sent:]
-        logger.debug('flushed %d bytes to %s' % (sent, self.what))
+        if not self.segments:
+            return
+        
+        try:
+            if len(self.segments) > 1 and hasattr(self.conn, 'sendmsg'):
+                sent = self.conn.sendmsg(list(itertools.islice(self.segments, SENDMSG_MAX_SEGMENTS)))
+            else:
+                sent = self.send(self.segments[0])
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            sent = 0
+        self._consume(sent)
+        self.sent += sent
+        logger.debug('flushed %d bytes to %s', sent, self.what)
+    
+    def _consume(self, sent):
+        self.pending -= sent
+        while sent > 0:
+            segment = self.segments[0]
+            if len(segment) > sent:
+                self.segments[0] = segment[sent:]
+                break
+            sent -= len(segment)
+            self.segments.popleft()
+            if isinstance(getattr(segment, 'obj', None), bytearray):
+                buffer_pool.release(segment.obj)
+
+# delay between staggered connection attempts (RFC 8305)
+CONNECTION_ATTEMPT_DELAY = 0.25
 
 class Server(Connection):
-    """Establish connection to destination server."""
+    """Establish connection to destination server.
+    
+    ``connect`` connects blocking.  ``start_connect`` instead starts
+    non-blocking connection attempts, driven by ``process_connect`` as
+    they become ready for writes.  Addresses are attempted alternating
+    between families, a new attempt starting every ``attempt_delay``
+    seconds or as soon as one fails, the first to connect wins (RFC 8305).
+    """
     
     def __init__(self, host, port):
         super(Server, self).__init__(b'server')
         self.addr = (host, int(port))
+        
+        # sockets of connection attempts in progress
+        self.attempts = []
+        self.addresses = []
+        self.attempt_delay = CONNECTION_ATTEMPT_DELAY
+        self.next_attempt = None
+        self.deadline = None
+        self.error = None
+    
+    def resolve(self):
+        """Resolves server address blocking, returns (family, sockaddr) pairs."""
+        return [(family, sockaddr) for family, _, _, _, sockaddr in
+                socket.getaddrinfo(text_(self.addr[0]), self.addr[1], 0, socket.SOCK_STREAM)]
+    
+    def connect(self, addresses=None):
+        """Connects to the first reachable of ``addresses``, a list of
+        (family, sockaddr) pairs, resolving server address if not given."""
+        if addresses is None:
+            addresses = self.resolve()
+        
+        error = socket.error('no addresses to connect to')
+        for family, sockaddr in addresses:
+            conn = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                conn.connect(sockaddr)
+            except socket.error as e:
+                conn.close()
+                error = e
+            else:
+                self.conn = conn
+                return
+        raise error
+    
+    def start_connect(self, addresses=None, timeout=10, attempt_delay=CONNECTION_ATTEMPT_DELAY):
+        """Starts connecting to ``addresses`` without blocking, giving up
+        after ``timeout`` seconds."""
+        if addresses is None:
+            addresses = self.resolve()
+        
+        self.addresses = self.interleave_families(addresses)
+        self.error = socket.error('no addresses to connect to')
+        self.attempt_delay = attempt_delay
+        self.deadline = monotonic() + timeout
+        self._attempt()
+        if not self.attempts:
+            self.deadline = None
+            raise self.error
+    
+    @staticmethod
+    def interleave_families(addresses):
+        """Orders addresses alternating between families, starting with
+        the family of the first address."""
+        ranked, counts = [], dict()
+        for address in addresses:
+            counts[address[0]] = counts.get(address[0], 0) + 1
+            ranked.append((counts[address[0]], address))
+        return [address for _, address in sorted(ranked, key=lambda item: item[0])]
+    
+    def is_connecting(self):
+        return self.deadline is not None
+    
+    def next_timeout(self):
+        """Seconds until ``process_connect`` must be called regardless of readiness."""
+        deadline = self.deadline
+        if self.next_attempt is not None and self.addresses:
+            deadline = min(deadline, self.next_attempt)
+        return max(deadline - monotonic(), 0)
+    
+    def process_connect(self, w):
+        """Processes connection attempts ready for writes, returns True once
+        connected.  Raises ``socket.timeout`` once timed out, or the last
+        error once every address has failed."""
+        for conn in [conn for conn in self.attempts if conn in w]:
+            self.attempts.remove(conn)
+            err = conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err == 0:
+                self._cancel_attempts()
+                self.conn = conn
+                self.deadline = None
+                return True
+            conn.close()
+            self.error = socket.error(err, os.strerror(err))
+            self._attempt()
+        
+        now = monotonic()
+        if self.next_attempt is not None and now >= self.next_attempt:
+            self._attempt()
+        
+        if not self.attempts:
+            self.deadline = None
+            raise self.error
+        if now >= self.deadline:
+            self._cancel_attempts()
+            self.deadline = None
+            raise socket.timeout('timed out')
+        return False
     
-    def connect(self):
-        self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.conn.connect((self.addr[0], self.addr[1]))
+    def _attempt(self):
+        while self.addresses:
+            family, sockaddr = self.addresses.pop(0)
+            logger.debug('attempting connection to %r', sockaddr)
+            try:
+                conn = socket.socket(family, socket.SOCK_STREAM)
+            except socket.error as e:
+                self.error = e
+                continue
+            conn.setblocking(False)
+            err = conn.connect_ex(sockaddr)
+            if err in (0, errno.EINPROGRESS, errno.EAGAIN, errno.EWOULDBLOCK):
+                self.attempts.append(conn)
+                self.next_attempt = monotonic() + self.attempt_delay
+                return
+            conn.close()
+            self.error = socket.error(err, os.strerror(err))
+        self.next_attempt = None
+    
+    def _cancel_attempts(self):
+        for conn in self.attempts:
+            conn.close()
+        self.attempts = []
+        self.addresses = []
+        self.next_attempt = None
+    
+    def close(self):
+        self._cancel_attempts()
+        self.deadline = None
+        super(Server, self).close()
 
 class Client(Connection):
     """Accepted client connection."""
@@ -300,250 +790,3089 @@ class Client(Connection):
         self.conn = conn
         self.addr = addr
 
-class ProxyError(Exception):
-    pass
-
-class ProxyConnectionFailed(ProxyError):
-    
-    def __init__(self, host, port, reason):
-        self.host = host
-        self.port = port
-        self.reason = reason
-    
-    def __str__(self):
-        return '<ProxyConnectionFailed - %s:%s - %s>' % (self.host, self.port, self.reason)
-
-class Proxy(multiprocessing.Process):
-    """HTTP proxy implementation.
+class ConnectionPool(object):
+    """Pool of idle keep-alive connections to destination servers.
     
-    Accepts connection object and act as a proxy between client and server.
+    Keeps upto ``max_idle`` idle ``Server`` connections per (host, port).
+    Connections idle for longer than ``idle_timeout`` seconds are closed
+    and every connection is checked for liveness before being reused.
     """
     
-    def __init__(self, client):
-        super(Proxy, self).__init__()
-        
-        self.start_time = self._now()
-        self.last_activity = self.start_time
-        
-        self.client = client
-        self.server = None
-        
-        self.request = HttpParser()
-        self.response = HttpParser(HTTP_RESPONSE_PARSER)
-        
-        self.connection_established_pkt = CRLF.join([
-            b'HTTP/1.1 200 Connection established',
-            b'Proxy-agent: proxy.py v' + version,
-            CRLF
-        ])
-    
-    def _now(self):
-        return datetime.datetime.utcnow()
+    def __init__(self, max_idle=8, idle_timeout=30):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.pools = dict()
+        self.last_eviction = monotonic()
     
-    def _inactive_for(self):
-        return (self._now() - self.last_activity).seconds
+    def acquire(self, host, port):
+        """Returns an idle connection to host:port or None."""
+        self.evict_expired()
+        idle = self.pools.get((host, int(port)))
+        while idle:
+            server, released_at = idle.pop()
+            if monotonic() - released_at < self.idle_timeout and self._is_alive(server):
+                logger.debug('reusing pooled connection to server %s:%s', host, port)
+                return server
+            server.close()
+        return None
     
-    def _is_inactive(self):
-        return self._inactive_for() > 30
+    def release(self, server):
+        """Returns a connection to the pool, closing it if the pool is full."""
+        idle = self.pools.setdefault(server.addr, [])
+        if len(idle) >= self.max_idle:
+            server.close()
+        else:
+            logger.debug('releasing connection to server %s:%s into pool', *server.addr)
+            idle.append((server, monotonic()))
+        self.evict_expired()
     
-    def _process_request(self, data):
-        # once we have connection to the server
-        # we don't parse the http request packets
-        # any further, instead just pipe incoming
-        # data from client to server
-        if self.server and not self.server.closed:
-            self.server.queue(data)
+    def evict_expired(self):
+        now = monotonic()
+        if now - self.last_eviction < 1:
             return
+        self.last_eviction = now
         
-        # parse http request
-        self.request.parse(data)
-        
-        # once http request parser has reached the state complete
-        # we attempt to establish connection to destination server
-        if self.request.state == HTTP_PARSER_STATE_COMPLETE:
-            logger.debug('request parser is in state complete')
-            
-            if self.request.method == b"CONNECT":
-                host, port = self.request.url.path.split(COLON)
-            elif self.request.url:
-                host, port = self.request.url.hostname, self.request.url.port if self.request.url.port else 80
-            
-            self.server = Server(host, port)
-            try:
-                logger.debug('connecting to server %s:%s' % (host, port))
-                self.server.connect()
-                logger.debug('connected to server %s:%s' % (host, port))
-            except Exception as e:
-                self.server.closed = True
-                raise ProxyConnectionFailed(host, port, repr(e))
-            
-            # for http connect methods (https requests)
-            # queue appropriate response for client 
-            # notifying about established connection
-            if self.request.method == b"CONNECT":
-                self.client.queue(self.connection_established_pkt)
-            # for usual http requests, re-build request packet
-            # and queue for the server with appropriate headers
+        for addr in list(self.pools):
+            alive = []
+            for server, released_at in self.pools[addr]:
+                if now - released_at < self.idle_timeout:
+                    alive.append((server, released_at))
+                else:
+                    server.close()
+            if alive:
+                self.pools[addr] = alive
             else:
-                self.server.queue(self.request.build(
-                    del_headers=[b'proxy-connection', b'connection', b'keep-alive'], 
-                    add_headers=[(b'Connection', b'Close')]
-                ))
+                del self.pools[addr]
     
-    def _process_response(self, data):
-        # parse incoming response packet
-        # only for non-https requests
-        if not self.request.method == b"CONNECT":
-            self.response.parse(data)
-        
-        # queue data for client
-        self.client.queue(data)
+    @staticmethod
+    def _is_alive(server):
+        # an idle connection must never be readable, if it is the
+        # server has either closed it or sent unsolicited data
+        try:
+            r, w, x = select.select([server.conn], [], [], 0)
+        except (socket.error, ValueError):
+            return False
+        return len(r) == 0
     
-    def _access_log(self):
-        host, port = self.server.addr if self.server else (None, None)
-        if self.request.method == b"CONNECT":
-            logger.info("%s:%s - %s %s:%s" % (self.client.addr[0], self.client.addr[1], self.request.method, host, port))
-        elif self.request.method:
-            logger.info("%s:%s - %s %s:%s%s - %s %s - %s bytes" % (self.client.addr[0], self.client.addr[1], self.request.method, host, port, self.request.build_url(), self.response.code, self.response.reason, len(self.response.raw)))
-        
-    def _get_waitable_lists(self):
-        rlist, wlist, xlist = [self.client.conn], [], []
-        logger.debug('*** watching client for read ready')
-        
-        if self.client.has_buffer():
-            logger.debug('pending client buffer found, watching client for write ready')
-            wlist.append(self.client.conn)
-        
-        if self.server and not self.server.closed:
-            logger.debug('connection to server exists, watching server for read ready')
-            rlist.append(self.server.conn)
+    def close(self):
+        for idle in self.pools.values():
+            for server, released_at in idle:
+                server.close()
+        self.pools = dict()
+
+class Resolver(object):
+    """Resolves server hostnames, caching results.
+    
+    Upto ``max_size`` lookups are cached in LRU order, addresses for
+    ``ttl`` seconds and failures for ``negative_ttl`` seconds.  ``lookup``
+    resolves within the calling thread.  Once started, ``resolve`` runs
+    lookups in a pool of ``workers`` threads off the event path and
+    concurrent lookups of a name are coalesced into one.  Results are
+    delivered by ``process_completed``, which the event loop invokes when
+    the resolver is ready for reads.  Lookups are performed by
+    ``getaddrinfo``, which may be replaced to plug in another resolver.
+    """
+    
+    def __init__(self, max_size=1024, ttl=60, negative_ttl=5, workers=4, getaddrinfo=socket.getaddrinfo):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.workers = workers
+        self.getaddrinfo = getaddrinfo
         
-        if self.server and not self.server.closed and self.server.has_buffer():
-            logger.debug('connection to server exists and pending server buffer found, watching server for write ready')
-            wlist.append(self.server.conn)
+        # (host, port) -> (expires_at, (addresses, error))
+        self.cache = collections.OrderedDict()
+        # (host, port) -> callbacks waiting for the lookup in progress
+        self.waiters = dict()
+        self.lookups = queue.Queue()
+        self.completed = collections.deque()
+        self.threads = []
+        self.reader = self.writer = None
         
-        return rlist, wlist, xlist
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
     
-    def _process_wlist(self, w):
-        if self.client.conn in w:
-            logger.debug('client is ready for writes, flushing client buffer')
-            self.client.flush()
+    def start(self):
+        """Starts lookup threads, must be called within the process using them."""
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+    
+    def fileno(self):
+        return self.reader.fileno()
+    
+    def lookup(self, host, port):
+        """Resolves host:port blocking, returns (addresses, error)."""
+        key = (host, int(port))
+        result = self._cached(key)
+        if result:
+            self.hits += 1
+            return result
         
-        if self.server and not self.server.closed and self.server.conn in w:
-            logger.debug('server is ready for writes, flushing server buffer')
-            self.server.flush()
+        self.misses += 1
+        result = self._query(key)
+        self._store(key, result)
+        return result
     
-    def _process_rlist(self, r):
-        if self.client.conn in r:
-            logger.debug('client is ready for reads, reading')
-            data = self.client.recv()
-            self.last_activity = self._now()
-            
-            if not data:
-                logger.debug('client closed connection, breaking')
-                return True
-            
-            try:
-                self._process_request(data)
-            except ProxyConnectionFailed as e:
-                logger.exception(e)
-                self.client.queue(CRLF.join([
-                    b'HTTP/1.1 502 Bad Gateway',
-                    b'Proxy-agent: proxy.py v' + version,
-                    b'Content-Length: 11',
-                    b'Connection: close',
-                    CRLF
-                ]) + b'Bad Gateway')
-                self.client.flush()
-                return True
+    def resolve(self, host, port, callback):
+        """Returns cached (addresses, error) for host:port if any, otherwise
+        returns None and ``callback(addresses, error)`` is invoked once
+        host is resolved."""
+        key = (host, int(port))
+        result = self._cached(key)
+        if result:
+            self.hits += 1
+            return result
         
-        if self.server and not self.server.closed and self.server.conn in r:
-            logger.debug('server is ready for reads, reading')
-            data = self.server.recv()
-            self.last_activity = self._now()
-            
-            if not data:
-                logger.debug('server closed connection')
-                self.server.close()
-            else:
-                self._process_response(data)
+        self.misses += 1
+        if key in self.waiters:
+            self.coalesced += 1
+            self.waiters[key].append(callback)
+        else:
+            self.waiters[key] = [callback]
+            self.lookups.put(key)
+        return None
+    
+    def process_completed(self):
+        """Caches completed lookups and invokes callbacks waiting for them."""
+        try:
+            while self.reader.recv(4096):
+                pass
+        except socket.error:
+            pass
         
-        return False
+        while self.completed:
+            key, result = self.completed.popleft()
+            self._store(key, result)
+            for callback in self.waiters.pop(key, []):
+                callback(*result)
     
-    def _process(self):
+    def _query(self, key):
+        try:
+            infos = self.getaddrinfo(text_(key[0]), key[1], 0, socket.SOCK_STREAM)
+        except socket.error as e:
+            return None, e
+        return [(family, sockaddr) for family, _, _, _, sockaddr in infos], None
+    
+    def _work(self):
         while True:
-            rlist, wlist, xlist = self._get_waitable_lists()
-            r, w, x = select.select(rlist, wlist, xlist, 1)
-            
-            self._process_wlist(w)
-            if self._process_rlist(r):
-                break
-            
-            if self.client.buffer_size() == 0:
-                if self.response.state == HTTP_PARSER_STATE_COMPLETE:
-                    logger.debug('client buffer is empty and response state is complete, breaking')
-                    break
-                
-                if self._is_inactive():
-                    logger.debug('client buffer is empty and maximum inactivity has reached, breaking')
-                    break
+            key = self.lookups.get()
+            if key is None:
+                return
+            self.completed.append((key, self._query(key)))
+            try:
+                self.writer.send(b'\0')
+            except socket.error:
+                # reader is already due to wake up, or closed
+                pass
     
-    def run(self):
-        logger.debug('Proxying connection %r at address %r' % (self.client.conn, self.client.addr))
-        try:
-            self._process()
-        except KeyboardInterrupt:
-            pass
-        except Exception as e:
-            logger.exception('Exception while handling connection %r with reason %r' % (self.client.conn, e))
-        finally:
-            logger.debug("closing client connection with pending client buffer size %d bytes" % self.client.buffer_size())
-            self.client.close()
-            if self.server:
-                logger.debug("closed client connection with pending server buffer size %d bytes" % self.server.buffer_size())
-            self._access_log()
-            logger.debug('Closing proxy for connection %r at address %r' % (self.client.conn, self.client.addr))
+    def _cached(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is None or entry[0] <= monotonic():
+            return None
+        # re-inserted as the most recently used
+        self.cache[key] = entry
+        return entry[1]
+    
+    def _store(self, key, result):
+        ttl = self.negative_ttl if result[1] else self.ttl
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        self.cache.pop(key, None)
+        self.cache[key] = (monotonic() + ttl, result)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+    
+    def close(self):
+        for _ in self.threads:
+            self.lookups.put(None)
+        self.threads = []
+        if self.reader:
+            self.reader.close()
+            self.writer.close()
 
-class TCP(object):
-    """TCP server implementation."""
+class Backend(object):
+    """Server of a ``BackendPool``, tracking its connections and health in
+    the pool's shared ``values``."""
     
-    def __init__(self, hostname='127.0.0.1', port=8899, backlog=100):
-        self.hostname = hostname
-        self.port = port
-        self.backlog = backlog
+    # offsets of values of a backend: active connections, consecutive
+    # failures, time until which backend is ejected, and its current
+    # weight in weighted round-robin
+    ACTIVE = 0
+    FAILURES = 1
+    EJECTED_UNTIL = 2
+    CURRENT_WEIGHT = 3
+    SIZE = 4
     
-    def handle(self, client):
-        raise NotImplementedError()
+    def __init__(self, host, port, pool, offset, weight=1):
+        self.addr = (host, port)
+        self.pool = pool
+        self.offset = offset
+        self.weight = weight
     
-    def run(self):
-        try:
-            logger.info('Starting server on port %d' % self.port)
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.socket.bind((self.hostname, self.port))
-            self.socket.listen(self.backlog)
-            while True:
-                conn, addr = self.socket.accept()
-                logger.debug('Accepted connection %r at address %r' % (conn, addr))
-                client = Client(conn, addr)
-                self.handle(client)
-        except Exception as e:
-            logger.exception('Exception while running the server %r' % e)
-        finally:
-            logger.info('Closing server socket')
-            self.socket.close()
+    def _value(index):
+        def get(self):
+            return self.pool.values[self.offset + index]
+        
+        def set(self, value):
+            self.pool.values[self.offset + index] = value
+        return property(get, set)
+    
+    active = _value(ACTIVE)
+    failures = _value(FAILURES)
+    ejected_until = _value(EJECTED_UNTIL)
+    current_weight = _value(CURRENT_WEIGHT)
+    del _value
+    
+    def is_available(self, now):
+        return self.ejected_until <= now
 
-class HTTP(TCP):
-    """HTTP proxy server implementation.
+def parse_addresses(spec):
+    """Parses ``host:port[:weight][,host:port[:weight]]`` into a list of
+    (host, port, weight)."""
+    addresses = []
+    for address in bytes_(spec).split(b','):
+        parts = address.strip().split(b':')
+        if len(parts) not in (2, 3) or not parts[0] or not all(part.isdigit() for part in parts[1:]) or \
+        (len(parts) == 3 and int(parts[2]) < 1):
+            raise ValueError('Invalid address %r' % text_(address))
+        addresses.append((text_(parts[0]), int(parts[1]), int(parts[2]) if len(parts) == 3 else 1))
+    return addresses
+
+class BackendPool(object):
+    """Servers requests are balanced across, backends of a reverse proxy
+    route or parent proxies.
+    
+    ``addresses`` are (host, port) or (host, port, weight).  ``balance``
+    is one of ``round-robin`` (smooth weighted), ``least-connections``
+    (relative to weight) or ``consistent-hash``, the latter mapping the key
+    requests are selected by onto a hash ring so that a key keeps to a
+    backend while it is available.
+    
+    Health is tracked passively with a circuit breaker per backend: one
+    failing ``max_failures`` times in a row is ejected (open) for
+    ``eject_timeout`` seconds, after which a single request is let through
+    (half-open).  Its success closes the breaker again, its failure ejects
+    the backend for another ``eject_timeout`` seconds.
     
-    Spawns new process to proxy accepted client connection.
+    Like ``Metrics``, balancing and health state is kept in a shared
+    memory array created before processes fork and updated under a lock,
+    so that it holds across workers and processes of the process engine.
     """
     
+    ROUND_ROBIN = 'round-robin'
+    LEAST_CONNECTIONS = 'least-connections'
+    CONSISTENT_HASH = 'consistent-hash'
+    BALANCERS = (ROUND_ROBIN, LEAST_CONNECTIONS, CONSISTENT_HASH)
+    # points on the hash ring per unit of backend weight
+    REPLICAS = 100
+    
+    # values layout: rotation of least loaded backends, ejections, then
+    # the values of every backend
+    NEXT = 0
+    EJECTIONS = 1
+    BACKENDS = 2
+    
+    def __init__(self, addresses, balance=ROUND_ROBIN, max_failures=3, eject_timeout=30):
+        if balance not in self.BALANCERS:
+            raise ValueError('Unknown balancing method %r' % balance)
+        self.values = multiprocessing.RawArray('d', self.BACKENDS + len(addresses) * Backend.SIZE)
+        self.lock = multiprocessing.Lock()
+        self.backends = [Backend(address[0], address[1], self, self.BACKENDS + n * Backend.SIZE, *address[2:])
+                         for n, address in enumerate(addresses)]
+        self.balance = balance
+        self.max_failures = max_failures
+        self.eject_timeout = eject_timeout
+        self.ring = []
+        if balance == self.CONSISTENT_HASH:
+            self.ring = sorted((self._hash(b'%s:%d-%d' % (bytes_(backend.addr[0]), backend.addr[1], i)), n)
+                               for n, backend in enumerate(self.backends)
+                               for i in range(self.REPLICAS * backend.weight))
+    
+    @property
+    def ejections(self):
+        return int(self.values[self.EJECTIONS])
+    
+    def select(self, key=None, exclude=()):
+        """Returns an available backend, counted as active until released,
+        or None if all are ejected or excluded."""
+        now = monotonic()
+        with self.lock:
+            candidates = [backend for backend in self.backends
+                          if backend.is_available(now) and backend not in exclude]
+            if not candidates:
+                return None
+            
+            if self.balance == self.CONSISTENT_HASH:
+                start = bisect.bisect(self.ring, (self._hash(bytes_(key or b'')),))
+                for i in range(len(self.ring)):
+                    backend = self.backends[self.ring[(start + i) % len(self.ring)][1]]
+                    if backend in candidates:
+                        break
+            elif self.balance == self.LEAST_CONNECTIONS:
+                # rotating candidates spreads ties between least loaded ones
+                self.values[self.NEXT] += 1
+                offset = int(self.values[self.NEXT]) % len(candidates)
+                candidates = candidates[offset:] + candidates[:offset]
+                backend = min(candidates, key=lambda backend: backend.active / float(backend.weight))
+            else:
+                for candidate in candidates:
+                    candidate.current_weight += candidate.weight
+                backend = max(candidates, key=lambda backend: backend.current_weight)
+                backend.current_weight -= sum(candidate.weight for candidate in candidates)
+            
+            # an ejected backend is probed by this request alone
+            if backend.ejected_until:
+                logger.debug('probing backend %s:%s', *backend.addr)
+                backend.ejected_until = now + self.eject_timeout
+            backend.active += 1
+        return backend
+    
+    def release(self, backend):
+        with self.lock:
+            backend.active -= 1
+    
+    def succeeded(self, backend):
+        if backend.failures or backend.ejected_until:
+            with self.lock:
+                backend.failures = 0
+                backend.ejected_until = 0
+    
+    def failed(self, backend):
+        with self.lock:
+            backend.failures += 1
+            if backend.failures < self.max_failures and not backend.ejected_until:
+                return
+            backend.ejected_until = monotonic() + self.eject_timeout
+            backend.failures = 0
+            self.values[self.EJECTIONS] += 1
+        logger.warning('Backend %s:%s failed, ejecting for %ss' % (
+            backend.addr[0], backend.addr[1], self.eject_timeout))
+    
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+class Router(object):
+    """Maps requests of a reverse proxy onto backend pools by Host and
+    path prefix, routes for a host preferred over those for any host."""
+    
+    def __init__(self):
+        # (host or None, path prefix, pool)
+        self.routes = []
+    
+    def add(self, host, prefix, pool):
+        self.routes.append((host.lower() if host else None, prefix, pool))
+        self.routes.sort(key=lambda route: (route[0] is None, -len(route[1])))
+    
+    @staticmethod
+    def parse(spec):
+        """Parses a ``[host][/prefix]=host:port[:weight][,...]`` route into
+        (host or None, path prefix, backend addresses)."""
+        match, _, backends = bytes_(spec).partition(b'=')
+        host, slash, prefix = match.partition(b'/')
+        return host or None, slash + prefix or b'/', parse_addresses(backends)
+    
+    def route(self, request):
+        """Returns the pool serving request or None."""
+        if request.method == b"CONNECT":
+            return None
+        host = request.address()[0]
+        host = host.lower() if host else None
+        path = request.url.path or b'/'
+        for route_host, prefix, pool in self.routes:
+            if route_host in (None, host) and path.startswith(prefix):
+                return pool
+        return None
+
+# response headers not stored along with cached responses
+UNCACHED_HEADERS = (b'connection', b'keep-alive', b'proxy-connection', b'transfer-encoding', b'te',
+                    b'trailer', b'upgrade', b'content-length', b'age')
+
+# response headers sent along with 304 responses built from cache
+NOT_MODIFIED_HEADERS = (b'cache-control', b'content-location', b'date', b'etag', b'expires',
+                        b'last-modified', b'vary')
+
+
+def http_date(value):
+    """Parses an HTTP date into seconds since epoch, None if invalid."""
+    parsed = email.utils.parsedate_tz(text_(value, errors='replace'))
+    return email.utils.mktime_tz(parsed) if parsed else None
+
+
+def cache_control(header_list):
+    """Returns Cache-Control directives within headers as a dict."""
+    directives = dict()
+    for key, value in header_list:
+        if key.lower() == b'cache-control':
+            for directive in value.split(b','):
+                name, _, argument = directive.strip().partition(b'=')
+                directives[name.lower()] = argument.strip(b'"')
+    return directives
+
+
+class CacheEntry(object):
+    """Cached response, body stored decoded.
+    
+    Body is held in memory as ``body``, in the file ``path`` of the disk
+    tier, or both.
+    """
+    
+    def __init__(self, response, body, length=None):
+        self.version = response.version
+        self.code = response.code
+        self.reason = response.reason
+        self.body = body
+        self.length = len(body) if body is not None else length
+        self.path = None
+        self.update(response)
+    
+    def update(self, response):
+        """Updates headers and freshness from a response validating this one."""
+        headers = [(k, v) for k, v in response.header_list if k.lower() not in UNCACHED_HEADERS]
+        if response.code == b'304':
+            updated = set(k.lower() for k, v in headers)
+            headers += [(k, v) for k, v in self.headers if k.lower() not in updated]
+        self.headers = headers
+        self.etag = self.header(b'etag')
+        self.last_modified = self.header(b'last-modified')
+        # size in memory along with the body
+        self.size = self.length + sum(len(k) + len(v) for k, v in headers)
+        
+        # freshness follows headers merged with those of a 304
+        directives = cache_control(headers)
+        self.must_revalidate = b'no-cache' in directives
+        self.stored_at = monotonic()
+        age = response.headers.get(b'age', (None, b''))[1]
+        self.initial_age = int(age) if age.isdigit() else 0
+        self.lifetime = self._lifetime(directives)
+    
+    def header(self, name):
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return None
+    
+    def age(self):
+        return int(monotonic() - self.stored_at) + self.initial_age
+    
+    def is_fresh(self, max_age=None):
+        if self.must_revalidate:
+            return False
+        age = self.age()
+        return age < self.lifetime and (max_age is None or age <= max_age)
+    
+    def record(self):
+        """Returns entry without its body as a JSON serializable dict."""
+        return {
+            'version': text_(self.version, 'latin-1'),
+            'code': text_(self.code, 'latin-1'),
+            'reason': text_(self.reason, 'latin-1'),
+            'headers': [[text_(k, 'latin-1'), text_(v, 'latin-1')] for k, v in self.headers],
+            'length': self.length,
+            'path': self.path,
+            'must_revalidate': self.must_revalidate,
+            'lifetime': self.lifetime,
+            # age is carried over restarts by wall clock time
+            'age': self.age(),
+            'saved_at': time.time(),
+        }
+    
+    @classmethod
+    def from_record(cls, record):
+        entry = cls.__new__(cls)
+        entry.version = bytes_(record['version'], 'latin-1')
+        entry.code = bytes_(record['code'], 'latin-1')
+        entry.reason = bytes_(record['reason'], 'latin-1')
+        entry.headers = [(bytes_(k, 'latin-1'), bytes_(v, 'latin-1')) for k, v in record['headers']]
+        entry.etag = entry.header(b'etag')
+        entry.last_modified = entry.header(b'last-modified')
+        entry.body = None
+        entry.length = record['length']
+        entry.path = record['path']
+        entry.size = entry.length + sum(len(k) + len(v) for k, v in entry.headers)
+        entry.must_revalidate = record['must_revalidate']
+        entry.lifetime = record['lifetime']
+        entry.stored_at = monotonic()
+        entry.initial_age = record['age'] + max(int(time.time() - record['saved_at']), 0)
+        return entry
+    
+    def _lifetime(self, directives):
+        for directive in (b's-maxage', b'max-age'):
+            if directive in directives:
+                return int(directives[directive]) if directives[directive].isdigit() else 0
+        if self.header(b'expires') is not None:
+            expires = http_date(self.header(b'expires'))
+            date = http_date(self.header(b'date') or b'') or time.time()
+            return max(expires - date, 0) if expires else 0
+        return 0
+
+class DiskCache(object):
+    """Disk tier of ``ResponseCache``, keeping bodies in files below ``directory``.
+    
+    Bodies and the index of cached entries are written to temporary files
+    renamed into place once complete.  Files aren't synced to disk, which
+    would stall the event loop; after a crash entries whose body is missing
+    or isn't of its recorded length are dropped, and files missing from
+    the index are removed when the index is loaded.  Cached bodies are read
+    through ``mmap``, so that they're sent to clients straight from the
+    page cache.
+    
+    The directory is locked by the process using it, other processes
+    (e.g. further workers) run without the disk tier.
+    """
+    
+    INDEX = 'index'
+    LOCK = 'lock'
+    
+    def __init__(self, directory, max_size=1024 * 1024 * 1024, max_object_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_object_size = max_object_size
+        # bytes of bodies stored
+        self.size = 0
+        self.lock = None
+    
+    def load(self):
+        """Locks directory and returns records of the saved index, None
+        if the directory is locked by another process."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.lock = open(os.path.join(self.directory, self.LOCK), 'a')
+        if fcntl:
+            try:
+                fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except EnvironmentError:
+                logger.warning('Cache directory %s is in use, disk cache disabled' % self.directory)
+                self.lock.close()
+                self.lock = None
+                return None
+        
+        try:
+            with open(os.path.join(self.directory, self.INDEX)) as f:
+                records = json.load(f)
+        except (EnvironmentError, ValueError):
+            records = []
+        
+        names = set(os.listdir(self.directory))
+        records = [record for record in records if self.size_of(record['entry']['path']) == record['entry']['length']]
+        for name in names - set(record['entry']['path'] for record in records) - set([self.INDEX, self.LOCK]):
+            self.remove(name)
+        logger.debug('loaded %d cached responses from %s', len(records), self.directory)
+        return records
+    
+    def save(self, records):
+        self.write(self.INDEX, bytes_(json.dumps(records)))
+    
+    def create(self):
+        """Returns a new temporary file within directory."""
+        return tempfile.NamedTemporaryFile(dir=self.directory, prefix='.tmp', delete=False)
+    
+    def commit(self, f, name):
+        """Renames temporary file f, once written, into place as name."""
+        f.close()
+        os.rename(f.name, os.path.join(self.directory, name))
+    
+    def discard(self, f):
+        f.close()
+        self.remove(os.path.basename(f.name))
+    
+    def write(self, name, data):
+        f = self.create()
+        try:
+            f.write(data)
+            self.commit(f, name)
+        except EnvironmentError:
+            self.discard(f)
+            raise
+    
+    def read(self, name):
+        """Returns a memoryview of the contents of file name."""
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b'')
+            # mapping stays valid once file is closed or replaced
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.directory, name))
+    
+    def size_of(self, name):
+        try:
+            return os.path.getsize(os.path.join(self.directory, name))
+        except OSError:
+            return None
+    
+    def remove(self, name):
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except OSError:
+            pass
+    
+    def close(self):
+        if self.lock:
+            self.lock.close()
+            self.lock = None
+
+class ResponseCache(object):
+    """In-memory cache of responses to GET requests shared by proxies.
+    
+    Responses are cached as permitted by their ``Cache-Control``,
+    ``Expires`` and ``Vary`` headers, one entry per variant.  Stale entries
+    carrying an ``ETag`` or ``Last-Modified`` validator are revalidated with
+    the server by conditional requests.  Entries are evicted in LRU order
+    once their total size exceeds ``max_size`` bytes, responses larger than
+    ``max_object_size`` bytes aren't cached.
+    
+    With a ``DiskCache`` tier, responses are also stored on disk, where
+    larger ones up to ``disk.max_object_size`` bytes are kept only.  Entries
+    are evicted from disk in LRU order once their bodies exceed
+    ``disk.max_size`` bytes, small ones read back from disk are kept in
+    memory again.  The disk index is loaded on first use and saved every
+    ``INDEX_SAVE_INTERVAL`` seconds at most, changes made since are saved
+    by ``flush`` or ``close``, so that entries survive restarts.
+    
+    Concurrent requests for an url being fetched wait for its response
+    rather than fetching it as well, for ``collapse_timeout`` seconds at
+    most (see ``join``).
+    """
+    
+    CACHEABLE_CODES = (b'200', b'203', b'300', b'301', b'404', b'410')
+    INDEX_SAVE_INTERVAL = 5
+    
+    def __init__(self, max_size=64 * 1024 * 1024, max_object_size=1024 * 1024, disk=None, collapse_timeout=5):
+        self.max_size = max_size
+        self.max_object_size = max_object_size
+        self.size = 0
+        # (key, vary values) -> CacheEntry in LRU order
+        self.entries = collections.OrderedDict()
+        # key -> names of request headers responses vary on
+        self.vary = dict()
+        # key -> set of (key, vary values) cached for it
+        self.variants = dict()
+        
+        self.disk = disk
+        self.loaded = disk is None
+        # index changes not yet saved to disk
+        self.dirty = False
+        # first change is saved right away
+        self.saved_at = None
+        
+        self.collapse_timeout = collapse_timeout
+        # key -> callbacks of requests waiting for the response being fetched
+        self.fetching = dict()
+        
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.stores = 0
+        self.evictions = 0
+        self.collapsed = 0
+    
+    @staticmethod
+    def key(request):
+        host, port = request.address()
+        return request.method, host, port, request.build_url()
+    
+    @staticmethod
+    def is_request_cacheable(request):
+        return request.method == b"GET" and \
+            b'authorization' not in request.headers and \
+            b'upgrade' not in request.headers and \
+            not request.is_body_expected() and \
+            b'no-store' not in cache_control(request.header_list)
+    
+    def is_cacheable(self, request, response):
+        if not self.is_request_cacheable(request) or response.code not in self.CACHEABLE_CODES:
+            return False
+        if b'content-length' not in response.headers and not response.is_chunked_encoded():
+            return False
+        if b'set-cookie' in response.headers or \
+        response.headers.get(b'vary', (None, b''))[1].strip() == b'*':
+            return False
+        directives = cache_control(response.header_list)
+        if b'no-store' in directives or b'private' in directives:
+            return False
+        return b'max-age' in directives or b's-maxage' in directives or b'expires' in response.headers or \
+            b'etag' in response.headers or b'last-modified' in response.headers
+    
+    def lookup(self, request):
+        """Returns (entry, fresh) for request.  Entry is None if there is
+        none usable, stale entries are only returned if they can be
+        revalidated."""
+        if not self.is_request_cacheable(request):
+            return None, False
+        if not self.loaded:
+            self._load()
+        
+        variant = self._variant(self.key(request), request)
+        entry = self.entries.pop(variant, None)
+        if entry is not None and entry.body is None and not self.disk.exists(entry.path):
+            self._remove(variant, entry)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None, False
+        # re-inserted as the most recently used
+        self.entries[variant] = entry
+        
+        directives = cache_control(request.header_list)
+        max_age = directives.get(b'max-age')
+        fresh = b'no-cache' not in directives and \
+            b'no-cache' not in request.headers.get(b'pragma', (None, b''))[1].lower() and \
+            entry.is_fresh(int(max_age) if max_age and max_age.isdigit() else None)
+        if fresh:
+            self.hits += 1
+            return entry, True
+        if entry.etag or entry.last_modified:
+            self.revalidations += 1
+            return entry, False
+        self.misses += 1
+        return None, False
+    
+    def collect(self, body, data):
+        """Appends data to body of a response being cached, returns body or
+        None once too large to be cached.  Body starts as a ``bytearray``
+        and moves to a temporary file of the disk tier beyond
+        ``max_object_size`` bytes."""
+        if isinstance(body, bytearray):
+            size = len(body) + len(data)
+            if size <= self.max_object_size:
+                body += data
+                return body
+            if not self.disk or size > self.disk.max_object_size:
+                return None
+            data, body = body + data, None
+        elif body.tell() + len(data) > self.disk.max_object_size:
+            self.disk.discard(body)
+            return None
+        
+        try:
+            body = body or self.disk.create()
+            body.write(data)
+        except EnvironmentError as e:
+            logger.warning('Failed writing cached response to disk: %r' % e)
+            if body:
+                self.disk.discard(body)
+            return None
+        return body
+    
+    def discard(self, body):
+        """Discards body collected for a response which won't be cached."""
+        if not isinstance(body, (bytes, bytearray)):
+            self.disk.discard(body)
+    
+    def store(self, request, response, body):
+        """Caches response to request, if permitted.  Body is either bytes
+        or as returned by ``collect``."""
+        if not self.loaded:
+            self._load()
+        in_memory = isinstance(body, (bytes, bytearray))
+        length = len(body) if in_memory else body.tell()
+        on_disk = self.disk is not None and length <= self.disk.max_object_size
+        if not self.is_cacheable(request, response) or (length > self.max_object_size and not on_disk):
+            return self.discard(body)
+        
+        key = self.key(request)
+        names = tuple(name.strip().lower() for name in
+                      response.headers.get(b'vary', (None, b''))[1].split(b',') if name.strip())
+        variant = (key, self._vary_values(request, names))
+        entry = CacheEntry(response, bytes(body) if in_memory and length <= self.max_object_size else None, length)
+        if entry.size - length > self.max_object_size:
+            return self.discard(body)
+        self._remove(variant)
+        
+        if on_disk:
+            entry.path = hashlib.sha1(bytes_(repr(variant))).hexdigest()
+            try:
+                if in_memory:
+                    self.disk.write(entry.path, body)
+                else:
+                    self.disk.commit(body, entry.path)
+                self.disk.size += length
+                self.dirty = True
+            except EnvironmentError as e:
+                logger.warning('Failed writing cached response to disk: %r' % e)
+                self.discard(body)
+                entry.path = None
+        if entry.body is None and entry.path is None:
+            return
+        
+        self.vary[key] = names
+        self.entries[variant] = entry
+        self.variants.setdefault(key, set()).add(variant)
+        if entry.body is not None:
+            self.size += entry.size
+        self.stores += 1
+        
+        self._evict()
+        self._save()
+    
+    def join(self, request, callback):
+        """Collapses request with an identical one being fetched, returns
+        True if so and ``callback`` is called once its response is complete.
+        Otherwise caller is expected to fetch the response, then call
+        ``complete``."""
+        key = self.key(request)
+        if key in self.fetching:
+            self.fetching[key].append(callback)
+            self.collapsed += 1
+            return True
+        self.fetching[key] = []
+        return False
+    
+    def leave(self, request, callback):
+        """Stops waiting for the response an identical request is fetching."""
+        callbacks = self.fetching.get(self.key(request), [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+    
+    def complete(self, request):
+        """Wakes requests waiting for the response to request."""
+        for callback in self.fetching.pop(self.key(request), []):
+            callback()
+    
+    def refresh(self, entry, response):
+        """Updates entry from the 304 response revalidating it."""
+        if entry.body is not None:
+            self.size -= entry.size
+        entry.update(response)
+        if entry.body is not None:
+            self.size += entry.size
+        if entry.path:
+            self.dirty = True
+            self._save()
+    
+    def invalidate(self, request):
+        """Drops every variant cached for the url of an unsafe request."""
+        if not self.loaded:
+            self._load()
+        host, port = request.address()
+        for variant in list(self.variants.get((b"GET", host, port, request.build_url()), ())):
+            self._remove(variant)
+        self._save()
+    
+    def build_response(self, entry, request):
+        """Returns (head, body) of a response to request built from entry,
+        which is a 304 if request is conditional and entry hasn't been
+        modified since.  Body kept on disk only is a memoryview of its
+        mapped file."""
+        if self._is_not_modified(entry, request):
+            line = b' '.join([entry.version, b'304', b'Not Modified'])
+            headers = [(k, v) for k, v in entry.headers if k.lower() in NOT_MODIFIED_HEADERS]
+            body = b''
+        else:
+            line = b' '.join([entry.version, entry.code, entry.reason])
+            headers = entry.headers + [(b'Content-Length', bytes_(str(entry.length)))]
+            body = self._body(entry)
+        headers.append((b'Age', bytes_(str(entry.age()))))
+        return line + CRLF + b''.join(k + b': ' + v + CRLF for k, v in headers) + CRLF, body
+    
+    def flush(self):
+        """Saves index of the disk tier if changed and not saved for
+        ``INDEX_SAVE_INTERVAL`` seconds, to be called periodically."""
+        self._save()
+    
+    def close(self):
+        """Saves index of the disk tier."""
+        if self.disk and self.loaded:
+            self._save(force=True)
+            self.disk.close()
+    
+    @staticmethod
+    def _is_not_modified(entry, request):
+        if entry.code != b'200':
+            return False
+        if b'if-none-match' in request.headers:
+            tags = [tag.strip() for tag in request.headers[b'if-none-match'][1].split(b',')]
+            if b'*' in tags:
+                return True
+            # weak comparison
+            strip = lambda tag: tag[2:] if tag.startswith(b'W/') else tag
+            return entry.etag is not None and strip(entry.etag) in [strip(tag) for tag in tags]
+        if b'if-modified-since' in request.headers and entry.last_modified:
+            since = http_date(request.headers[b'if-modified-since'][1])
+            modified = http_date(entry.last_modified)
+            return since is not None and modified is not None and modified <= since
+        return False
+    
+    def _variant(self, key, request):
+        return key, self._vary_values(request, self.vary.get(key, ()))
+    
+    @staticmethod
+    def _vary_values(request, names):
+        return tuple(request.headers.get(name, (None, None))[1] for name in names)
+    
+    def _body(self, entry):
+        if entry.body is not None:
+            return entry.body
+        body = self.disk.read(entry.path)
+        # small bodies read back from disk are kept in memory again
+        if entry.length <= self.max_object_size:
+            entry.body = body.tobytes()
+            self.size += entry.size
+            self._evict()
+        return body
+    
+    def _evict(self):
+        """Evicts least recently used entries beyond size of either tier.
+        Entries also kept on disk only leave memory."""
+        for variant, entry in list(self.entries.items()):
+            if self.size <= self.max_size:
+                break
+            if entry.body is None:
+                continue
+            if entry.path:
+                self.size -= entry.size
+                entry.body = None
+            else:
+                self._remove(variant, entry)
+            self.evictions += 1
+        
+        if not self.disk:
+            return
+        for variant, entry in list(self.entries.items()):
+            if self.disk.size <= self.disk.max_size:
+                break
+            if entry.path is None:
+                continue
+            if entry.body is not None:
+                self.disk.remove(entry.path)
+                self.disk.size -= entry.length
+                entry.path = None
+                self.dirty = True
+            else:
+                self._remove(variant, entry)
+            self.evictions += 1
+    
+    def _remove(self, variant, entry=None):
+        entry = self.entries.pop(variant, entry)
+        if entry is None:
+            return
+        if entry.body is not None:
+            self.size -= entry.size
+        if entry.path:
+            self.disk.remove(entry.path)
+            self.disk.size -= entry.length
+            self.dirty = True
+        variants = self.variants.get(variant[0])
+        if variants is not None:
+            variants.discard(variant)
+            if not variants:
+                del self.variants[variant[0]]
+                self.vary.pop(variant[0], None)
+    
+    def _load(self):
+        """Loads index of the disk tier, disabling the tier if unusable."""
+        self.loaded = True
+        try:
+            records = self.disk.load()
+        except EnvironmentError as e:
+            logger.warning('Failed loading disk cache %s: %r' % (self.disk.directory, e))
+            records = None
+        if records is None:
+            self.disk = None
+            return
+        
+        # records are saved in LRU order
+        for record in records:
+            method, host, port, url = record['key']
+            key = (bytes_(method, 'latin-1'), bytes_(host, 'latin-1'), port, bytes_(url, 'latin-1'))
+            values = tuple(value if value is None else bytes_(value, 'latin-1') for value in record['values'])
+            variant = (key, values)
+            self.vary[key] = tuple(bytes_(name, 'latin-1') for name in record['vary'])
+            self.entries[variant] = CacheEntry.from_record(record['entry'])
+            self.variants.setdefault(key, set()).add(variant)
+            self.disk.size += record['entry']['length']
+        self._evict()
+    
+    def _save(self, force=False):
+        if not self.disk or not self.dirty:
+            return
+        if not force and self.saved_at is not None and \
+        monotonic() - self.saved_at < self.INDEX_SAVE_INTERVAL:
+            return
+        
+        records = []
+        for (key, values), entry in self.entries.items():
+            if entry.path is None:
+                continue
+            method, host, port, url = key
+            records.append({
+                'key': [text_(method, 'latin-1'), text_(host, 'latin-1'), port, text_(url, 'latin-1')],
+                'values': [value if value is None else text_(value, 'latin-1') for value in values],
+                'vary': [text_(name, 'latin-1') for name in self.vary.get(key, ())],
+                'entry': entry.record(),
+            })
+        try:
+            self.disk.save(records)
+        except EnvironmentError as e:
+            logger.warning('Failed saving disk cache index: %r' % e)
+        self.dirty = False
+        self.saved_at = monotonic()
+
+class GzipEncoder(object):
+    """Compresses a response body as it is received, into chunks of
+    chunked transfer encoding.
+    
+    Data written before ``start`` is held back uncompressed, so that
+    compression may still be decided against once response head is
+    complete.
+    """
+    
+    def __init__(self, level=6):
+        self.level = level
+        self.compressor = None
+        # data held back or compressed, not read yet
+        self.pending = []
+    
+    def write(self, data):
+        if self.compressor is None:
+            self.pending.append(bytes(data))
+            return
+        data = self.compressor.compress(data)
+        if data:
+            self.pending.append(data)
+    
+    def start(self):
+        self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        pending, self.pending = self.pending, []
+        for data in pending:
+            self.write(data)
+    
+    def is_started(self):
+        return self.compressor is not None
+    
+    def read(self, final=False):
+        """Returns compressed data as a chunk, with the last chunk if final."""
+        if final:
+            self.pending.append(self.compressor.flush())
+        data, self.pending = b''.join(self.pending), []
+        chunk = b'%x' % len(data) + CRLF + data + CRLF if data else b''
+        return chunk + b'0' + CRLF * 2 if final else chunk
+
+class Compression(object):
+    """Settings of on-the-fly gzip compression of responses.
+    
+    Responses of ``types`` are compressed for HTTP/1.1 clients accepting
+    gzip if not already encoded and, if their length is known, of at
+    least ``min_length`` bytes.  Responses are sent with chunked transfer
+    encoding, so only those framed by content-length or chunked encoding
+    are compressed.
+    """
+    
+    TYPES = (b'text/html', b'text/plain', b'text/css', b'text/xml', b'text/javascript', b'text/csv',
+             b'application/javascript', b'application/json', b'application/xml', b'image/svg+xml')
+    
+    def __init__(self, types=TYPES, min_length=1024, level=6):
+        self.types = set(t.lower() for t in types)
+        self.min_length = min_length
+        self.level = level
+        self.compressed = 0
+    
+    def accepts(self, request):
+        """True if response to request may be compressed."""
+        if request.version != b'HTTP/1.1' or request.method == b"HEAD":
+            return False
+        for coding in request.headers.get(b'accept-encoding', (None, b''))[1].split(b','):
+            name, _, params = coding.partition(b';')
+            if name.strip().lower() in (b'gzip', b'x-gzip'):
+                q = params.strip().lower()
+                try:
+                    return not q.startswith(b'q=') or float(q[2:]) > 0
+                except ValueError:
+                    return False
+        return False
+    
+    def is_compressible(self, response):
+        if response.code != b'200' or b'content-encoding' in response.headers:
+            return False
+        if b'no-transform' in cache_control(response.header_list):
+            return False
+        content_type = response.headers.get(b'content-type', (None, b''))[1].split(b';')[0].strip().lower()
+        if content_type not in self.types:
+            return False
+        if b'content-length' in response.headers:
+            return int(response.headers[b'content-length'][1]) >= self.min_length
+        return response.is_chunked_encoded()
+    
+    def encoder(self):
+        return GzipEncoder(self.level)
+
+# os.splice is available on Linux with Python 3.10+
+HAS_SPLICE = hasattr(os, 'splice')
+
+class Splicer(object):
+    """Relays data from one socket to another within the kernel.
+    
+    Data read from ``src`` is spliced into a pipe and from the pipe
+    into ``dst``, it is never copied into user space.  ``broken`` is set
+    once ``dst`` has been closed by its peer.
+    """
+    
+    def __init__(self, src, dst, size=65536):
+        self.src = src
+        self.dst = dst
+        self.size = size
+        self.pending = 0
+        self.eof = False
+        self.broken = False
+        self.r, self.w = os.pipe()
+    
+    def fill(self):
+        """Moves available data from source socket into the pipe."""
+        try:
+            size = os.splice(self.src.fileno(), self.w, self.size - self.pending,
+                             flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logger.debug('Exception while splicing from %r with reason %r', self.src, e)
+            size = 0
+        if size == 0:
+            self.eof = True
+        self.pending += size
+    
+    def drain(self):
+        """Moves data from the pipe into destination socket."""
+        try:
+            size = os.splice(self.r, self.dst.fileno(), self.pending,
+                             flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (BrokenPipeError, ConnectionResetError) as e:
+            logger.debug('Exception while splicing to %r with reason %r', self.dst, e)
+            self.broken = True
+            return
+        self.pending -= size
+    
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+class ProxyError(Exception):
+    pass
+
+class ProxyConnectionFailed(ProxyError):
+    
+    def __init__(self, host, port, reason):
+        self.host = host
+        self.port = port
+        self.reason = reason
+    
+    def __str__(self):
+        return '<%s - %s:%s - %s>' % (self.__class__.__name__, self.host, self.port, self.reason)
+
+class ProxyConnectionTimeout(ProxyConnectionFailed):
+    pass
+
+class ProxyNoRoute(ProxyConnectionFailed):
+    """No reverse proxy route matches the request."""
+    pass
+
+class ProxyNoBackend(ProxyConnectionFailed):
+    """All backends of the route are ejected."""
+    pass
+
+class Proxy(multiprocessing.Process):
+    """HTTP proxy implementation.
+    
+    Accepts connection object and act as a proxy between client and server.
+    When a ``ConnectionPool`` is given, connections to servers are kept
+    alive and reused across requests.  Client connections are kept alive
+    for upto ``max_requests`` requests, pipelined requests are served in
+    order once the preceding response is complete.
+    
+    Once a tunnel is established and pending data flushed, data is relayed
+    within the kernel using ``os.splice`` when ``splice`` is enabled and
+    supported, otherwise it is relayed as soon as it is received.
+    
+    Server hostnames are looked up through ``resolver`` when given, within
+    an event loop without blocking it.  Connections to servers are made
+    without blocking, failing with 504 after ``connect_timeout`` seconds.
+    
+    With a ``ResponseCache``, fresh cached responses are served without
+    connecting to the server and stale ones are revalidated.  Within an
+    event loop, a request for an url being fetched by another proxy waits
+    for that response to be cached instead.
+    
+    Either side isn't read from while data pending for the other exceeds
+    ``high_watermark`` bytes, until it drains down to ``low_watermark``
+    bytes, so that a slow reader bounds buffered data.
+    
+    Connection is closed once no data is transferred for ``idle_timeout``
+    seconds or after ``total_timeout`` seconds (0 for no limit), and
+    responded with 504 if server doesn't respond to a request within
+    ``first_byte_timeout`` seconds of it being complete.  Timeouts are tracked as deadlines on
+    the monotonic clock, see ``_get_timeout``.
+    
+    Requests are recorded in ``metrics`` when given, and logged to
+    ``access_log`` when given instead of through ``logging``.
+    
+    With ``Compression`` settings, eligible responses are gzip compressed
+    as they are received for clients accepting it.
+    
+    With a ``Router``, requests are served as a reverse proxy: they are
+    sent to a backend of the pool their Host and path are routed to.
+    Otherwise with a pool of ``parents``, requests are chained through a
+    parent proxy, CONNECT requests included.  Idempotent requests without
+    a body are retried on another backend or parent if one can't be
+    connected to.
+    """
+    
+    def __init__(self, client, pool=None, max_requests=100, splice=HAS_SPLICE, resolver=None,
+                 connect_timeout=10, cache=None, high_watermark=256 * 1024, low_watermark=64 * 1024,
+                 first_byte_timeout=30, idle_timeout=30, total_timeout=0, metrics=None, access_log=None,
+                 compression=None, router=None, parents=None):
+        super(Proxy, self).__init__()
+        
+        self.start_time = monotonic()
+        self.last_activity = self.start_time
+        self.first_byte_timeout = first_byte_timeout
+        self.idle_timeout = idle_timeout
+        self.total_timeout = total_timeout
+        # time by which server must have responded to the current request
+        self.first_byte_deadline = None
+        
+        # timings of the current request recorded in metrics, and status
+        # code of a response sent by proxy itself
+        self.metrics = metrics
+        self.access_log = access_log
+        self.request_start = None
+        self.connect_start = None
+        self.connect_time = None
+        self.first_byte_time = None
+        self.status = None
+        # bytes sent to client recorded in metrics so far, and sent
+        # before a tunnel started relaying
+        self.sent_observed = 0
+        self.sent_before_relay = None
+        
+        self.client = client
+        self.server = None
+        self.server_reused = False
+        self.pool = pool
+        
+        self.max_requests = max_requests
+        self.requests_served = 0
+        self.client_keep_alive = False
+        self.tunnel = False
+        self.pipeline = b''
+        
+        self.splice = splice and HAS_SPLICE
+        self.relaying = False
+        self.splicers = None
+        
+        self.resolver = resolver
+        self.connect_timeout = connect_timeout
+        
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        
+        self.cache = cache
+        # stale cache entry being revalidated by the current request
+        self.revalidating = None
+        # body of the current response, collected while it may be cached
+        self.cache_body = None
+        # True while fetching a response other requests wait for
+        self.leader = False
+        # time until which request waits for an identical one, and
+        # whether the response to that one is complete
+        self.waiting_until = None
+        self.woken = False
+        # compresses the current response if client accepts it
+        self.compression = compression
+        self.encoder = None
+        # maps requests onto backends in reverse proxy mode, or parent
+        # proxies requests are chained through, backend or parent serving
+        # the current request and those that failed to
+        self.router = router
+        self.parents = parents
+        self.backend = None
+        self.failed_backends = []
+        # event loop driving this proxy, if any
+        self.loop = None
+        # result of a lookup completed off the event path
+        self.resolved = None
+        
+        self.request = HttpParser(stream=True)
+        self.response = HttpParser(HTTP_RESPONSE_PARSER, stream=True)
+        
+        self.connection_established_pkt = PROXY_CONNECTION_ESTABLISHED_PKT
+    
+    def _is_timed_out(self):
+        """Returns True once any of the timeouts has expired."""
+        now = monotonic()
+        if self.first_byte_deadline is not None and now >= self.first_byte_deadline:
+            logger.debug('server did not respond within first byte timeout, breaking')
+            if self.backend:
+                self.backend.pool.failed(self.backend)
+            self.client.queue(PROXY_GATEWAY_TIMEOUT_RESPONSE_PKT)
+            self.status = b'504'
+            self.client.flush()
+            return True
+        if self.total_timeout and now >= self.start_time + self.total_timeout:
+            logger.debug('maximum connection duration has reached, breaking')
+            return True
+        if now >= self.last_activity + self.idle_timeout:
+            logger.debug('maximum inactivity has reached, breaking')
+            return True
+        return False
+    
+    def _process_request(self, data):
+        # once a tunnel is established (https requests
+        # and upgraded connections) we don't parse the
+        # packets any further, instead just pipe incoming
+        # data from client to server
+        if self.tunnel:
+            self.server.queue(data)
+            if self.relaying:
+                self.server.flush()
+            return
+        
+        # data received while a request is being served
+        # belongs to the next pipelined request, which is
+        # processed once the current response is complete
+        if self.request.state == HTTP_PARSER_STATE_COMPLETE:
+            self.pipeline += data
+            return
+        
+        if self.request_start is None:
+            self.request_start = monotonic()
+        
+        # parse http request
+        headers_complete = self.request.state >= HTTP_PARSER_STATE_HEADERS_COMPLETE
+        self.request.parse(data)
+        if self.request.state < HTTP_PARSER_STATE_HEADERS_COMPLETE:
+            return
+        
+        # once request headers are complete we attempt to establish
+        # connection to destination server, request body if any is
+        # streamed to the server as it arrives
+        if not headers_complete:
+            logger.debug('request headers are complete')
+            
+            host, port = self.request.address()
+            self.response.method = self.request.method
+            
+            if self.compression and self.compression.accepts(self.request):
+                self.encoder = self.compression.encoder()
+                self.response.on_body = self._response_body
+            
+            if self.cache and self._process_cache():
+                return
+            self._open_server(host, port)
+            
+            # for http connect methods (https requests)
+            # data is relayed as it is once server is connected,
+            # parents are asked to connect to server first
+            if self.request.method == b"CONNECT" and not self.parents:
+                self.server.queue(bytes(self.request.buffer))
+                self.tunnel = True
+                return
+            
+            # for usual http requests, re-build request head
+            # and queue for the server with appropriate headers
+            self._queue_request()
+            # head ended within this data, keep only what follows it
+            data = data[len(data) - (self.request.received - self.request.head_size):]
+        
+        # queue body data for server, data beyond end
+        # of the request belongs to the next one
+        if self.request.state == HTTP_PARSER_STATE_COMPLETE and self.request.buffer:
+            data = data[:len(data) - len(self.request.buffer)]
+            self.pipeline += bytes(self.request.buffer)
+        if data:
+            self.server.queue(data)
+        if headers_complete and self.request.state == HTTP_PARSER_STATE_COMPLETE:
+            self._start_first_byte_deadline()
+    
+    def _open_server(self, host, port):
+        if self.router or self.parents:
+            host, port = self._select_backend()
+        if self.pool and not self.request.method == b"CONNECT":
+            self.server = self.pool.acquire(host, port)
+        if self.server:
+            self.server_reused = True
+        else:
+            self._connect_server(host, port)
+    
+    def _select_backend(self):
+        """Returns address of the backend or parent proxy selected to serve
+        request."""
+        pool = self.parents
+        if self.router:
+            pool = self.router.route(self.request)
+            if pool is None:
+                raise ProxyNoRoute(*self.request.address(), reason='no route')
+        self.backend = pool.select(self.client.addr[0], self.failed_backends)
+        if self.backend is None:
+            raise ProxyNoBackend(*self.request.address(), reason='no backend available')
+        logger.debug('routing request to %s %s:%s', 'backend' if self.router else 'parent', *self.backend.addr)
+        return self.backend.addr
+    
+    def _release_backend(self):
+        if self.backend:
+            self.backend.pool.release(self.backend)
+            self.backend = None
+    
+    def _failover(self):
+        """Retries request on another backend or parent once one failed,
+        provided nothing has been sent to or received from it but the
+        request head. Returns True if retried."""
+        backend = self.backend
+        self._release_backend()
+        backend.pool.failed(backend)
+        if self.request.method not in (b"GET", b"HEAD", b"OPTIONS", b"TRACE", b"CONNECT") or \
+        self.request.is_body_expected() or \
+        self.response.state != HTTP_PARSER_STATE_INITIALIZED:
+            return False
+        
+        self.failed_backends.append(backend)
+        while True:
+            if self.server:
+                self.server.close()
+            self.server = None
+            try:
+                self._open_server(None, None)
+            except (ProxyNoRoute, ProxyNoBackend):
+                return False
+            except ProxyConnectionFailed:
+                backend = self.backend
+                self._release_backend()
+                backend.pool.failed(backend)
+                self.failed_backends.append(backend)
+                continue
+            logger.debug('retrying request on %s:%s', *self.backend.addr)
+            self._queue_request()
+            return True
+    
+    def _process_cache(self, collapse=True):
+        """Serves request from cache if possible, returns True if served
+        or waiting for an identical request."""
+        if self.request.method in (b"POST", b"PUT", b"DELETE", b"PATCH"):
+            self.cache.invalidate(self.request)
+            return False
+        
+        entry, fresh = self.cache.lookup(self.request)
+        if entry and fresh:
+            logger.debug('serving response from cache')
+            self.pipeline += bytes(self.request.buffer)
+            self._serve_cached(entry)
+            return True
+        
+        if entry is None and collapse and self.loop and self.cache.collapse_timeout and \
+        self.cache.is_request_cacheable(self.request):
+            if self.cache.join(self.request, self._collapsed):
+                logger.debug('waiting for identical request being fetched')
+                self.pipeline += bytes(self.request.buffer)
+                del self.request.buffer[:]
+                self.waiting_until = monotonic() + self.cache.collapse_timeout
+                return True
+            self.leader = True
+        
+        if entry:
+            logger.debug('revalidating cached response')
+            self.revalidating = entry
+        if self.cache.is_request_cacheable(self.request):
+            self.cache_body = bytearray()
+            self.response.on_body = self._response_body
+        return False
+    
+    def _collapsed(self):
+        """Called once the response to the request waited for is complete."""
+        self.woken = True
+        self.loop.dispatch(self)
+    
+    def _resume_request(self):
+        """Serves request which waited for an identical one from cache,
+        fetches it from server if not cached or waited too long."""
+        if not self.woken:
+            logger.debug('identical request still being fetched, fetching directly')
+            self.cache.leave(self.request, self._collapsed)
+        self.waiting_until = None
+        self.woken = False
+        
+        if not self._process_cache(collapse=False):
+            self._open_server(*self.request.address())
+            self._queue_request()
+    
+    def _complete_fetch(self):
+        if self.leader:
+            self.leader = False
+            self.cache.complete(self.request)
+    
+    def _serve_cached(self, entry):
+        head, body = self.cache.build_response(entry, self.request)
+        self._process_response(head)
+        if body:
+            self._process_response(body)
+        if self.client_keep_alive and self.response.state == HTTP_PARSER_STATE_COMPLETE:
+            self._finish_request()
+    
+    def _response_body(self, data):
+        if self.cache_body is not None:
+            self.cache_body = self.cache.collect(self.cache_body, data)
+        if self.encoder:
+            self.encoder.write(data)
+    
+    def _discard_cache_body(self):
+        if self.cache_body is not None:
+            self.cache.discard(self.cache_body)
+            self.cache_body = None
+    
+    def _revalidated(self):
+        """Serves the revalidated cache entry once server responded with 304."""
+        entry, self.revalidating = self.revalidating, None
+        self.cache.refresh(entry, self.response)
+        self._discard_cache_body()
+        
+        if self._is_server_reusable():
+            self.pool.release(self.server)
+        elif not self.server.closed:
+            self.server.close()
+        self.server = None
+        
+        self.response = HttpParser(HTTP_RESPONSE_PARSER, stream=True, on_body=self.response.on_body)
+        self.response.method = self.request.method
+        self._serve_cached(entry)
+    
+    def _connect_server(self, host, port):
+        """Starts connecting to server, within an event loop once host has
+        been resolved off the event path. Connection attempts are driven by
+        ``_process_events``, data queued for server meanwhile is sent once
+        connected."""
+        self.server = Server(host, port)
+        self.connect_start = monotonic()
+        if self.resolver is None:
+            return self._connect(None)
+        if self.loop is None:
+            return self._connect(*self.resolver.lookup(host, port))
+        
+        result = self.resolver.resolve(host, port, self._resolved)
+        if result:
+            self._connect(*result)
+        else:
+            logger.debug('resolving server %s:%s', host, port)
+    
+    def _resolved(self, addresses, error):
+        self.resolved = (addresses, error)
+        self.loop.dispatch(self)
+    
+    def _connect(self, addresses, error=None):
+        host, port = self.server.addr
+        try:
+            if error:
+                raise error
+            logger.debug('connecting to server %s:%s', host, port)
+            self.server.start_connect(addresses, self.connect_timeout)
+        except Exception as e:
+            self.server.closed = True
+            raise ProxyConnectionFailed(host, port, repr(e))
+    
+    def _process_connect(self, w):
+        host, port = self.server.addr
+        try:
+            if not self.server.process_connect(w):
+                return
+        except socket.timeout as e:
+            self.server.closed = True
+            raise ProxyConnectionTimeout(host, port, repr(e))
+        except Exception as e:
+            self.server.closed = True
+            raise ProxyConnectionFailed(host, port, repr(e))
+        logger.debug('connected to server %s:%s', host, port)
+        self.connect_time = monotonic() - self.connect_start
+        
+        # for http connect methods (https requests)
+        # queue appropriate response for client
+        # notifying about established connection
+        if self.request.method == b"CONNECT" and not self.parents:
+            self.client.queue(self.connection_established_pkt)
+    
+    def _is_server_connected(self):
+        return self.server is not None and self.server.conn is not None and not self.server.closed
+    
+    def _build_request(self):
+        del_headers = [b'proxy-connection', b'connection', b'keep-alive']
+        add_headers = [(b'Connection', b'Keep-Alive' if self.pool else b'Close')]
+        
+        # validators of the cached response replace those of client
+        if self.revalidating:
+            del_headers += [b'if-none-match', b'if-modified-since']
+            if self.revalidating.etag:
+                add_headers.append((b'If-None-Match', self.revalidating.etag))
+            if self.revalidating.last_modified:
+                add_headers.append((b'If-Modified-Since', self.revalidating.last_modified))
+        
+        # reverse proxied requests carry the client address
+        if self.router:
+            forwarded = [v for k, v in self.request.header_list if k.lower() == b'x-forwarded-for']
+            del_headers.append(b'x-forwarded-for')
+            add_headers.append((b'X-Forwarded-For', b', '.join(forwarded + [bytes_(self.client.addr[0])])))
+        
+        # parent proxies are sent absolute urls, client credentials are ours
+        if self.parents and not self.router:
+            del_headers.append(b'proxy-authorization')
+            return self.request.build_head(del_headers=del_headers, add_headers=add_headers, absolute=True)
+        return self.request.build_head(del_headers=del_headers, add_headers=add_headers)
+    
+    def _is_retryable(self):
+        # a pooled connection may have been closed by the server while
+        # idle, in that case idempotent requests are replayed once over a
+        # new connection provided nothing has been received for them yet,
+        # request bodies are streamed and can't be replayed
+        return self.server_reused and \
+            self.request.method in (b"GET", b"HEAD", b"OPTIONS", b"TRACE") and \
+            not self.request.is_body_expected() and \
+            self.response.state == HTTP_PARSER_STATE_INITIALIZED
+    
+    def _queue_request(self):
+        """Queues request head for server, which is to respond within
+        first byte timeout once request is complete."""
+        self.server.queue(self._build_request())
+        self._start_first_byte_deadline()
+    
+    def _start_first_byte_deadline(self):
+        # uploads may take any time, server is only expected to
+        # respond once it has the whole request
+        if self.first_byte_timeout and self.request.state == HTTP_PARSER_STATE_COMPLETE and \
+        self.response.received == 0:
+            self.first_byte_deadline = monotonic() + self.first_byte_timeout
+    
+    def _retry_request(self):
+        logger.debug('pooled connection to server %s:%s was closed, retrying', *self.server.addr)
+        self.server_reused = False
+        self._connect_server(*self.server.addr)
+        self._queue_request()
+    
+    def _is_server_reusable(self):
+        return self.pool is not None and \
+            self.server is not None and \
+            not self.server.closed and \
+            not self.server.has_buffer() and \
+            not self.request.method == b"CONNECT" and \
+            self.request.state == HTTP_PARSER_STATE_COMPLETE and \
+            self.response.state == HTTP_PARSER_STATE_COMPLETE and \
+            self.response.is_keep_alive()
+    
+    def _is_client_keep_alive(self):
+        # a response arriving before request body is complete
+        # ends the client connection once it is forwarded
+        return self.requests_served + 1 < self.max_requests and \
+            self.request.state == HTTP_PARSER_STATE_COMPLETE and \
+            self.request.is_keep_alive() and \
+            (b'content-length' in self.response.headers or
+             self.response.is_chunked_encoded() or
+             not self.response.is_body_expected())
+    
+    def _build_response_head(self):
+        self.client_keep_alive = self._is_client_keep_alive()
+        del_headers = [b'proxy-connection', b'connection', b'keep-alive']
+        add_headers = [(b'Connection', b'keep-alive' if self.client_keep_alive else b'close')]
+        
+        # compressed body is sent chunked, and no longer matches a strong etag
+        if self.encoder:
+            vary = [v for k, v in self.response.header_list if k.lower() == b'vary'] + [b'Accept-Encoding']
+            del_headers += [b'content-length', b'transfer-encoding', b'vary']
+            add_headers += [(b'Transfer-Encoding', b'chunked'), (b'Content-Encoding', b'gzip'),
+                            (b'Vary', b', '.join(vary))]
+            etag = self.response.headers.get(b'etag', (None, None))[1]
+            if etag and not etag.startswith(b'W/'):
+                del_headers.append(b'etag')
+                add_headers.append((b'ETag', b'W/' + etag))
+        
+        return self.response.build_head(del_headers=del_headers, add_headers=add_headers)
+    
+    def _process_response(self, data):
+        # responses within a tunnel aren't parsed,
+        # data is queued for client as it is
+        if self.tunnel:
+            self.client.queue(data)
+            if self.relaying:
+                self.client.flush()
+            return
+        
+        headers_complete = self.response.state >= HTTP_PARSER_STATE_HEADERS_COMPLETE
+        self.response.parse(data)
+        if self.response.state < HTTP_PARSER_STATE_HEADERS_COMPLETE:
+            return
+        
+        # response headers are queued for client only once complete,
+        # hop-by-hop headers are rewritten for the client connection
+        if not headers_complete:
+            # head ended within this data, keep only what follows it
+            data = data[len(data) - (self.response.received - self.response.head_size):]
+            
+            # parents respond with errors of servers they proxy to
+            if self.backend:
+                if self.router and self.response.code in (b'502', b'503', b'504'):
+                    self.backend.pool.failed(self.backend)
+                else:
+                    self.backend.pool.succeeded(self.backend)
+            
+            if self.request.method == b"CONNECT" and self.response.code.startswith(b'2'):
+                logger.debug('parent proxy connected to server, tunneling connection')
+                self.client.queue(self.connection_established_pkt + data)
+                self.server.queue(self.pipeline)
+                self.pipeline = b''
+                self.tunnel = True
+                return
+            
+            if self.response.code == b'101':
+                logger.debug('server switched protocols, tunneling connection')
+                self.client.queue(self.response.build_head() + data)
+                self.server.queue(self.pipeline)
+                self.pipeline = b''
+                self.tunnel = True
+                return
+            
+            # interim response, final response follows
+            if self.response.code.startswith(b'1'):
+                self.client.queue(self.response.build_head())
+                self.response = HttpParser(HTTP_RESPONSE_PARSER, stream=True, on_body=self.response.on_body)
+                self.response.method = self.request.method
+                if data:
+                    self._process_response(data)
+                return
+            
+            # cached response is still valid, serve it instead
+            if self.revalidating and self.response.code == b'304':
+                return self._revalidated()
+            if self.cache_body is not None and not self.cache.is_cacheable(self.request, self.response):
+                self._discard_cache_body()
+                self._complete_fetch()
+            if self.encoder:
+                if self.compression.is_compressible(self.response):
+                    logger.debug('compressing response')
+                    self.encoder.start()
+                    self.compression.compressed += 1
+                else:
+                    self.encoder = None
+            
+            self.client.queue(self._build_response_head())
+        
+        # don't forward data beyond end of the response
+        if self.response.state == HTTP_PARSER_STATE_COMPLETE and self.response.buffer:
+            data = data[:len(data) - len(self.response.buffer)]
+        
+        # queue data for client
+        if self.encoder:
+            self.client.queue(self.encoder.read(self.response.state == HTTP_PARSER_STATE_COMPLETE))
+        else:
+            self.client.queue(data)
+        
+        if self.response.state == HTTP_PARSER_STATE_COMPLETE:
+            if self.cache_body is not None:
+                self.cache.store(self.request, self.response, self.cache_body)
+                self.cache_body = None
+            self._complete_fetch()
+    
+    def _finish_request(self):
+        """Prepares persistent client connection for the next request."""
+        self._access_log()
+        self._observe()
+        self.requests_served += 1
+        
+        if self._is_server_reusable():
+            self.pool.release(self.server)
+        elif self.server and not self.server.closed:
+            self.server.close()
+        self.server = None
+        self.server_reused = False
+        self.first_byte_deadline = None
+        self.request_start = None
+        self.connect_time = None
+        self.first_byte_time = None
+        self.revalidating = None
+        self.encoder = None
+        self._release_backend()
+        self.failed_backends = []
+        self._discard_cache_body()
+        self._complete_fetch()
+        
+        self.request = HttpParser(stream=True)
+        self.response = HttpParser(HTTP_RESPONSE_PARSER, stream=True)
+        self.client_keep_alive = False
+        
+        pipeline, self.pipeline = self.pipeline, b''
+        if pipeline:
+            logger.debug('processing pipelined request')
+            self._process_request(pipeline)
+    
+    def _access_log(self):
+        # target client asked for, rather than the parent or backend
+        # connected to
+        host, port = self.request.address() if self.request.url else (None, None)
+        if self.access_log:
+            if self.request.method:
+                self.access_log.record(self.client.addr, self.request.method, host, port,
+                                       None if self.request.method == b"CONNECT" else self.request.build_url(),
+                                       self.response.code, self.response.reason, self.response.received,
+                                       monotonic() - self.request_start)
+        elif self.request.method == b"CONNECT":
+            logger.info("%s:%s - %s %s:%s" % (self.client.addr[0], self.client.addr[1], self.request.method, host, port))
+        elif self.request.method:
+            logger.info("%s:%s - %s %s:%s%s - %s %s - %s bytes" % (self.client.addr[0], self.client.addr[1], self.request.method, host, port, self.request.build_url(), self.response.code, self.response.reason, self.response.received))
+    
+    def _observe(self):
+        """Records the current request in metrics, along with bytes sent to
+        client since the previous one.  Data relayed through a tunnel isn't
+        counted, established tunnels are recorded as 200."""
+        if not self.metrics:
+            return
+        sent = self.client.sent if self.sent_before_relay is None else self.sent_before_relay
+        sent, self.sent_observed = sent - self.sent_observed, sent
+        if not self.request.method:
+            # rest of the previous response flushed since it was recorded
+            if sent:
+                self.metrics.send(sent)
+            return
+        code = self.response.code or self.status or (b'200' if self.tunnel else None)
+        self.metrics.observe(code, self.request.received, sent,
+                             monotonic() - self.request_start, self.connect_time, self.first_byte_time)
+        
+    def _get_waitable_lists(self):
+        if self.splicers:
+            return self._get_splice_waitable_lists()
+        
+        rlist, wlist, xlist = [], [], []
+        
+        if self.server and self.server.is_congested(self.high_watermark, self.low_watermark) or \
+        len(self.pipeline) > self.high_watermark:
+            logger.debug('pending server buffer above watermark, not watching client for read ready')
+        else:
+            logger.debug('*** watching client for read ready')
+            rlist.append(self.client.conn)
+        
+        if self.client.has_buffer():
+            logger.debug('pending client buffer found, watching client for write ready')
+            wlist.append(self.client.conn)
+        
+        if self._is_server_connected():
+            if self.client.is_congested(self.high_watermark, self.low_watermark):
+                logger.debug('pending client buffer above watermark, not watching server for read ready')
+            else:
+                logger.debug('connection to server exists, watching server for read ready')
+                rlist.append(self.server.conn)
+        
+        if self._is_server_connected() and self.server.has_buffer():
+            logger.debug('connection to server exists and pending server buffer found, watching server for write ready')
+            wlist.append(self.server.conn)
+        
+        if self.server and self.server.is_connecting():
+            logger.debug('connecting to server, watching connection attempts for write ready')
+            wlist.extend(self.server.attempts)
+        
+        return rlist, wlist, xlist
+    
+    def _get_timeout(self):
+        """Seconds after which proxy must be processed regardless of
+        socket readiness, i.e. until the nearest deadline."""
+        now = monotonic()
+        deadlines = [self.last_activity + self.idle_timeout]
+        if self.total_timeout:
+            deadlines.append(self.start_time + self.total_timeout)
+        if self.first_byte_deadline is not None:
+            deadlines.append(self.first_byte_deadline)
+        if self.waiting_until is not None:
+            deadlines.append(self.waiting_until)
+        if self.server and self.server.is_connecting():
+            deadlines.append(now + self.server.next_timeout())
+        return max(min(deadlines) - now, 0)
+    
+    def _process_wlist(self, w):
+        if self.client.conn in w:
+            logger.debug('client is ready for writes, flushing client buffer')
+            self.client.flush()
+            self.last_activity = monotonic()
+        
+        if self._is_server_connected() and self.server.conn in w:
+            logger.debug('server is ready for writes, flushing server buffer')
+            self.server.flush()
+    
+    def _process_rlist(self, r):
+        if self.client.conn in r:
+            logger.debug('client is ready for reads, reading')
+            data = self.client.recv_view() if self.tunnel else self.client.recv()
+            self.last_activity = monotonic()
+            
+            if not data:
+                logger.debug('client closed connection, breaking')
+                return True
+            
+            try:
+                self._process_request(data)
+            except ProxyConnectionFailed as e:
+                return self._bad_gateway(e)
+        
+        if self._is_server_connected() and self.server.conn in r:
+            logger.debug('server is ready for reads, reading')
+            data = self.server.recv_view() if self.tunnel else self.server.recv()
+            self.last_activity = monotonic()
+            
+            if not data:
+                logger.debug('server closed connection')
+                self.server.close()
+                if self._is_retryable():
+                    try:
+                        self._retry_request()
+                    except ProxyConnectionFailed as e:
+                        return self._bad_gateway(e)
+            else:
+                self.first_byte_deadline = None
+                if self.first_byte_time is None and not self.tunnel:
+                    self.first_byte_time = monotonic() - self.request_start
+                self._process_response(data)
+                if self.client_keep_alive and self.response.state == HTTP_PARSER_STATE_COMPLETE:
+                    try:
+                        self._finish_request()
+                    except ProxyConnectionFailed as e:
+                        return self._bad_gateway(e)
+        
+        return False
+    
+    def _bad_gateway(self, e):
+        if self.backend and self._failover():
+            return False
+        logger.exception(e)
+        if isinstance(e, ProxyNoRoute):
+            self.client.queue(PROXY_NOT_FOUND_RESPONSE_PKT)
+            self.status = b'404'
+        elif isinstance(e, ProxyNoBackend):
+            self.client.queue(PROXY_SERVICE_UNAVAILABLE_RESPONSE_PKT)
+            self.status = b'503'
+        elif isinstance(e, ProxyConnectionTimeout):
+            self.client.queue(PROXY_GATEWAY_TIMEOUT_RESPONSE_PKT)
+            self.status = b'504'
+        else:
+            self.client.queue(PROXY_BAD_GATEWAY_RESPONSE_PKT)
+            self.status = b'502'
+        self.client.flush()
+        return True
+    
+    def _start_relay(self):
+        logger.debug('tunnel established, relaying %s', 'using splice' if self.splice else 'data')
+        self.relaying = True
+        self.sent_before_relay = self.client.sent
+        self.client.conn.setblocking(False)
+        self.server.conn.setblocking(False)
+        if self.splice:
+            self.splicers = (Splicer(self.client.conn, self.server.conn),
+                             Splicer(self.server.conn, self.client.conn))
+    
+    def _get_splice_waitable_lists(self):
+        upstream, downstream = self.splicers
+        rlist, wlist = [], []
+        
+        if upstream.pending:
+            wlist.append(self.server.conn)
+        elif not upstream.eof:
+            rlist.append(self.client.conn)
+        
+        # once client has closed, only data already in the pipe is relayed
+        if downstream.pending:
+            wlist.append(self.client.conn)
+        elif not downstream.eof and not upstream.eof:
+            rlist.append(self.server.conn)
+        
+        return rlist, wlist, []
+    
+    def _process_splice(self, r, w):
+        upstream, downstream = self.splicers
+        
+        if self.server.conn in w:
+            upstream.drain()
+        if self.client.conn in w:
+            downstream.drain()
+        
+        if self.client.conn in r:
+            upstream.fill()
+            self.last_activity = monotonic()
+            upstream.drain()
+        
+        if self.server.conn in r:
+            downstream.fill()
+            self.last_activity = monotonic()
+            downstream.drain()
+        
+        if upstream.broken or downstream.broken:
+            logger.debug('peer closed connection, breaking')
+            return True
+        
+        if upstream.eof and upstream.pending == 0 and downstream.pending == 0:
+            logger.debug('client closed connection and pipes are drained, breaking')
+            return True
+        
+        if downstream.eof and downstream.pending == 0:
+            logger.debug('server closed connection and pipe is drained, breaking')
+            return True
+        
+        return self._is_timed_out()
+    
+    def _process_events(self, r, w):
+        """Process ready sockets, returns True once proxying is complete."""
+        if self.splicers:
+            return self._process_splice(r, w)
+        
+        try:
+            if self.waiting_until is not None and (self.woken or monotonic() >= self.waiting_until):
+                self._resume_request()
+            if self.resolved:
+                addresses, error = self.resolved
+                self.resolved = None
+                self._connect(addresses, error)
+            if self.server and self.server.is_connecting():
+                self._process_connect(w)
+        except ProxyConnectionFailed as e:
+            return self._bad_gateway(e)
+        
+        self._process_wlist(w)
+        if self._process_rlist(r):
+            return True
+        
+        if self.tunnel and not self.relaying and \
+        not self.client.has_buffer() and \
+        self._is_server_connected() and not self.server.has_buffer():
+            self._start_relay()
+        
+        if self.client.buffer_size() == 0:
+            if self.response.state == HTTP_PARSER_STATE_COMPLETE and not self.tunnel:
+                logger.debug('client buffer is empty and response state is complete, breaking')
+                return True
+            
+            if self.server and self.server.closed:
+                logger.debug('client buffer is empty and server closed connection, breaking')
+                return True
+        
+        return self._is_timed_out()
+    
+    def _process(self):
+        while True:
+            rlist, wlist, xlist = self._get_waitable_lists()
+            r, w, x = select.select(rlist, wlist, xlist, self._get_timeout())
+            
+            if self._process_events(r, w):
+                break
+    
+    def _shutdown(self):
+        if self.splicers:
+            for splicer in self.splicers:
+                splicer.close()
+        logger.debug("closing client connection with pending client buffer size %d bytes", self.client.buffer_size())
+        self.client.close()
+        if self.server:
+            logger.debug("closed client connection with pending server buffer size %d bytes", self.server.buffer_size())
+            if self._is_server_reusable():
+                self.pool.release(self.server)
+            elif not self.server.closed:
+                self.server.close()
+        self._release_backend()
+        self._discard_cache_body()
+        self._complete_fetch()
+        if self.waiting_until is not None:
+            self.cache.leave(self.request, self._collapsed)
+        self._access_log()
+        self._observe()
+        logger.debug('Closing proxy for connection %r at address %r', self.client.conn, self.client.addr)
+    
+    def run(self):
+        logger.debug('Proxying connection %r at address %r', self.client.conn, self.client.addr)
+        try:
+            self._process()
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            logger.exception('Exception while handling connection %r with reason %r' % (self.client.conn, e))
+        finally:
+            self._shutdown()
+
+class EventLoop(object):
+    """Multiplexes many proxy connections within a single process.
+    
+    Instead of forking a process per connection, ``Proxy`` instances are
+    registered with the loop and driven by a single ``selectors`` based
+    poller (epoll/kqueue where available).  Each proxy keeps deciding what
+    it wants to wait for via ``_get_waitable_lists``, the loop only keeps
+    the selector registrations in sync with it.
+    
+    Proxies are also processed once the deadline returned by their
+    ``_get_timeout`` passes.  Deadlines are kept in a heap, a deadline
+    moved later is only pushed again once the earlier one pops, so that
+    rescheduling on every event costs nothing and the loop sleeps exactly
+    until the nearest deadline.
+    """
+    
+    def __init__(self, on_close=None):
+        if selectors is None:
+            raise ProxyError('event loop engine requires the selectors module (Python 3.4+)')
+        self.selector = selectors.DefaultSelector()
+        self.proxies = dict()
+        self.readers = dict()
+        # proxy -> time by which it must be processed regardless of readiness
+        self.timers = dict()
+        # heap of (deadline, sequence, proxy), and proxy -> the earliest
+        # of its deadlines in the heap, entries not matching are stale
+        self.heap = []
+        self.scheduled = dict()
+        self.sequence = itertools.count()
+        # called with every proxy once closed
+        self.on_close = on_close
+    
+    def add_reader(self, sock, callback):
+        """Invoke ``callback`` whenever ``sock`` is ready for reads."""
+        self.readers[sock] = callback
+        self.selector.register(sock, selectors.EVENT_READ, callback)
+    
+    def remove_reader(self, sock):
+        del self.readers[sock]
+        self.selector.unregister(sock)
+    
+    def add(self, proxy):
+        logger.debug('Adding proxy for connection %r to event loop', proxy.client.conn)
+        proxy.loop = self
+        self.proxies[proxy] = dict()
+        self._sync(proxy)
+    
+    def remove(self, proxy):
+        logger.debug('Removing proxy for connection %r from event loop', proxy.client.conn)
+        self.timers.pop(proxy, None)
+        self.scheduled.pop(proxy, None)
+        for conn in self.proxies.pop(proxy):
+            self.selector.unregister(conn)
+    
+    def _sync(self, proxy):
+        rlist, wlist, xlist = proxy._get_waitable_lists()
+        wanted = dict()
+        for conn in rlist:
+            wanted[conn] = wanted.get(conn, 0) | selectors.EVENT_READ
+        for conn in wlist:
+            wanted[conn] = wanted.get(conn, 0) | selectors.EVENT_WRITE
+        
+        registered = self.proxies[proxy]
+        for conn in list(registered):
+            if conn not in wanted:
+                self.selector.unregister(conn)
+                del registered[conn]
+        
+        for conn, events in wanted.items():
+            if conn not in registered:
+                conn.setblocking(False)
+                self.selector.register(conn, events, proxy)
+            elif registered[conn] != events:
+                self.selector.modify(conn, events, proxy)
+            registered[conn] = events
+        
+        timeout = proxy._get_timeout()
+        if timeout is None:
+            self.timers.pop(proxy, None)
+        else:
+            self.timers[proxy] = monotonic() + timeout
+            self._schedule(proxy)
+    
+    def _schedule(self, proxy):
+        deadline = self.timers[proxy]
+        if proxy not in self.scheduled or deadline < self.scheduled[proxy]:
+            self.scheduled[proxy] = deadline
+            heapq.heappush(self.heap, (deadline, next(self.sequence), proxy))
+    
+    def _close(self, proxy):
+        self.remove(proxy)
+        try:
+            proxy._shutdown()
+        except Exception as e:
+            logger.exception('Exception while closing connection %r with reason %r' % (proxy.client.conn, e))
+        if self.on_close:
+            self.on_close(proxy)
+    
+    def _dispatch(self, proxy, r, w):
+        try:
+            done = proxy._process_events(r, w)
+        except Exception as e:
+            logger.exception('Exception while handling connection %r with reason %r' % (proxy.client.conn, e))
+            done = True
+        
+        if done:
+            self._close(proxy)
+        else:
+            self._sync(proxy)
+    
+    def dispatch(self, proxy):
+        """Processes proxy regardless of socket readiness, e.g. once a
+        lookup it waits for has completed."""
+        if proxy in self.proxies:
+            self._dispatch(proxy, [], [])
+    
+    def poll(self, timeout=None):
+        """Processes ready sockets and expired deadlines, waiting up to
+        timeout seconds, or until the nearest deadline if None."""
+        if self.heap:
+            nearest = max(self.heap[0][0] - monotonic(), 0)
+            timeout = nearest if timeout is None else min(timeout, nearest)
+        
+        ready = dict()
+        callbacks = []
+        for key, mask in self.selector.select(timeout):
+            if key.fileobj in self.readers:
+                callbacks.append(key.data)
+                continue
+            r, w = ready.setdefault(key.data, ([], []))
+            if mask & selectors.EVENT_READ:
+                r.append(key.fileobj)
+            if mask & selectors.EVENT_WRITE:
+                w.append(key.fileobj)
+        
+        for proxy, (r, w) in ready.items():
+            if proxy in self.proxies:
+                self._dispatch(proxy, r, w)
+        
+        now = monotonic()
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            expired.append(heapq.heappop(self.heap))
+        for deadline, _, proxy in expired:
+            if self.scheduled.get(proxy) != deadline:
+                continue
+            del self.scheduled[proxy]
+            if proxy not in self.timers:
+                continue
+            # deadline moved since, or proxy was just processed
+            if self.timers[proxy] > now or proxy in ready:
+                self._schedule(proxy)
+                continue
+            self._dispatch(proxy, [], [])
+        
+        for callback in callbacks:
+            callback()
+    
+    def close(self):
+        for proxy in list(self.proxies):
+            self._close(proxy)
+        self.selector.close()
+
+class TCP(object):
+    """TCP server implementation."""
+    
+    def __init__(self, hostname='127.0.0.1', port=8899, backlog=100):
+        self.hostname = hostname
+        self.port = port
+        self.backlog = backlog
+    
+    def handle(self, client):
+        raise NotImplementedError()
+    
+    def accept(self):
+        conn, addr = self.socket.accept()
+        logger.debug('Accepted connection %r at address %r', conn, addr)
+        client = Client(conn, addr)
+        self.handle(client)
+    
+    def serve(self):
+        while True:
+            self.accept()
+    
+    def listen(self, reuse_port=False):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.hostname, self.port))
+        sock.listen(self.backlog)
+        return sock
+    
+    def run(self):
+        self.socket = None
+        try:
+            logger.info('Starting server on port %d' % self.port)
+            self.socket = self.listen()
+            self.serve()
+        except Exception as e:
+            logger.exception('Exception while running the server %r' % e)
+        finally:
+            logger.info('Closing server socket')
+            if self.socket:
+                self.socket.close()
+
+ENGINE_PROCESS = 'process'
+ENGINE_EVENTLOOP = 'eventloop'
+ENGINE_ASYNCIO = 'asyncio'
+ENGINES = (ENGINE_PROCESS, ENGINE_EVENTLOOP, ENGINE_ASYNCIO)
+# command line options implemented by the asyncio engine
+ASYNCIO_OPTIONS = ('hostname', 'port', 'log_level', 'engine', 'connect_timeout', 'idle_timeout')
+
+class AdmissionControl(object):
+    """Limits the number of connections proxied at once.
+    
+    At most ``max_connections`` connections are proxied concurrently,
+    further ones wait in a queue of ``max_pending`` connections and are
+    rejected once it is full.  Connections from a client address beyond
+    ``max_per_client`` concurrent (or waiting) ones are rejected.  A limit
+    of 0 disables it.
+    """
+    
+    ADMIT = 'admit'
+    QUEUE = 'queue'
+    REJECT = 'reject'
+    
+    def __init__(self, max_connections=0, max_per_client=0, max_pending=128):
+        self.max_connections = max_connections
+        self.max_per_client = max_per_client
+        self.max_pending = max_pending
+        self.active = 0
+        # client address -> connections active or waiting
+        self.clients = dict()
+        self.pending = collections.deque()
+        
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.rejected_per_client = 0
+    
+    def admit(self, client):
+        """Returns ADMIT if client may be proxied now, QUEUE if it waits for
+        a connection to complete or REJECT if it is to be turned away."""
+        host = client.addr[0]
+        if self.max_per_client and self.clients.get(host, 0) >= self.max_per_client:
+            self.rejected += 1
+            self.rejected_per_client += 1
+            return self.REJECT
+        
+        if self.max_connections and self.active >= self.max_connections:
+            if len(self.pending) >= self.max_pending:
+                self.rejected += 1
+                return self.REJECT
+            self.pending.append(client)
+            self.clients[host] = self.clients.get(host, 0) + 1
+            self.queued += 1
+            return self.QUEUE
+        
+        self.active += 1
+        self.clients[host] = self.clients.get(host, 0) + 1
+        self.admitted += 1
+        return self.ADMIT
+    
+    def release(self, client):
+        """Called once client has been proxied, returns a waiting client
+        admitted in its place, if any."""
+        host = client.addr[0]
+        self.clients[host] -= 1
+        if not self.clients[host]:
+            del self.clients[host]
+        self.active -= 1
+        
+        if self.pending and (not self.max_connections or self.active < self.max_connections):
+            self.active += 1
+            self.admitted += 1
+            return self.pending.popleft()
+        return None
+    
+    def close(self):
+        """Closes waiting clients."""
+        while self.pending:
+            self.pending.popleft().close()
+
+class HTTP(TCP):
+    """HTTP proxy server implementation.
+    
+    With the default ``process`` engine, spawns new process to proxy
+    accepted client connection.  With the ``eventloop`` engine all
+    accepted connections are multiplexed within this process.
+    
+    When ``workers`` is non-zero, a master process pre-forks that many
+    long lived worker processes, each running its own event loop, and
+    respawns any worker which exits.  Workers either share the listening
+    socket created by the master or, with ``reuse_port``, each bind their
+    own ``SO_REUSEPORT`` listener and let the kernel shard accepts.
+    Workers are stopped with the master on SIGTERM or SIGINT, and exit by
+    themselves should the master die.
+    
+    A ``Resolver`` given is shared by all proxies within a process, every
+    event loop starts its own lookup threads.
+    
+    Connections are admitted through ``admission`` when given, connections
+    turned away are responded with 503 Service Unavailable.  With workers,
+    its limits apply to each worker.
+    
+    Requests are recorded in ``metrics`` when given, which must have a
+    slot for every worker.
+    """
+    
+    # seconds workers are given to exit once terminated, before being killed
+    WORKER_STOP_TIMEOUT = 5
+    
+    def __init__(self, hostname='127.0.0.1', port=8899, backlog=100, engine=ENGINE_PROCESS,
+                 workers=0, reuse_port=False, supervise_interval=1, resolver=None, admission=None, metrics=None,
+                 **kwargs):
+        super(HTTP, self).__init__(hostname, port, backlog)
+        if engine not in (ENGINE_PROCESS, ENGINE_EVENTLOOP):
+            raise ValueError('Unknown engine %r' % engine)
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('SO_REUSEPORT is not supported on this platform')
+        if metrics and metrics.slots < max(workers, 1):
+            raise ValueError('Metrics has %d slots for %d workers' % (metrics.slots, workers))
+        self.engine = ENGINE_EVENTLOOP if workers else engine
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.supervise_interval = supervise_interval
+        self.processes = []
+        # within a worker, pid of the master process which spawned it
+        self.master_pid = None
+        self.loop = None
+        self.resolver = resolver
+        self.admission = admission
+        self.metrics = metrics
+        # processes proxying admitted connections
+        self.children = []
+        # remaining keyword arguments are passed to every Proxy
+        self.kwargs = kwargs
+    
     def handle(self, client):
-        proc = Proxy(client)
+        if self.admission:
+            admitted = self.admission.admit(client)
+            if admitted == AdmissionControl.QUEUE:
+                logger.debug('Connection %r at address %r queued for admission', client.conn, client.addr)
+                if self.metrics:
+                    self.metrics.queue()
+                return
+            if admitted == AdmissionControl.REJECT:
+                logger.debug('Connection %r at address %r rejected', client.conn, client.addr)
+                return self._reject(client)
+            if self.metrics:
+                self.metrics.admit()
+        self._proxy(client)
+    
+    def _proxy(self, client):
+        proc = Proxy(client, resolver=self.resolver, metrics=self.metrics, **self.kwargs)
+        if self.loop:
+            self.loop.add(proc)
+            return
         proc.daemon = True
         proc.start()
-        logger.debug('Started process %r to handle connection %r' % (proc, client.conn))
+        logger.debug('Started process %r to handle connection %r', proc, client.conn)
+        if self.admission:
+            self.children.append(proc)
+        # the child owns the connection now, closing our copy ensures
+        # client sees the connection closed once the child closes it
+        client.close()
+    
+    def _reject(self, client):
+        if self.metrics:
+            self.metrics.reject()
+        try:
+            client.conn.setblocking(False)
+            client.conn.send(PROXY_SERVICE_UNAVAILABLE_RESPONSE_PKT)
+            # unread request data would make close reset the connection
+            client.conn.recv(65536)
+        except socket.error:
+            pass
+        client.close()
+    
+    def _closed(self, proc):
+        client = self.admission.release(proc.client)
+        if client:
+            logger.debug('Connection %r at address %r admitted from queue', client.conn, client.addr)
+            if self.metrics:
+                self.metrics.admit()
+            self._proxy(client)
+    
+    def _reap(self):
+        for proc in [proc for proc in self.children if not proc.is_alive()]:
+            self.children.remove(proc)
+            self._closed(proc)
+    
+    def serve(self):
+        if self.engine == ENGINE_PROCESS:
+            if not self.admission:
+                return super(HTTP, self).serve()
+            # wake up periodically to admit queued connections
+            # in place of exited processes
+            while True:
+                r, _, _ = select.select([self.socket], [], [], 0.1)
+                self._reap()
+                if r:
+                    self.accept()
+        
+        self.loop = EventLoop(on_close=self._closed if self.admission else None)
+        self.socket.setblocking(False)
+        self.loop.add_reader(self.socket, self.accept)
+        if self.resolver:
+            self.resolver.start()
+            self.loop.add_reader(self.resolver, self.resolver.process_completed)
+        # wake up periodically to save cache index and check on master
+        cache = self.kwargs.get('cache')
+        intervals = [self.supervise_interval] if self.master_pid else []
+        if cache and cache.disk:
+            intervals.append(cache.INDEX_SAVE_INTERVAL)
+        interval = min(intervals) if intervals else None
+        try:
+            while True:
+                self.loop.poll(interval)
+                if cache:
+                    cache.flush()
+                if self.master_pid and os.getppid() != self.master_pid:
+                    logger.warning('Master process exited, stopping worker')
+                    break
+        finally:
+            if self.admission:
+                self.admission.close()
+            self.loop.close()
+            if self.resolver:
+                self.resolver.close()
+            if self.kwargs.get('cache'):
+                self.kwargs['cache'].close()
+    
+    def accept(self):
+        try:
+            super(HTTP, self).accept()
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+    
+    @staticmethod
+    def _terminate(signum, frame):
+        raise SystemExit(0)
+    
+    def _run_worker(self, index, master_pid):
+        signal.signal(signal.SIGTERM, self._terminate)
+        self.master_pid = master_pid
+        if self.metrics:
+            self.metrics.slot = index
+        try:
+            if self.reuse_port:
+                self.socket = self.listen(reuse_port=True)
+            logger.info('Worker started, serving on port %d' % self.port)
+            self.serve()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.socket.close()
+    
+    def _spawn_worker(self, index):
+        worker = multiprocessing.Process(target=self._run_worker, args=(index, os.getpid()))
+        worker.daemon = True
+        worker.start()
+        logger.debug('Started worker process %r', worker)
+        return worker
+    
+    def _supervise(self):
+        for i, worker in enumerate(self.processes):
+            if not worker.is_alive():
+                logger.warning('Worker process %r exited with code %r, respawning' % (worker, worker.exitcode))
+                self.processes[i] = self._spawn_worker(i)
+    
+    def run(self):
+        # cleanup, e.g. stopping workers or saving cache index, runs on
+        # SIGTERM as it does on SIGINT
+        signal.signal(signal.SIGTERM, self._terminate)
+        if not self.workers:
+            return super(HTTP, self).run()
+        
+        self.socket = None
+        try:
+            logger.info('Starting server on port %d with %d workers' % (self.port, self.workers))
+            if not self.reuse_port:
+                self.socket = self.listen()
+            self.processes = [self._spawn_worker(i) for i in range(self.workers)]
+            while True:
+                time.sleep(self.supervise_interval)
+                self._supervise()
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            logger.exception('Exception while running the server %r' % e)
+        finally:
+            logger.info('Stopping workers')
+            for worker in self.processes:
+                worker.terminate()
+            for worker in self.processes:
+                worker.join(self.WORKER_STOP_TIMEOUT)
+                if worker.is_alive():
+                    logger.warning('Worker process %r did not exit, killing' % worker)
+                    os.kill(worker.pid, signal.SIGKILL)
+                    worker.join()
+            if self.socket:
+                self.socket.close()
+
+class Metrics(object):
+    """Request counters and latency histograms shared between processes.
+    
+    Values are kept in a shared memory array created before processes
+    fork, divided into ``slots`` slots of which each process writes to
+    ``slot``.  Every worker owns a slot, processes sharing one (e.g. those
+    of the process engine) serialize updates through the slot lock.
+    Slots are summed when rendered, in Prometheus text format.
+    
+    Histograms have fixed ``BUCKETS``, in seconds.
+    """
+    
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    HISTOGRAMS = (
+        ('proxy_upstream_connect_seconds', 'Time taken to connect to destination servers.'),
+        ('proxy_first_byte_seconds', 'Time from request until first byte of response from server.'),
+        ('proxy_request_duration_seconds', 'Time from request until response is complete.'),
+    )
+    
+    # slot layout: requests by status code (0 for no response), bytes
+    # received and sent, connections admitted, queued and rejected, then
+    # for every histogram its bucket counts (last one +Inf) followed by
+    # sum of observations
+    CODES = 600
+    BYTES_IN = CODES
+    BYTES_OUT = CODES + 1
+    REJECTED = CODES + 2
+    ADMITTED = CODES + 3
+    QUEUED = CODES + 4
+    HISTOGRAM_OFFSET = CODES + 5
+    HISTOGRAM_SIZE = len(BUCKETS) + 2
+    SLOT_SIZE = HISTOGRAM_OFFSET + len(HISTOGRAMS) * HISTOGRAM_SIZE
+    
+    CONNECT = 0
+    FIRST_BYTE = 1
+    DURATION = 2
+    
+    def __init__(self, slots=1):
+        self.slots = slots
+        self.slot = 0
+        self.values = multiprocessing.RawArray('d', slots * self.SLOT_SIZE)
+        self.locks = [multiprocessing.Lock() for _ in range(slots)]
+    
+    def observe(self, code, bytes_in, bytes_out, duration, connect=None, first_byte=None):
+        """Records a request, timings are in seconds and None if unknown."""
+        try:
+            code = int(code or 0)
+        except ValueError:
+            code = 0
+        if not 100 <= code < self.CODES:
+            code = 0
+        
+        base = self.slot * self.SLOT_SIZE
+        values = self.values
+        with self.locks[self.slot]:
+            values[base + code] += 1
+            values[base + self.BYTES_IN] += bytes_in
+            values[base + self.BYTES_OUT] += bytes_out
+            for histogram, value in ((self.CONNECT, connect), (self.FIRST_BYTE, first_byte),
+                                     (self.DURATION, duration)):
+                if value is None:
+                    continue
+                offset = base + self.HISTOGRAM_OFFSET + histogram * self.HISTOGRAM_SIZE
+                values[offset + bisect.bisect_left(self.BUCKETS, value)] += 1
+                values[offset + self.HISTOGRAM_SIZE - 1] += value
+    
+    def send(self, size):
+        """Records bytes sent to a client outside of an observed request."""
+        with self.locks[self.slot]:
+            self.values[self.slot * self.SLOT_SIZE + self.BYTES_OUT] += size
+    
+    def admit(self):
+        """Records a connection admitted, straight away or from queue."""
+        self._count(self.ADMITTED)
+    
+    def queue(self):
+        """Records a connection queued for admission."""
+        self._count(self.QUEUED)
+    
+    def reject(self):
+        """Records a connection turned away."""
+        self._count(self.REJECTED)
+    
+    def _count(self, index):
+        with self.locks[self.slot]:
+            self.values[self.slot * self.SLOT_SIZE + index] += 1
+    
+    def totals(self):
+        """Returns values summed over all slots."""
+        values = self.values[:]
+        return [sum(values[i::self.SLOT_SIZE]) for i in range(self.SLOT_SIZE)]
+    
+    def render(self):
+        totals = self.totals()
+        lines = [
+            '# HELP proxy_requests_total Requests proxied by response status code, 0 if there was no response.',
+            '# TYPE proxy_requests_total counter',
+        ]
+        for code in range(self.CODES):
+            if totals[code]:
+                lines.append('proxy_requests_total{code="%d"} %d' % (code, totals[code]))
+        for name, index, help in (('proxy_received_bytes_total', self.BYTES_IN, 'Bytes of requests received from clients.'),
+                                  ('proxy_sent_bytes_total', self.BYTES_OUT, 'Bytes of responses sent to clients.'),
+                                  ('proxy_admitted_connections_total', self.ADMITTED, 'Connections admitted by admission control.'),
+                                  ('proxy_queued_connections_total', self.QUEUED, 'Connections queued by admission control.'),
+                                  ('proxy_rejected_connections_total', self.REJECTED, 'Connections turned away by admission control.')):
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s counter' % name, '%s %d' % (name, totals[index])]
+        
+        for histogram, (name, help) in enumerate(self.HISTOGRAMS):
+            offset = self.HISTOGRAM_OFFSET + histogram * self.HISTOGRAM_SIZE
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s histogram' % name]
+            count = 0
+            for i, bound in enumerate(self.BUCKETS + ('+Inf',)):
+                count += totals[offset + i]
+                lines.append('%s_bucket{le="%s"} %d' % (name, bound, count))
+            lines.append('%s_sum %r' % (name, totals[offset + self.HISTOGRAM_SIZE - 1]))
+            lines.append('%s_count %d' % (name, count))
+        return bytes_('\n'.join(lines) + '\n')
+
+class MetricsServer(TCP):
+    """Admin endpoint serving ``Metrics`` at ``/metrics``, from a thread
+    of the process started."""
+    
+    def __init__(self, metrics, hostname='127.0.0.1', port=8900, backlog=100, timeout=5):
+        super(MetricsServer, self).__init__(hostname, port, backlog)
+        self.metrics = metrics
+        self.timeout = timeout
+    
+    def handle(self, client):
+        try:
+            client.conn.settimeout(self.timeout)
+            request = HttpParser()
+            while request.state < HTTP_PARSER_STATE_HEADERS_COMPLETE:
+                data = client.recv()
+                if not data:
+                    return
+                request.parse(data)
+            
+            if request.method == b'GET' and request.url.path == b'/metrics':
+                body = self.metrics.render()
+                head = [b'HTTP/1.1 200 OK', b'Content-Type: text/plain; version=0.0.4']
+            else:
+                body = b'Not Found'
+                head = [b'HTTP/1.1 404 Not Found', b'Content-Type: text/plain']
+            client.conn.sendall(CRLF.join(head + [
+                b'Content-Length: ' + bytes_(str(len(body))),
+                b'Connection: close',
+                CRLF
+            ]) + body)
+        except Exception as e:
+            logger.exception('Exception while serving metrics to %r with reason %r' % (client.addr, e))
+        finally:
+            client.close()
+    
+    def start(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+class AccessLog(object):
+    """Access log written in batches by a background thread.
+    
+    Proxies ``record`` requests as tuples into a ``multiprocessing`` queue,
+    which works across forked processes and workers, while the thread
+    started in the main process formats them as ``text`` or ``json``
+    lines and writes all queued ones at once.  Records are dropped once
+    ``max_queued`` are pending.  The file is rotated once it would exceed
+    ``max_bytes`` (0 never rotates), keeping ``backups`` rotated files.
+    """
+    
+    FORMATS = ('text', 'json')
+    FIELDS = ('time', 'client', 'client_port', 'method', 'host', 'port', 'url', 'status', 'reason', 'bytes',
+              'duration')
+    
+    def __init__(self, path, format='text', max_bytes=0, backups=5, batch_size=512, max_queued=65536):
+        if format not in self.FORMATS:
+            raise ValueError('Unknown access log format %r' % format)
+        self.path = path
+        self.format = format
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.queue = multiprocessing.Queue(max_queued)
+        self.file = None
+        self.size = 0
+        self.thread = None
+        # records dropped by this process
+        self.dropped = 0
+    
+    def record(self, client, method, host, port, url, status, reason, size, duration):
+        try:
+            self.queue.put_nowait((time.time(), client[0], client[1], method, host, port, url, status, reason,
+                                   size, duration))
+        except queue.Full:
+            self.dropped += 1
+    
+    def start(self):
+        self.file = open(self.path, 'ab', 64 * 1024)
+        self.size = self.file.tell()
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def close(self, timeout=5):
+        """Writes records queued so far and closes the file."""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join(timeout)
+            self.thread = None
+        if self.file:
+            self.file.close()
+            self.file = None
+    
+    def format_record(self, record):
+        record = [text_(value, 'latin-1') if isinstance(value, binary_type) else value for value in record]
+        record[0] = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record[0])) + '.%03dZ' % (record[0] % 1 * 1000)
+        if self.format == 'json':
+            return json.dumps(dict(zip(self.FIELDS, record)), sort_keys=True) + '\n'
+        if record[6] is None:
+            return '%s %s:%s - %s %s:%s - %s bytes - %.3fs\n' % tuple(record[:6] + record[9:])
+        return '%s %s:%s - %s %s:%s%s - %s %s - %s bytes - %.3fs\n' % tuple(record)
+    
+    def _write(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while len(records) < self.batch_size and records[-1] is not None:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            
+            data = bytes_(''.join(self.format_record(record) for record in records if record is not None))
+            try:
+                if data:
+                    if self.max_bytes and self.size and self.size + len(data) > self.max_bytes:
+                        self._rotate()
+                    self.file.write(data)
+                    self.file.flush()
+                    self.size += len(data)
+            except (IOError, OSError) as e:
+                logger.warning('Failed writing access log %s: %r' % (self.path, e))
+            if records[-1] is None:
+                return
+    
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, i)):
+                os.rename('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+        self.file = open(self.path, 'wb', 64 * 1024)
+        self.size = 0
+
+class AsyncUpstream(asyncio.Protocol if asyncio else object):
+    """Server side protocol of an ``AsyncProxy`` connection."""
+    
+    def __init__(self, proxy):
+        self.proxy = proxy
+    
+    def connection_made(self, transport):
+        self.proxy.server_transport = transport
+    
+    def data_received(self, data):
+        self.proxy.server_data_received(data)
+    
+    def eof_received(self):
+        return False
+    
+    def connection_lost(self, exc):
+        self.proxy.server_connection_lost(exc)
+    
+    def pause_writing(self):
+        self.proxy.transport.pause_reading()
+    
+    def resume_writing(self):
+        self.proxy.transport.resume_reading()
+
+class AsyncProxy(asyncio.Protocol if asyncio else object):
+    """HTTP proxy implementation on top of asyncio transports.
+    
+    Client facing protocol which drives ``HttpParser`` incrementally as
+    data arrives, connects upstream once request headers are complete
+    and then streams bytes in both directions.  Transport flow control is
+    propagated across the two sides, so a slow reader pauses the other
+    transport instead of buffering.  Connect and inactivity timeouts are
+    loop timers, nothing polls.
+    """
+    
+    def __init__(self, connect_timeout=10, inactivity_timeout=30):
+        self.loop = asyncio.get_event_loop()
+        self.connect_timeout = connect_timeout
+        self.inactivity_timeout = inactivity_timeout
+        
+        self.transport = None
+        self.server_transport = None
+        self.addr = None
+        self.server_addr = None
+        self.connecting = None
+        self.pending = []
+        # set once request head has been written upstream, until then
+        # data is held in pending even if server transport exists
+        self.relaying = False
+        self.closed = False
+        
+        self.request = HttpParser(stream=True)
+        self.response = HttpParser(HTTP_RESPONSE_PARSER, stream=True)
+        
+        self.last_activity = self.loop.time()
+        self.inactivity_timer = None
+    
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        self._schedule_inactivity_check(self.inactivity_timeout)
+    
+    def _schedule_inactivity_check(self, delay):
+        self.inactivity_timer = self.loop.call_later(delay, self._check_inactivity)
+    
+    def _check_inactivity(self):
+        inactive_for = self.loop.time() - self.last_activity
+        if inactive_for >= self.inactivity_timeout:
+            logger.debug('maximum inactivity has reached for %r, closing', self.addr)
+            self.close()
+        else:
+            self._schedule_inactivity_check(self.inactivity_timeout - inactive_for)
+    
+    def data_received(self, data):
+        self.last_activity = self.loop.time()
+        
+        if self.relaying:
+            self.server_transport.write(data)
+            return
+        
+        if self.connecting:
+            self.pending.append(data)
+            return
+        
+        # connect once request headers are complete, data following
+        # them is written to the server as it arrives
+        self.request.parse(data)
+        if self.request.state >= HTTP_PARSER_STATE_HEADERS_COMPLETE:
+            data = data[len(data) - (self.request.received - self.request.head_size):]
+            if data:
+                self.pending.append(data)
+            self._connect()
+    
+    def _connect(self):
+        self.server_addr = self.request.address()
+        host, port = self.server_addr
+        logger.debug('connecting to server %s:%s', host, port)
+        self.connecting = asyncio.ensure_future(asyncio.wait_for(
+            self.loop.create_connection(lambda: AsyncUpstream(self), text_(host), int(port)),
+            self.connect_timeout))
+        self.connecting.add_done_callback(self._connected)
+    
+    def _connected(self, future):
+        self.connecting = None
+        if future.cancelled() or self.closed:
+            return
+        
+        e = future.exception()
+        if e:
+            logger.error(str(ProxyConnectionFailed(self.server_addr[0], self.server_addr[1], repr(e))))
+            if isinstance(e, asyncio.TimeoutError):
+                self.transport.write(PROXY_GATEWAY_TIMEOUT_RESPONSE_PKT)
+            else:
+                self.transport.write(PROXY_BAD_GATEWAY_RESPONSE_PKT)
+            self.close()
+            return
+        
+        logger.debug('connected to server %s:%s', *self.server_addr)
+        if self.request.method == b"CONNECT":
+            self.transport.write(PROXY_CONNECTION_ESTABLISHED_PKT)
+        else:
+            self.server_transport.write(self.request.build_head(
+                del_headers=[b'proxy-connection', b'connection', b'keep-alive'],
+                add_headers=[(b'Connection', b'Close')]
+            ))
+        
+        for data in self.pending:
+            self.server_transport.write(data)
+        self.pending = []
+        self.relaying = True
+    
+    def server_data_received(self, data):
+        self.last_activity = self.loop.time()
+        if not self.request.method == b"CONNECT":
+            self.response.parse(data)
+        self.transport.write(data)
+        
+        if self.response.state == HTTP_PARSER_STATE_COMPLETE:
+            logger.debug('response state is complete, closing')
+            self.close()
+    
+    def server_connection_lost(self, exc):
+        logger.debug('server closed connection')
+        self.server_transport = None
+        self.close()
+    
+    def pause_writing(self):
+        if self.server_transport:
+            self.server_transport.pause_reading()
+    
+    def resume_writing(self):
+        if self.server_transport:
+            self.server_transport.resume_reading()
+    
+    def eof_received(self):
+        return False
+    
+    def connection_lost(self, exc):
+        logger.debug('client closed connection')
+        self.close()
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        
+        if self.inactivity_timer:
+            self.inactivity_timer.cancel()
+        if self.connecting:
+            self.connecting.cancel()
+        if self.server_transport:
+            self.server_transport.close()
+        # pending writes are flushed before the transport is closed
+        self.transport.close()
+        self._access_log()
+    
+    def _access_log(self):
+        host, port = self.server_addr if self.server_addr else (None, None)
+        if self.request.method == b"CONNECT":
+            logger.info("%s:%s - %s %s:%s" % (self.addr[0], self.addr[1], self.request.method, host, port))
+        elif self.request.method:
+            logger.info("%s:%s - %s %s:%s%s - %s %s - %s bytes" % (self.addr[0], self.addr[1], self.request.method, host, port, self.request.build_url(), self.response.code, self.response.reason, self.response.received))
+
+class AsyncHTTP(object):
+    """asyncio based HTTP proxy server.
+    
+    ``start`` returns a coroutine creating the listening server on the
+    current event loop, which allows embedding the proxy within other
+    asyncio applications.  ``run`` serves forever on a new event loop.
+    """
+    
+    def __init__(self, hostname='127.0.0.1', port=8899, backlog=100, connect_timeout=10, inactivity_timeout=30):
+        if asyncio is None:
+            raise ProxyError('asyncio engine requires Python 3.4+')
+        self.hostname = hostname
+        self.port = port
+        self.backlog = backlog
+        self.connect_timeout = connect_timeout
+        self.inactivity_timeout = inactivity_timeout
+    
+    def protocol_factory(self):
+        return AsyncProxy(self.connect_timeout, self.inactivity_timeout)
+    
+    def start(self, loop=None):
+        loop = loop if loop else asyncio.get_event_loop()
+        return loop.create_server(self.protocol_factory, self.hostname, self.port, backlog=self.backlog)
+    
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        logger.info('Starting server on port %d' % self.port)
+        server = loop.run_until_complete(self.start())
+        try:
+            loop.run_forever()
+        finally:
+            logger.info('Closing server socket')
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
 
 def main():
     parser = argparse.ArgumentParser(
@@ -554,18 +3883,159 @@ def main():
     parser.add_argument('--hostname', default='127.0.0.1', help='Default: 127.0.0.1')
     parser.add_argument('--port', default='8899', help='Default: 8899')
     parser.add_argument('--log-level', default='INFO', help='DEBUG, INFO, WARNING, ERROR, CRITICAL')
+    parser.add_argument('--engine', default=ENGINE_PROCESS, choices=ENGINES, help='Default: process. '
+                        'process spawns a process per connection, eventloop multiplexes all connections in one process, '
+                        'asyncio serves connections using asyncio transports, supporting --connect-timeout and '
+                        '--idle-timeout only')
+    parser.add_argument('--workers', default='0', help='Default: 0. Number of pre-forked worker processes, '
+                        'each running its own event loop. Implies --engine eventloop')
+    parser.add_argument('--reuse-port', action='store_true', default=False, help='Default: False. '
+                        'Each worker binds its own SO_REUSEPORT listener instead of sharing one socket')
+    parser.add_argument('--disable-splice', action='store_true', default=False, help='Default: False. '
+                        'Relay tunneled data through user space even where os.splice is available')
+    parser.add_argument('--max-requests', default='100', help='Default: 100. Maximum number of requests served '
+                        'over a persistent client connection')
+    parser.add_argument('--max-connections', default='0', help='Default: 0. Maximum number of connections proxied '
+                        'at once by each process or worker, 0 disables the limit')
+    parser.add_argument('--max-connections-per-client', default='0', help='Default: 0. Maximum number of '
+                        'concurrent connections from a client address, 0 disables the limit')
+    parser.add_argument('--max-pending-connections', default='128', help='Default: 128. Maximum number of '
+                        'connections waiting for admission beyond --max-connections, further ones are responded with '
+                        '503 Service Unavailable')
+    parser.add_argument('--high-watermark', default='256', help='Default: 256. KB of data pending for a client or '
+                        'server beyond which the other side of the connection is no longer read from')
+    parser.add_argument('--low-watermark', default='64', help='Default: 64. KB of pending data down to which a '
+                        'congested connection must drain before reading resumes')
+    parser.add_argument('--upstream-max-idle', default='0', help='Default: 0. Maximum idle keep-alive connections '
+                        'pooled per destination server, 0 disables pooling. Takes effect with the eventloop engine')
+    parser.add_argument('--upstream-idle-timeout', default='30', help='Default: 30. Seconds after which idle pooled '
+                        'connections are closed')
+    parser.add_argument('--connect-timeout', default='10', help='Default: 10. Seconds to wait for connections to '
+                        'destination servers before responding with 504 Gateway Timeout')
+    parser.add_argument('--first-byte-timeout', default='30', help='Default: 30. Seconds to wait for a response from '
+                        'destination servers before responding with 504 Gateway Timeout, 0 disables the timeout')
+    parser.add_argument('--idle-timeout', default='30', help='Default: 30. Seconds after which connections without '
+                        'any data transferred are closed')
+    parser.add_argument('--total-timeout', default='0', help='Default: 0. Maximum duration in seconds of a client '
+                        'connection, 0 disables the limit')
+    parser.add_argument('--dns-cache-size', default='1024', help='Default: 1024. Maximum number of cached hostname '
+                        'lookups, 0 disables the resolver cache')
+    parser.add_argument('--dns-ttl', default='60', help='Default: 60. Seconds for which resolved addresses are cached')
+    parser.add_argument('--dns-negative-ttl', default='5', help='Default: 5. Seconds for which failed lookups are cached')
+    parser.add_argument('--dns-workers', default='4', help='Default: 4. Number of threads performing lookups off '
+                        'the event loop')
+    parser.add_argument('--cache-size', default='0', help='Default: 0. Size in MB of the in-memory response cache, '
+                        '0 disables caching. Takes effect with the eventloop engine')
+    parser.add_argument('--cache-max-object-size', default='1024', help='Default: 1024. Size in KB of the largest '
+                        'response cached in memory')
+    parser.add_argument('--cache-collapse-timeout', default='5', help='Default: 5. Seconds for which requests wait '
+                        'for an identical request being fetched before fetching themselves, 0 disables waiting')
+    parser.add_argument('--cache-dir', default=None, help='Default: None. Directory of the disk cache tier, keeping '
+                        'responses over restarts. Takes effect along with --cache-size')
+    parser.add_argument('--cache-disk-size', default='1024', help='Default: 1024. Size in MB of the disk cache tier')
+    parser.add_argument('--cache-disk-max-object-size', default='256', help='Default: 256. Size in MB of the largest '
+                        'response cached on disk')
+    parser.add_argument('--access-log', default=None, help='Default: None. File requests are logged to in batches '
+                        'from a background thread, instead of through logging')
+    parser.add_argument('--access-log-format', default='text', choices=AccessLog.FORMATS, help='Default: text. '
+                        'text or json lines')
+    parser.add_argument('--access-log-max-size', default='0', help='Default: 0. Size in MB beyond which the access '
+                        'log is rotated, 0 disables rotation')
+    parser.add_argument('--access-log-backups', default='5', help='Default: 5. Number of rotated access logs kept')
+    parser.add_argument('--gzip', action='store_true', default=False, help='Default: False. Compress responses '
+                        'on the fly for clients accepting gzip')
+    parser.add_argument('--gzip-types', default=','.join(text_(t) for t in Compression.TYPES), help='Default: %s. '
+                        'Comma separated content types compressed' % ','.join(text_(t) for t in Compression.TYPES))
+    parser.add_argument('--gzip-min-length', default='1024', help='Default: 1024. Bytes below which responses of '
+                        'known length are not compressed')
+    parser.add_argument('--gzip-level', default='6', help='Default: 6. Compression level from 1 (fastest) to 9')
+    parser.add_argument('--metrics-port', default=None, help='Default: None. Port of the admin endpoint serving '
+                        'request metrics of all workers at /metrics in Prometheus text format, on --hostname')
+    parser.add_argument('--reverse', action='append', default=None, help='Default: None. Serves as a reverse proxy '
+                        'route [host][/prefix]=host:port[,host:port], balancing requests for the host and path prefix '
+                        'across the backends. May be given multiple times')
+    parser.add_argument('--parent', default=None, help='Default: None. Parent proxies host:port[:weight]'
+                        '[,host:port[:weight]] requests are chained through, weighted round-robin by default')
+    parser.add_argument('--balance', default=BackendPool.ROUND_ROBIN, choices=BackendPool.BALANCERS,
+                        help='Default: round-robin. Method by which requests are balanced across backends or '
+                        'parents, consistent-hash keeping clients to one by their address')
+    parser.add_argument('--max-fails', default='3', help='Default: 3. Consecutive failures after which a backend '
+                        'or parent is ejected from balancing')
+    parser.add_argument('--fail-timeout', default='30', help='Default: 30. Seconds for which failed backends and '
+                        'parents are ejected, before a single request probes whether they recovered')
     args = parser.parse_args()
     
+    if args.engine == ENGINE_ASYNCIO:
+        unsupported = ['--' + name.replace('_', '-') for name, value in sorted(vars(args).items())
+                       if name not in ASYNCIO_OPTIONS and value != parser.get_default(name)]
+        if unsupported:
+            parser.error('%s not supported with --engine asyncio' % ', '.join(unsupported))
+    
     logging.basicConfig(level=getattr(logging, args.log_level), format='%(asctime)s - %(levelname)s - pid:%(process)d - %(message)s')
     
     hostname = args.hostname
     port = int(args.port)
+    access_log = None
     
     try:
-        proxy = HTTP(hostname, port)
+        if args.engine == ENGINE_ASYNCIO:
+            proxy = AsyncHTTP(hostname, port, connect_timeout=float(args.connect_timeout),
+                              inactivity_timeout=float(args.idle_timeout))
+        else:
+            pool = None
+            if int(args.upstream_max_idle) > 0:
+                pool = ConnectionPool(int(args.upstream_max_idle), int(args.upstream_idle_timeout))
+            resolver = Resolver(int(args.dns_cache_size), int(args.dns_ttl), int(args.dns_negative_ttl),
+                                int(args.dns_workers))
+            cache = None
+            if int(args.cache_size) > 0:
+                disk = None
+                if args.cache_dir:
+                    disk = DiskCache(args.cache_dir, int(args.cache_disk_size) * 1024 * 1024,
+                                     int(args.cache_disk_max_object_size) * 1024 * 1024)
+                cache = ResponseCache(int(args.cache_size) * 1024 * 1024, int(args.cache_max_object_size) * 1024,
+                                      disk, float(args.cache_collapse_timeout))
+            if args.access_log:
+                access_log = AccessLog(args.access_log, args.access_log_format,
+                                       int(args.access_log_max_size) * 1024 * 1024, int(args.access_log_backups))
+                access_log.start()
+            compression = None
+            if args.gzip:
+                compression = Compression([bytes_(t.strip()) for t in args.gzip_types.split(',') if t.strip()],
+                                          int(args.gzip_min_length), int(args.gzip_level))
+            metrics = None
+            if args.metrics_port:
+                metrics = Metrics(max(int(args.workers), 1))
+                MetricsServer(metrics, hostname, int(args.metrics_port)).start()
+            router = None
+            if args.reverse:
+                router = Router()
+                for spec in args.reverse:
+                    host, prefix, addresses = Router.parse(spec)
+                    router.add(host, prefix, BackendPool(addresses, args.balance, int(args.max_fails),
+                                                         float(args.fail_timeout)))
+            parents = None
+            if args.parent:
+                parents = BackendPool(parse_addresses(args.parent), args.balance, int(args.max_fails),
+                                      float(args.fail_timeout))
+            admission = None
+            if int(args.max_connections) or int(args.max_connections_per_client):
+                admission = AdmissionControl(int(args.max_connections), int(args.max_connections_per_client),
+                                             int(args.max_pending_connections))
+            proxy = HTTP(hostname, port, engine=args.engine, workers=int(args.workers), reuse_port=args.reuse_port,
+                         resolver=resolver, admission=admission, metrics=metrics, access_log=access_log, pool=pool,
+                         max_requests=int(args.max_requests), splice=not args.disable_splice,
+                         connect_timeout=float(args.connect_timeout), cache=cache,
+                         high_watermark=int(args.high_watermark) * 1024, low_watermark=int(args.low_watermark) * 1024,
+                         first_byte_timeout=float(args.first_byte_timeout), idle_timeout=float(args.idle_timeout),
+                         total_timeout=float(args.total_timeout), compression=compression, router=router,
+                         parents=parents)
         proxy.run()
     except KeyboardInterrupt:
         pass
+    finally:
+        if access_log:
+            access_log.close()
 
 if __name__ == '__main__':
     main()
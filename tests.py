@@ -1,8 +1,26 @@
+import os
+import json
+import shutil
+import tempfile
 import unittest
+import socket
+import time
+import zlib
+import signal
+import select
+import threading
+import multiprocessing
 import proxy
 from proxy import *
 from proxy import bytes_, text_
 
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
 
 class TestChunkParser(unittest.TestCase):
 
@@ -25,6 +43,26 @@ class TestChunkParser(unittest.TestCase):
         self.assertEqual(self.parser.body, b'Wikipedia in\r\n\r\nchunks.')
         self.assertEqual(self.parser.state, CHUNK_PARSER_STATE_COMPLETE)
 
+    def test_chunk_parse_byte_by_byte(self):
+        data = b'4\r\nWiki\r\n5;ext=1\r\npedia\r\n0\r\n\r\nHTTP'
+        leftover = b''
+        for i in range(len(data)):
+            leftover += self.parser.parse(data[i:i + 1])
+        self.assertEqual(self.parser.body, b'Wikipedia')
+        self.assertEqual(self.parser.state, CHUNK_PARSER_STATE_COMPLETE)
+        self.assertEqual(leftover, b'HTTP')
+
+    def test_chunk_parse_trailers(self):
+        leftover = self.parser.parse(b'4\r\nWiki\r\n0\r\nX-Checksum: 1\r\nX-Other: 2\r\n\r\nHTTP')
+        self.assertEqual(self.parser.body, b'Wiki')
+        self.assertEqual(self.parser.trailers, [b'X-Checksum: 1', b'X-Other: 2'])
+        self.assertEqual(self.parser.state, CHUNK_PARSER_STATE_COMPLETE)
+        self.assertEqual(leftover, b'HTTP')
+
+    def test_negative_chunk_size(self):
+        self.parser.parse(b'4\r\nWiki\r\n')
+        self.assertRaises(ValueError, self.parser.parse, b'-4\r\npedia\r\n')
+
 class TestHttpParser(unittest.TestCase):
 
     def setUp(self):
@@ -49,6 +87,15 @@ class TestHttpParser(unittest.TestCase):
     def test_build_url_none(self):
         self.assertEqual(self.parser.build_url(), b'/None')
 
+    def test_build_url_absolute(self):
+        self.parser.parse(b'GET /path?a=b HTTP/1.1\r\nHost: example.com:8080\r\n\r\n')
+        self.assertEqual(self.parser.build_url(absolute=True), b'http://example.com:8080/path?a=b')
+        self.assertEqual(self.parser.build_line(absolute=True), b'GET http://example.com:8080/path?a=b HTTP/1.1')
+        
+        parser = HttpParser()
+        parser.parse(b'CONNECT example.com:443 HTTP/1.1\r\n\r\n')
+        self.assertEqual(parser.build_url(absolute=True), b'example.com:443')
+    
     def test_line_rcvd_to_rcving_headers_state_change(self):
         self.parser.parse(b"GET http://localhost HTTP/1.1")
         self.assertEqual(self.parser.state, HTTP_PARSER_STATE_INITIALIZED)
@@ -223,6 +270,86 @@ class TestHttpParser(unittest.TestCase):
         self.assertEqual(self.parser.body, b'Wikipedia in\r\n\r\nchunks.')
         self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
 
+    def test_response_without_body_completes_at_headers(self):
+        self.parser.type = HTTP_RESPONSE_PARSER
+        self.parser.parse(b'HTTP/1.1 304 Not Modified\r\nETag: "x"\r\n\r\n')
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
+        
+        parser = HttpParser(HTTP_RESPONSE_PARSER)
+        parser.method = b'HEAD'
+        parser.parse(b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n')
+        self.assertEqual(parser.state, HTTP_PARSER_STATE_COMPLETE)
+        
+        parser = HttpParser(HTTP_RESPONSE_PARSER)
+        parser.method = b'CONNECT'
+        parser.parse(b'HTTP/1.1 200 Connection established\r\nProxy-Agent: parent\r\n\r\n')
+        self.assertEqual(parser.state, HTTP_PARSER_STATE_COMPLETE)
+
+    def test_is_keep_alive(self):
+        self.parser.parse(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        self.assertTrue(self.parser.is_keep_alive())
+        
+        parser = HttpParser()
+        parser.parse(b'GET / HTTP/1.1\r\nConnection: Close\r\n\r\n')
+        self.assertFalse(parser.is_keep_alive())
+        
+        parser = HttpParser()
+        parser.parse(b'GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n')
+        self.assertTrue(parser.is_keep_alive())
+
+    def test_pipelined_request_left_in_buffer(self):
+        self.parser.parse(CRLF.join([
+            b'POST http://localhost/ HTTP/1.1',
+            b'Content-Length: 3',
+            CRLF
+        ]) + b'a=bGET http://localhost/ HTTP/1.1' + CRLF)
+        self.assertEqual(self.parser.state, HTTP_PARSER_STATE_COMPLETE)
+        self.assertEqual(self.parser.body, b'a=b')
+        self.assertEqual(self.parser.buffer, b'GET http://localhost/ HTTP/1.1' + CRLF)
+
+    def test_parse_byte_by_byte(self):
+        raw = CRLF.join([
+            b'HTTP/1.1 200 OK',
+            b'Transfer-Encoding: chunked',
+            b'Set-Cookie: a=1',
+            b'Set-Cookie: b=2',
+            CRLF
+        ]) + b'4\r\nWiki\r\n0\r\n\r\n'
+        parser = HttpParser(HTTP_RESPONSE_PARSER, keep_raw=True)
+        for i in range(len(raw)):
+            parser.parse(raw[i:i + 1])
+        self.assertEqual(parser.state, HTTP_PARSER_STATE_COMPLETE)
+        self.assertEqual(parser.header_list[1:], [(b'Set-Cookie', b'a=1'), (b'Set-Cookie', b'b=2')])
+        self.assertEqual(parser.body, b'Wiki')
+        self.assertEqual(parser.received, len(raw))
+        self.assertEqual(parser.head_size, raw.find(CRLF * 2) + len(CRLF * 2))
+        self.assertEqual(parser.raw, raw)
+        self.assertEqual(parser.buffer, b'')
+
+    def test_stream_passes_body_to_callback(self):
+        received = []
+        parser = HttpParser(HTTP_RESPONSE_PARSER, stream=True, on_body=lambda data: received.append(bytes(data)))
+        parser.parse(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n4\r\nWi')
+        parser.parse(b'ki\r\n5\r\npedia\r\n0\r\n\r\n')
+        self.assertEqual(parser.state, HTTP_PARSER_STATE_COMPLETE)
+        self.assertEqual(b''.join(received), b'Wikipedia')
+        self.assertEqual(parser.body_size, 9)
+        self.assertEqual(parser.body, None)
+        
+        parser = HttpParser(HTTP_RESPONSE_PARSER, stream=True)
+        parser.parse(b'HTTP/1.1 200 OK\r\nContent-Length: 1048576\r\n\r\n')
+        for _ in range(256):
+            parser.parse(b'x' * 4096)
+        self.assertEqual(parser.state, HTTP_PARSER_STATE_COMPLETE)
+        self.assertEqual(parser.body_size, 1048576)
+        self.assertEqual(parser.body, None)
+        self.assertEqual(parser.buffer, b'')
+
+    def test_raw_not_retained_by_default(self):
+        self.parser.parse(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        self.assertEqual(self.parser.raw, b'')
+        self.assertEqual(self.parser.received, 35)
+
 class MockConnection(object):
     
     def __init__(self, buffer=b''):
@@ -239,6 +366,64 @@ class MockConnection(object):
     def queue(self, data):
         self.buffer += data
 
+class TestConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.conn = Connection(b'client')
+        self.conn.conn = self.ours
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def test_queue_and_partial_flush(self):
+        self.conn.conn = MockConnection()
+        self.conn.conn.send = lambda data: min(len(data), 3)
+        self.conn.queue(b'hello')
+        self.conn.queue(b'')
+        self.conn.queue(b'world')
+        self.assertEqual(self.conn.buffer_size(), 10)
+        self.conn.flush()
+        self.assertEqual(self.conn.buffer, b'loworld')
+        self.conn.flush()
+        self.assertEqual(self.conn.buffer, b'world')
+        self.assertEqual(self.conn.buffer_size(), 5)
+
+    def test_flush_sends_multiple_segments(self):
+        for data in (b'a', b'b' * 100, b'c'):
+            self.conn.queue(data)
+        self.conn.flush()
+        self.assertFalse(self.conn.has_buffer())
+        self.assertEqual(self.theirs.recv(1024), b'a' + b'b' * 100 + b'c')
+
+    def test_recv_view_returns_pooled_buffer_once_flushed(self):
+        size = proxy.buffer_pool.size
+        self.theirs.sendall(b'x' * size)
+        view = self.conn.recv_view()
+        self.assertEqual(len(view), size)
+        self.assertTrue(isinstance(view.obj, bytearray))
+        
+        peer = Connection(b'server')
+        peer.conn = self.theirs
+        peer.queue(view)
+        free = len(proxy.buffer_pool.free)
+        peer.flush()
+        while peer.has_buffer():
+            self.ours.recv(size)
+            peer.flush()
+        self.assertEqual(len(proxy.buffer_pool.free), free + 1)
+
+    def test_congested_until_drained_below_low_watermark(self):
+        self.conn.queue(b'x' * 100)
+        self.assertFalse(self.conn.is_congested(100, 50))
+        self.conn.queue(b'x')
+        self.assertTrue(self.conn.is_congested(100, 50))
+        self.conn._consume(50)
+        self.assertTrue(self.conn.is_congested(100, 50))
+        self.conn._consume(1)
+        self.assertFalse(self.conn.is_congested(100, 50))
+
 class TestProxy(unittest.TestCase):
 
     def setUp(self):
@@ -246,6 +431,13 @@ class TestProxy(unittest.TestCase):
         self._addr = ('127.0.0.1', 54382)
         self.proxy = Proxy(Client(self._conn, self._addr))
 
+    def wait_connected(self):
+        """Drives non-blocking connect, leaving server connection blocking."""
+        while self.proxy.server.is_connecting():
+            r, w, x = select.select([], self.proxy.server.attempts, [], self.proxy.server.next_timeout())
+            self.proxy._process_connect(w)
+        self.proxy.server.conn.setblocking(True)
+
     def test_http_get(self):
         self.proxy.client.conn.queue(b"GET http://httpbin.org/get HTTP/1.1" + CRLF)
         self.proxy._process_request(self.proxy.client.recv())
@@ -263,6 +455,7 @@ class TestProxy(unittest.TestCase):
         self.assertEqual(self.proxy.request.state, HTTP_PARSER_STATE_COMPLETE)
         self.assertEqual(self.proxy.server.addr, (b"httpbin.org", 80))
         
+        self.wait_connected()
         self.proxy.server.flush()
         self.assertEqual(self.proxy.server.buffer_size(), 0)
         
@@ -286,6 +479,7 @@ class TestProxy(unittest.TestCase):
         ]))
         self.proxy._process_request(self.proxy.client.recv())
         self.assertFalse(self.proxy.server == None)
+        self.wait_connected()
         self.assertEqual(self.proxy.client.buffer, self.proxy.connection_established_pkt)
         
         parser = HttpParser(HTTP_RESPONSE_PARSER)
@@ -325,5 +519,1847 @@ class TestProxy(unittest.TestCase):
                 CRLF
             ]))
 
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def do_GET(self):
+        body = b'hello world'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class LocalOrigin(object):
+    """Serves OriginHandler on an ephemeral local port in a thread."""
+    
+    def __init__(self, handler=OriginHandler):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+    
+    def __enter__(self):
+        self.thread.start()
+        return self
+    
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+def proxy_pair():
+    """Returns a (Proxy, client side socket) pair connected via socketpair."""
+    ours, theirs = socket.socketpair()
+    return Proxy(Client(ours, ('127.0.0.1', 0))), theirs
+
+def read_response(sock, loop=None, timeout=5, until=HTTP_PARSER_STATE_COMPLETE):
+    parser = HttpParser(HTTP_RESPONSE_PARSER)
+    sock.settimeout(0 if loop else timeout)
+    deadline = time.time() + timeout
+    while parser.state < until and time.time() < deadline:
+        if loop:
+            loop.poll(0.05)
+        try:
+            data = sock.recv(8192)
+        except socket.error:
+            continue
+        if not data:
+            break
+        parser.parse(data)
+    return parser
+
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_multiplexes_proxies(self):
+        with LocalOrigin() as origin:
+            pairs = [proxy_pair() for _ in range(3)]
+            for p, sock in pairs:
+                self.loop.add(p)
+                sock.sendall(CRLF.join([
+                    b'GET http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+                    b'Host: 127.0.0.1',
+                    CRLF
+                ]))
+            for p, sock in pairs:
+                response = read_response(sock, self.loop)
+                self.assertEqual(response.code, b'200')
+                self.assertEqual(response.body, b'hello world')
+                sock.close()
+            for _ in range(10):
+                self.loop.poll(0.01)
+            self.assertEqual(len(self.loop.proxies), 0)
+
+    def test_client_close_removes_proxy(self):
+        p, sock = proxy_pair()
+        self.loop.add(p)
+        sock.close()
+        self.loop.poll(0.1)
+        self.assertEqual(len(self.loop.proxies), 0)
+        self.assertTrue(p.client.closed)
+
+    def add(self, **kwargs):
+        ours, theirs = socket.socketpair()
+        p = Proxy(Client(ours, ('127.0.0.1', 0)), **kwargs)
+        self.loop.add(p)
+        return p, theirs
+    
+    def test_sleeps_until_nearest_deadline(self):
+        first, first_sock = self.add(idle_timeout=0.2)
+        second, second_sock = self.add(idle_timeout=0.4)
+        start = time.time()
+        self.loop.poll()
+        self.assertAlmostEqual(time.time() - start, 0.2, delta=0.1)
+        self.assertNotIn(first, self.loop.proxies)
+        self.assertIn(second, self.loop.proxies)
+        self.loop.poll()
+        self.assertAlmostEqual(time.time() - start, 0.4, delta=0.1)
+        self.assertEqual(len(self.loop.proxies), 0)
+        self.assertEqual(first_sock.recv(1), b'')
+    
+    def test_activity_postpones_idle_timeout(self):
+        p, sock = self.add(idle_timeout=0.3)
+        start = time.time()
+        self.loop.poll(0.2)
+        sock.sendall(b'GET http://127.0.0.1/ HTTP/1.1\r\n')
+        while p in self.loop.proxies:
+            self.loop.poll()
+        self.assertAlmostEqual(time.time() - start, 0.5, delta=0.1)
+        self.assertEqual(len(self.loop.heap), 0)
+    
+    def test_total_timeout(self):
+        p, sock = self.add(total_timeout=0.2)
+        start = time.time()
+        self.loop.poll()
+        self.assertAlmostEqual(time.time() - start, 0.2, delta=0.1)
+        self.assertEqual(len(self.loop.proxies), 0)
+    
+    def test_first_byte_timeout_responds_with_gateway_timeout(self):
+        silent = socket.socket()
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(1)
+        try:
+            p, sock = self.add(first_byte_timeout=0.2)
+            sock.sendall(CRLF.join([
+                b'GET http://127.0.0.1:%d/ HTTP/1.1' % silent.getsockname()[1],
+                b'Host: 127.0.0.1',
+                CRLF
+            ]))
+            self.assertEqual(read_response(sock, self.loop).code, b'504')
+            self.assertEqual(len(self.loop.proxies), 0)
+        finally:
+            silent.close()
+
+    def test_first_byte_timeout_starts_once_request_is_complete(self):
+        with LocalOrigin() as origin:
+            p, sock = self.add(first_byte_timeout=0.2)
+            sock.sendall(CRLF.join([
+                b'PUT http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+                b'Host: 127.0.0.1',
+                b'Content-Length: 10',
+                CRLF
+            ]))
+            # upload takes longer than first byte timeout
+            for chunk in (b'01', b'23', b'45', b'67', b'89'):
+                deadline = time.time() + 0.1
+                while time.time() < deadline:
+                    self.loop.poll(0.01)
+                sock.sendall(chunk)
+            response = read_response(sock, self.loop)
+        self.assertEqual(response.code, b'200')
+        self.assertEqual(response.body, b'0123456789')
+
+class TestPersistentConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def request(self, port, headers=None):
+        return CRLF.join([
+            b'GET http://127.0.0.1:%d/ HTTP/1.1' % port,
+            b'Host: 127.0.0.1'
+        ] + (headers or []) + [CRLF])
+
+    def read_all(self, sock):
+        sock.settimeout(0)
+        data = b''
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            self.loop.poll(0.01)
+            try:
+                chunk = sock.recv(8192)
+            except socket.error:
+                continue
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_pipelined_requests(self):
+        with LocalOrigin() as origin:
+            p, sock = proxy_pair()
+            self.loop.add(p)
+            sock.sendall(self.request(origin.port) * 2 + self.request(origin.port, [b'Connection: close']))
+            data = self.read_all(sock)
+        self.assertEqual(data.count(b'HTTP/1.1 200 OK'), 3)
+        self.assertEqual(data.count(b'hello world'), 3)
+        self.assertEqual(data.count(b'Connection: keep-alive'), 2)
+        self.assertTrue(data.endswith(b'Connection: close\r\n\r\nhello world'))
+        self.assertEqual(p.requests_served, 2)
+
+    def test_max_requests(self):
+        with LocalOrigin() as origin:
+            ours, theirs = socket.socketpair()
+            self.loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), max_requests=2))
+            theirs.sendall(self.request(origin.port) * 3)
+            data = self.read_all(theirs)
+        self.assertEqual(data.count(b'HTTP/1.1 200 OK'), 2)
+        self.assertEqual(data.count(b'Connection: close'), 1)
+
+    def test_request_body_streamed_once_headers_complete(self):
+        with LocalOrigin() as origin:
+            p, sock = proxy_pair()
+            self.loop.add(p)
+            sock.sendall(CRLF.join([
+                b'PUT http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+                b'Host: 127.0.0.1',
+                b'Content-Length: 10',
+                CRLF
+            ]) + b'01234')
+            for _ in range(10):
+                self.loop.poll(0.01)
+            self.assertIsNotNone(p.server)
+            self.assertEqual(p.request.state, HTTP_PARSER_STATE_RCVING_BODY)
+            self.assertEqual(p.request.body, None)
+            
+            sock.sendall(b'56789' + self.request(origin.port, [b'Connection: close']))
+            data = self.read_all(sock)
+        self.assertEqual(data.count(b'HTTP/1.1 200 OK'), 2)
+        self.assertIn(b'\r\n\r\n0123456789HTTP/1.1', data)
+        self.assertTrue(data.endswith(b'hello world'))
+
+    def test_request_body_after_100_continue(self):
+        with LocalOrigin() as origin:
+            p, sock = proxy_pair()
+            self.loop.add(p)
+            sock.sendall(CRLF.join([
+                b'PUT http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+                b'Host: 127.0.0.1',
+                b'Connection: close',
+                b'Content-Length: 10',
+                b'Expect: 100-continue',
+                CRLF
+            ]))
+            parser = read_response(sock, self.loop, until=HTTP_PARSER_STATE_HEADERS_COMPLETE)
+            self.assertEqual(parser.code, b'100')
+            self.assertEqual(parser.state, HTTP_PARSER_STATE_COMPLETE)
+            
+            sock.sendall(b'0123456789')
+            data = parser.buffer + self.read_all(sock)
+        self.assertTrue(data.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(data.endswith(b'\r\n\r\n0123456789'))
+
+    def test_chunked_response_with_trailers(self):
+        class TrailersHandler(OriginHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                self.wfile.write(b'5\r\nhello\r\n0\r\nX-Checksum: 1\r\n\r\n')
+        
+        with LocalOrigin(TrailersHandler) as origin:
+            p, sock = proxy_pair()
+            self.loop.add(p)
+            sock.sendall(self.request(origin.port) + self.request(origin.port, [b'Connection: close']))
+            data = self.read_all(sock)
+        self.assertEqual(data.count(b'0\r\nX-Checksum: 1\r\n\r\nHTTP/1.1 200 OK'), 1)
+        self.assertTrue(data.endswith(b'0\r\nX-Checksum: 1\r\n\r\n'))
+
+    def test_server_not_read_while_client_congested(self):
+        class LargeBodyHandler(OriginHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', str(1024 * 1024))
+                self.end_headers()
+                for _ in range(64):
+                    self.wfile.write(b'x' * 16384)
+        
+        with LocalOrigin(LargeBodyHandler) as origin:
+            ours, theirs = socket.socketpair()
+            p = Proxy(Client(ours, ('127.0.0.1', 0)), high_watermark=16384, low_watermark=4096)
+            self.loop.add(p)
+            theirs.sendall(self.request(origin.port, [b'Connection: close']))
+            for _ in range(50):
+                self.loop.poll(0.01)
+            self.assertTrue(p.client.congested)
+            self.assertLessEqual(p.client.buffer_size(), 16384 + 8192)
+            self.assertNotIn(p.server.conn, p._get_waitable_lists()[0])
+            
+            data = self.read_all(theirs)
+        self.assertTrue(data.endswith(b'\r\n\r\n' + b'x' * 1024 * 1024))
+
+class LocalEcho(object):
+    """Echoes data back on an ephemeral local port in a thread."""
+    
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+    
+    def serve(self):
+        conn, addr = self.listener.accept()
+        data = conn.recv(65536)
+        while data:
+            conn.sendall(data)
+            data = conn.recv(65536)
+        conn.close()
+    
+    def __enter__(self):
+        self.thread.start()
+        return self
+    
+    def __exit__(self, *args):
+        self.listener.close()
+
+class TestTunnel(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.running = True
+        self.thread = threading.Thread(target=self.run_loop)
+        self.thread.daemon = True
+
+    def run_loop(self):
+        while self.running or self.loop.proxies:
+            self.loop.poll(0.01)
+
+    def tearDown(self):
+        self.running = False
+        self.thread.join()
+        self.loop.close()
+
+    def relay(self, splice):
+        with LocalEcho() as echo:
+            ours, sock = socket.socketpair()
+            p = Proxy(Client(ours, ('127.0.0.1', 0)), splice=splice)
+            self.loop.add(p)
+            self.thread.start()
+            sock.sendall(CRLF.join([
+                b'CONNECT 127.0.0.1:%d HTTP/1.1' % echo.port,
+                b'Host: 127.0.0.1',
+                CRLF
+            ]))
+            self.assertEqual(read_response(sock, until=HTTP_PARSER_STATE_HEADERS_COMPLETE).code, b'200')
+            sock.settimeout(None)
+            
+            payload = os.urandom(1024 * 1024)
+            sender = threading.Thread(target=sock.sendall, args=(payload,))
+            sender.start()
+            received = b''
+            while len(received) < len(payload):
+                data = sock.recv(65536)
+                if not data:
+                    break
+                received += data
+            sender.join()
+            sock.close()
+        self.assertEqual(received, payload)
+        self.assertTrue(p.relaying)
+        return p
+
+    @unittest.skipUnless(proxy.HAS_SPLICE, 'os.splice is not available')
+    def test_splice_relay(self):
+        p = self.relay(splice=True)
+        self.assertNotEqual(p.splicers, None)
+
+    def test_user_space_relay(self):
+        p = self.relay(splice=False)
+        self.assertEqual(p.splicers, None)
+
+@unittest.skipUnless(proxy.HAS_SPLICE, 'os.splice is not available')
+class TestSplicer(unittest.TestCase):
+
+    def test_splice_to_closed_peer(self):
+        src, src_peer = socket.socketpair()
+        dst, dst_peer = socket.socketpair()
+        splicer = Splicer(src, dst)
+        try:
+            src_peer.sendall(b'data')
+            dst_peer.close()
+            splicer.fill()
+            splicer.drain()
+            self.assertTrue(splicer.broken)
+        finally:
+            splicer.close()
+            for sock in (src, src_peer, dst):
+                sock.close()
+
+    def test_pipes_drained_once_client_closes(self):
+        client, client_peer = socket.socketpair()
+        server, server_peer = socket.socketpair()
+        p = Proxy(Client(client, ('127.0.0.1', 0)))
+        p.server = Server(b'127.0.0.1', 0)
+        p.server.conn = server
+        p.tunnel = True
+        p._start_relay()
+        try:
+            # client doesn't read for now, response stays in the pipe
+            filler = b''
+            while True:
+                try:
+                    filler += b'x' * client.send(b'x' * 65536)
+                except socket.error:
+                    break
+            server_peer.sendall(b'response')
+            self.assertFalse(p._process_splice([server], []))
+            self.assertTrue(p.splicers[1].pending)
+            
+            client_peer.sendall(b'request')
+            client_peer.shutdown(socket.SHUT_WR)
+            self.assertFalse(p._process_splice([client], []))
+            self.assertFalse(p._process_splice([client], []))
+            self.assertEqual(server_peer.recv(1024), b'request')
+            
+            received = b''
+            while len(received) < len(filler):
+                received += client_peer.recv(65536)
+            self.assertTrue(p._process_splice([], [client]))
+            received += client_peer.recv(65536)
+            self.assertEqual(received, filler + b'response')
+        finally:
+            p._shutdown()
+            for sock in (client_peer, server_peer):
+                sock.close()
+
+class Blackhole(object):
+    """Listener whose accept queue is kept full, connections to it hang."""
+    
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(0)
+        self.port = self.listener.getsockname()[1]
+        self.filler = socket.create_connection(('127.0.0.1', self.port))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.filler.close()
+        self.listener.close()
+
+class TestServerConnect(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+
+    def connect(self, addresses, timeout=5, attempt_delay=0.1):
+        server = Server(b'localhost', 80)
+        server.start_connect(addresses, timeout, attempt_delay)
+        while not server.process_connect(select.select([], server.attempts, [], server.next_timeout())[1]):
+            pass
+        return server
+
+    def test_attempts_next_address_after_delay(self):
+        with Blackhole() as blackhole:
+            start = time.time()
+            server = self.connect([(socket.AF_INET, ('127.0.0.1', blackhole.port)),
+                                   (socket.AF_INET, ('127.0.0.1', self.port))])
+            self.assertGreaterEqual(time.time() - start, 0.1)
+            self.assertEqual(server.conn.getpeername()[1], self.port)
+            self.assertEqual(server.attempts, [])
+            server.close()
+
+    def test_attempts_next_address_once_refused(self):
+        refused = socket.socket()
+        refused.bind(('127.0.0.1', 0))
+        port = refused.getsockname()[1]
+        refused.close()
+        start = time.time()
+        server = self.connect([(socket.AF_INET, ('127.0.0.1', port)),
+                               (socket.AF_INET, ('127.0.0.1', self.port))], attempt_delay=5)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(server.conn.getpeername()[1], self.port)
+        server.close()
+        
+        with self.assertRaises(socket.error):
+            self.connect([(socket.AF_INET, ('127.0.0.1', port))])
+
+    def test_interleaves_address_families(self):
+        v6 = [(socket.AF_INET6, ('::1', port, 0, 0)) for port in (1, 2, 3)]
+        v4 = [(socket.AF_INET, ('127.0.0.1', port)) for port in (4, 5)]
+        self.assertEqual(Server.interleave_families(v6 + v4), [v6[0], v4[0], v6[1], v4[1], v6[2]])
+        self.assertEqual(Server.interleave_families(v4[:1] + v6[:2]), [v4[0], v6[0], v6[1]])
+
+    def test_proxy_responds_with_gateway_timeout(self):
+        loop = EventLoop()
+        try:
+            with Blackhole() as blackhole:
+                ours, theirs = socket.socketpair()
+                loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), connect_timeout=0.2))
+                theirs.sendall(b'GET http://127.0.0.1:%d/ HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n' % blackhole.port)
+                start = time.time()
+                self.assertEqual(read_response(theirs, loop).code, b'504')
+                self.assertLess(time.time() - start, 2)
+        finally:
+            loop.close()
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool(max_idle=1, idle_timeout=30)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def server(self):
+        ours, theirs = socket.socketpair()
+        server = Server(b'localhost', 80)
+        server.conn = ours
+        return server, theirs
+
+    def test_acquire_reuses_released_connection(self):
+        server, peer = self.server()
+        self.assertEqual(self.pool.acquire(b'localhost', 80), None)
+        self.pool.release(server)
+        self.assertEqual(self.pool.acquire(b'localhost', 80), server)
+        self.assertEqual(self.pool.acquire(b'localhost', 80), None)
+        peer.close()
+
+    def test_acquire_skips_closed_and_expired_connections(self):
+        server, peer = self.server()
+        self.pool.release(server)
+        peer.close()
+        self.assertEqual(self.pool.acquire(b'localhost', 80), None)
+        self.assertTrue(server.closed)
+        
+        server, peer = self.server()
+        self.pool.pools[server.addr] = [(server, monotonic() - 60)]
+        self.assertEqual(self.pool.acquire(b'localhost', 80), None)
+        self.assertTrue(server.closed)
+        peer.close()
+
+    def test_release_closes_connections_beyond_max_idle(self):
+        first, first_peer = self.server()
+        second, second_peer = self.server()
+        self.pool.release(first)
+        self.pool.release(second)
+        self.assertFalse(first.closed)
+        self.assertTrue(second.closed)
+        first_peer.close()
+        second_peer.close()
+
+    def test_proxy_reuses_pooled_connection(self):
+        loop = EventLoop()
+        connections = []
+        
+        class CountingHandler(OriginHandler):
+            def setup(self):
+                connections.append(self.client_address)
+                OriginHandler.setup(self)
+        
+        with LocalOrigin(CountingHandler) as origin:
+            for _ in range(3):
+                ours, theirs = socket.socketpair()
+                loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), pool=self.pool))
+                theirs.sendall(CRLF.join([
+                    b'GET http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+                    b'Host: 127.0.0.1',
+                    CRLF
+                ]))
+                self.assertEqual(read_response(theirs, loop).body, b'hello world')
+                theirs.close()
+                while loop.proxies:
+                    loop.poll(0.01)
+        loop.close()
+        self.assertEqual(len(connections), 1)
+
+class TestResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.queries = []
+        self.unblock = threading.Event()
+        self.unblock.set()
+        self.resolver = Resolver(max_size=2, ttl=60, negative_ttl=60, workers=2, getaddrinfo=self.getaddrinfo)
+
+    def tearDown(self):
+        self.unblock.set()
+        self.resolver.close()
+
+    def getaddrinfo(self, host, port, family, type):
+        self.queries.append(host)
+        self.unblock.wait(5)
+        if host == 'unknown.test':
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return [(socket.AF_INET, type, 6, '', ('127.0.0.1', port))]
+
+    def wait_completed(self, results):
+        deadline = time.time() + 5
+        while not results and time.time() < deadline:
+            select.select([self.resolver], [], [], 0.1)
+            self.resolver.process_completed()
+
+    def test_lookup_caches_addresses_and_failures(self):
+        self.assertEqual(self.resolver.lookup(b'origin.test', 80), ([(socket.AF_INET, ('127.0.0.1', 80))], None))
+        self.assertEqual(self.resolver.lookup(b'origin.test', 80), ([(socket.AF_INET, ('127.0.0.1', 80))], None))
+        addresses, error = self.resolver.lookup(b'unknown.test', 80)
+        self.assertIsNone(addresses)
+        self.assertIsInstance(error, socket.gaierror)
+        self.resolver.lookup(b'unknown.test', 80)
+        self.assertEqual(self.queries, ['origin.test', 'unknown.test'])
+        self.assertEqual((self.resolver.hits, self.resolver.misses), (2, 2))
+
+    def test_least_recently_used_and_expired_entries_are_dropped(self):
+        self.resolver.lookup(b'a.test', 80)
+        self.resolver.lookup(b'b.test', 80)
+        self.resolver.lookup(b'a.test', 80)
+        self.resolver.lookup(b'c.test', 80)
+        self.assertEqual(list(self.resolver.cache), [(b'a.test', 80), (b'c.test', 80)])
+        
+        expires_at, result = self.resolver.cache[(b'a.test', 80)]
+        self.resolver.cache[(b'a.test', 80)] = (expires_at - 61, result)
+        self.resolver.lookup(b'a.test', 80)
+        self.assertEqual(self.queries, ['a.test', 'b.test', 'c.test', 'a.test'])
+
+    def test_resolve_coalesces_concurrent_lookups(self):
+        self.resolver.start()
+        self.unblock.clear()
+        results = []
+        self.assertIsNone(self.resolver.resolve(b'origin.test', 80, lambda *result: results.append(result)))
+        self.assertIsNone(self.resolver.resolve(b'origin.test', 80, lambda *result: results.append(result)))
+        self.unblock.set()
+        self.wait_completed(results)
+        self.assertEqual(results, [([(socket.AF_INET, ('127.0.0.1', 80))], None)] * 2)
+        self.assertEqual(self.queries, ['origin.test'])
+        self.assertEqual(self.resolver.coalesced, 1)
+        self.assertEqual(self.resolver.resolve(b'origin.test', 80, None), results[0])
+
+    def test_proxy_connects_once_resolved(self):
+        self.resolver.start()
+        loop = EventLoop()
+        loop.add_reader(self.resolver, self.resolver.process_completed)
+        try:
+            with LocalOrigin() as origin:
+                for host, code in ((b'origin.test', b'200'), (b'unknown.test', b'502')):
+                    ours, theirs = socket.socketpair()
+                    p = Proxy(Client(ours, ('127.0.0.1', 0)), resolver=self.resolver)
+                    loop.add(p)
+                    theirs.sendall(CRLF.join([
+                        b'GET http://%s:%d/ HTTP/1.1' % (host, origin.port),
+                        b'Host: %s' % host,
+                        CRLF
+                    ]))
+                    self.assertEqual(read_response(theirs, loop).code, code)
+                    theirs.close()
+        finally:
+            loop.close()
+
+class CachingHandler(OriginHandler):
+    """Serves a cacheable response, 304 if validated by its ETag."""
+    
+    requests = []
+    
+    def do_GET(self):
+        self.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            return
+        body = b'cached body'
+        self.send_response(200)
+        self.send_header('Cache-Control', 'max-age=60')
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class SlowHandler(CachingHandler):
+    """Serves CachingHandler responses after a delay per request."""
+    
+    delays = []
+    
+    def do_GET(self):
+        time.sleep(self.delays.pop(0) if self.delays else 0)
+        CachingHandler.do_GET(self)
+
+class CacheTestCase(unittest.TestCase):
+    
+    def parse(self, type, data):
+        parser = HttpParser(type)
+        parser.parse(data)
+        return parser
+    
+    def request(self, path=b'/', headers=None):
+        return self.parse(HTTP_REQUEST_PARSER, CRLF.join([
+            b'GET http://origin.test%s HTTP/1.1' % path,
+            b'Host: origin.test'
+        ] + (headers or []) + [CRLF]))
+    
+    def response(self, headers, body=b'hello'):
+        return self.parse(HTTP_RESPONSE_PARSER, CRLF.join(
+            [b'HTTP/1.1 200 OK', b'Content-Length: %d' % len(body)] + headers + [CRLF]) + body)
+
+class TestResponseCache(CacheTestCase):
+    
+    def setUp(self):
+        self.cache = ResponseCache(max_size=1024, max_object_size=512)
+    
+    def test_fresh_and_stale_entries(self):
+        request = self.request()
+        self.cache.store(request, self.response([b'Cache-Control: max-age=60', b'ETag: "a"']), b'hello')
+        entry, fresh = self.cache.lookup(request)
+        self.assertTrue(fresh)
+        self.assertEqual(entry.body, b'hello')
+        
+        self.assertEqual(self.cache.lookup(self.request(headers=[b'Cache-Control: no-cache'])), (entry, False))
+        entry.stored_at -= 61
+        self.assertEqual(self.cache.lookup(request), (entry, False))
+        
+        self.cache.store(request, self.response([b'Cache-Control: max-age=0']), b'hello')
+        self.assertEqual(self.cache.lookup(request), (None, False))
+        self.assertEqual((self.cache.hits, self.cache.revalidations, self.cache.misses), (1, 2, 1))
+    
+    def test_uncacheable_responses_are_not_stored(self):
+        request = self.request()
+        for headers in ([], [b'Cache-Control: no-store, max-age=60'], [b'Cache-Control: private, max-age=60'],
+                        [b'Cache-Control: max-age=60', b'Set-Cookie: a=b'], [b'Cache-Control: max-age=60', b'Vary: *']):
+            self.cache.store(request, self.response(headers), b'hello')
+        self.cache.store(self.request(headers=[b'Authorization: Basic Zm9v']),
+                         self.response([b'Cache-Control: max-age=60']), b'hello')
+        self.cache.store(request, self.response([b'Cache-Control: max-age=60'], b'x' * 513), b'x' * 513)
+        self.assertEqual(len(self.cache.entries), 0)
+    
+    def test_entries_vary_on_request_headers(self):
+        for encoding in (b'gzip', b'identity'):
+            self.cache.store(self.request(headers=[b'Accept-Encoding: ' + encoding]),
+                             self.response([b'Cache-Control: max-age=60', b'Vary: Accept-Encoding'], encoding),
+                             encoding)
+        entry, fresh = self.cache.lookup(self.request(headers=[b'Accept-Encoding: identity']))
+        self.assertEqual(entry.body, b'identity')
+        self.assertEqual(self.cache.lookup(self.request()), (None, False))
+        
+        self.cache.invalidate(self.request())
+        self.assertEqual(len(self.cache.entries), 0)
+        self.assertEqual(self.cache.size, 0)
+    
+    def test_least_recently_used_entries_are_evicted(self):
+        for path in (b'/a', b'/b', b'/c'):
+            self.cache.store(self.request(path), self.response([b'Cache-Control: max-age=60'], b'x' * 400), b'x' * 400)
+            self.cache.lookup(self.request(b'/a'))
+        self.assertEqual([variant[0][3] for variant in self.cache.entries], [b'/c', b'/a'])
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertLessEqual(self.cache.size, 1024)
+    
+    def test_build_response(self):
+        request = self.request()
+        self.cache.store(request, self.response([b'Cache-Control: max-age=60', b'ETag: "a"',
+                                                 b'Connection: keep-alive']), b'hello')
+        entry, fresh = self.cache.lookup(request)
+        response = self.parse(HTTP_RESPONSE_PARSER, b''.join(self.cache.build_response(entry, request)))
+        self.assertEqual(response.code, b'200')
+        self.assertEqual(response.body, b'hello')
+        self.assertEqual(response.headers[b'age'][1], b'0')
+        self.assertNotIn(b'connection', response.headers)
+        
+        conditional = self.request(headers=[b'If-None-Match: W/"a"'])
+        response = self.parse(HTTP_RESPONSE_PARSER, b''.join(self.cache.build_response(entry, conditional)))
+        self.assertEqual(response.code, b'304')
+        self.assertEqual(response.headers[b'etag'][1], b'"a"')
+        self.assertNotIn(b'content-length', response.headers)
+    
+    def test_proxy_serves_and_revalidates_cached_responses(self):
+        CachingHandler.requests = []
+        loop = EventLoop()
+        try:
+            with LocalOrigin(CachingHandler) as origin:
+                def get():
+                    ours, theirs = socket.socketpair()
+                    loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), cache=self.cache))
+                    theirs.sendall(CRLF.join([
+                        b'GET http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+                        b'Host: 127.0.0.1',
+                        CRLF
+                    ]))
+                    response = read_response(theirs, loop)
+                    theirs.close()
+                    return response
+                
+                self.assertEqual(get().body, b'cached body')
+                self.assertEqual(get().body, b'cached body')
+                self.assertEqual(CachingHandler.requests, [None])
+                
+                for entry in self.cache.entries.values():
+                    entry.stored_at -= 61
+                response = get()
+                self.assertEqual((response.code, response.body), (b'200', b'cached body'))
+                self.assertEqual(CachingHandler.requests, [None, '"v1"'])
+                self.assertEqual(get().body, b'cached body')
+                self.assertEqual(len(CachingHandler.requests), 2)
+        finally:
+            loop.close()
+
+    def collapse(self, clients, delays):
+        CachingHandler.requests = []
+        SlowHandler.delays = delays
+        loop = EventLoop()
+        try:
+            with LocalOrigin(SlowHandler) as origin:
+                socks = []
+                for _ in range(clients):
+                    ours, theirs = socket.socketpair()
+                    loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), cache=self.cache))
+                    theirs.sendall(CRLF.join([
+                        b'GET http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+                        b'Host: 127.0.0.1',
+                        CRLF
+                    ]))
+                    socks.append(theirs)
+                    loop.poll(0)
+                for sock in socks:
+                    self.assertEqual(read_response(sock, loop).body, b'cached body')
+                    sock.close()
+        finally:
+            loop.close()
+    
+    def test_proxy_collapses_concurrent_requests(self):
+        self.collapse(5, [0.3])
+        self.assertEqual(CachingHandler.requests, [None])
+        self.assertEqual(self.cache.collapsed, 4)
+        self.assertEqual(self.cache.fetching, {})
+    
+    def test_collapsed_requests_fetch_once_waited_too_long(self):
+        self.cache.collapse_timeout = 0.2
+        self.collapse(3, [1])
+        self.assertEqual(CachingHandler.requests, [None] * 3)
+        self.assertEqual(self.cache.collapsed, 2)
+        self.assertEqual(self.cache.fetching, {})
+
+class LargeHandler(OriginHandler):
+    """Serves a cacheable body larger than kept in memory by the tests."""
+    
+    requests = 0
+    
+    def do_GET(self):
+        LargeHandler.requests += 1
+        body = b'x' * 4096
+        self.send_response(200)
+        self.send_header('Cache-Control', 'max-age=60')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class TestDiskCache(CacheTestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = self.open()
+    
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+    
+    def open(self, max_size=8192):
+        return ResponseCache(max_size=1024, max_object_size=512,
+                             disk=DiskCache(self.directory, max_size=max_size, max_object_size=4096))
+    
+    def store(self, path, size):
+        body = b'x' * size
+        self.cache.store(self.request(path), self.response([b'Cache-Control: max-age=60'], body), body)
+    
+    def test_large_bodies_are_served_from_disk(self):
+        self.store(b'/', 2048)
+        entry, fresh = self.cache.lookup(self.request())
+        self.assertTrue(fresh)
+        self.assertIsNone(entry.body)
+        self.assertEqual(self.cache.size, 0)
+        self.assertEqual(self.cache.disk.size, 2048)
+        
+        head, body = self.cache.build_response(entry, self.request())
+        self.assertIsInstance(body, memoryview)
+        self.assertEqual(body.tobytes(), b'x' * 2048)
+        self.assertIn(b'Content-Length: 2048\r\n', head)
+        
+        # replaced file stays mapped
+        self.store(b'/', 1024)
+        self.assertEqual(self.cache.lookup(self.request())[0].length, 1024)
+        self.assertEqual(body.tobytes(), b'x' * 2048)
+    
+    def test_entries_survive_restart(self):
+        self.store(b'/a', 100)
+        self.store(b'/b', 2048)
+        self.cache.close()
+        with open(os.path.join(self.directory, '.tmpcrashed'), 'w') as f:
+            f.write('partial')
+        
+        self.cache = self.open()
+        self.assertFalse(self.cache.loaded)
+        entry, fresh = self.cache.lookup(self.request(b'/a'))
+        self.assertTrue(fresh)
+        self.assertEqual(self.cache.build_response(entry, self.request(b'/a'))[1], b'x' * 100)
+        # small bodies read back are kept in memory
+        self.assertEqual(entry.body, b'x' * 100)
+        entry, fresh = self.cache.lookup(self.request(b'/b'))
+        self.assertEqual(entry.length, 2048)
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted([DiskCache.INDEX, DiskCache.LOCK] +
+                                                                    [e.path for e in self.cache.entries.values()]))
+    
+    def test_index_saved_on_first_store_and_flush(self):
+        def saved():
+            with open(os.path.join(self.directory, DiskCache.INDEX)) as f:
+                return [record['key'][3] for record in json.load(f)]
+        
+        self.store(b'/a', 100)
+        self.assertEqual(saved(), ['/a'])
+        self.store(b'/b', 100)
+        self.cache.flush()
+        self.assertEqual(saved(), ['/a'])
+        
+        self.cache.saved_at -= ResponseCache.INDEX_SAVE_INTERVAL
+        self.cache.flush()
+        self.assertEqual(saved(), ['/a', '/b'])
+    
+    def test_index_saved_on_sigterm(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        
+        with LocalOrigin(LargeHandler) as origin:
+            requests = [CRLF.join([
+                b'GET http://127.0.0.1:%d%s HTTP/1.1' % (origin.port, path),
+                b'Host: 127.0.0.1',
+                CRLF
+            ]) for path in (b'/a', b'/b')]
+            http = HTTP(port=port, engine=ENGINE_EVENTLOOP, cache=self.cache)
+            server = multiprocessing.Process(target=http.run)
+            server.start()
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                try:
+                    sock = socket.create_connection(('127.0.0.1', port))
+                    break
+                except socket.error:
+                    time.sleep(0.05)
+            sock.sendall(requests[0])
+            self.assertEqual(read_response(sock).body, b'x' * 4096)
+            sock.sendall(requests[1])
+            self.assertEqual(read_response(sock).body, b'x' * 4096)
+            sock.close()
+            
+            os.kill(server.pid, signal.SIGTERM)
+            server.join(5)
+        self.assertEqual(server.exitcode, 0)
+        
+        self.cache = self.open()
+        for request in requests:
+            self.assertTrue(self.cache.lookup(self.parse(HTTP_REQUEST_PARSER, request))[1])
+    
+    def test_truncated_bodies_are_dropped_on_load(self):
+        self.store(b'/a', 2048)
+        self.store(b'/b', 2048)
+        path = self.cache.lookup(self.request(b'/b'))[0].path
+        self.cache.close()
+        # as left by a crash before data reached the disk
+        with open(os.path.join(self.directory, path), 'r+b') as f:
+            f.truncate(1000)
+        
+        self.cache = self.open()
+        self.assertEqual(self.cache.lookup(self.request(b'/a'))[0].length, 2048)
+        self.assertIsNone(self.cache.lookup(self.request(b'/b'))[0])
+        self.assertNotIn(path, os.listdir(self.directory))
+        self.assertEqual(self.cache.disk.size, 2048)
+    
+    def test_least_recently_used_entries_are_evicted_from_disk(self):
+        for path in (b'/a', b'/b', b'/c'):
+            self.store(path, 3000)
+            self.cache.lookup(self.request(b'/a'))
+        self.assertEqual([variant[0][3] for variant in self.cache.entries], [b'/c', b'/a'])
+        self.assertEqual(self.cache.disk.size, 6000)
+        self.assertEqual(len(set(os.listdir(self.directory)) - set([DiskCache.INDEX, DiskCache.LOCK])), 2)
+    
+    def test_directory_is_used_by_one_process(self):
+        self.store(b'/', 100)
+        other = self.open()
+        other.store(self.request(), self.response([b'Cache-Control: max-age=60']), b'hello')
+        self.assertIsNone(other.disk)
+        self.assertEqual(len(other.entries), 1)
+        other.close()
+    
+    def test_proxy_caches_body_on_disk(self):
+        LargeHandler.requests = 0
+        loop = EventLoop()
+        try:
+            with LocalOrigin(LargeHandler) as origin:
+                for _ in range(2):
+                    ours, theirs = socket.socketpair()
+                    loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), cache=self.cache))
+                    theirs.sendall(CRLF.join([
+                        b'GET http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+                        b'Host: 127.0.0.1',
+                        CRLF
+                    ]))
+                    self.assertEqual(read_response(theirs, loop).body, b'x' * 4096)
+                    theirs.close()
+        finally:
+            loop.close()
+        self.assertEqual(LargeHandler.requests, 1)
+        self.assertEqual(self.cache.disk.size, 4096)
+        self.assertEqual(self.cache.hits, 1)
+
+class TestAdmissionControl(unittest.TestCase):
+    
+    def setUp(self):
+        self.admission = AdmissionControl(max_connections=2, max_per_client=2, max_pending=1)
+    
+    def client(self, host='127.0.0.1'):
+        return Client(None, (host, 0))
+    
+    def test_admits_queues_and_rejects(self):
+        first, second, third, fourth = [self.client('10.0.0.%d' % i) for i in range(4)]
+        self.assertEqual(self.admission.admit(first), AdmissionControl.ADMIT)
+        self.assertEqual(self.admission.admit(second), AdmissionControl.ADMIT)
+        self.assertEqual(self.admission.admit(third), AdmissionControl.QUEUE)
+        self.assertEqual(self.admission.admit(fourth), AdmissionControl.REJECT)
+        
+        self.assertIs(self.admission.release(first), third)
+        self.assertIsNone(self.admission.release(second))
+        self.assertEqual(self.admission.active, 1)
+        self.assertEqual((self.admission.admitted, self.admission.queued, self.admission.rejected), (3, 1, 1))
+    
+    def test_rejects_beyond_per_client_limit(self):
+        self.admission.max_connections = 0
+        clients = [self.client() for _ in range(3)]
+        self.assertEqual([self.admission.admit(client) for client in clients],
+                         [AdmissionControl.ADMIT, AdmissionControl.ADMIT, AdmissionControl.REJECT])
+        self.admission.release(clients[0])
+        self.assertEqual(self.admission.admit(self.client()), AdmissionControl.ADMIT)
+        self.assertEqual(self.admission.admit(self.client('127.0.0.2')), AdmissionControl.ADMIT)
+        self.assertEqual(self.admission.rejected_per_client, 1)
+    
+    def test_http_admits_queued_connection_once_one_closes(self):
+        http = HTTP(engine=ENGINE_EVENTLOOP, admission=AdmissionControl(max_connections=1, max_pending=1))
+        http.loop = EventLoop(on_close=http._closed)
+        try:
+            with LocalOrigin() as origin:
+                socks = []
+                for _ in range(3):
+                    ours, theirs = socket.socketpair()
+                    http.handle(Client(ours, ('127.0.0.1', 0)))
+                    socks.append(theirs)
+                self.assertEqual(len(http.loop.proxies), 1)
+                self.assertEqual(read_response(socks[2], http.loop).code, b'503')
+                
+                for sock in socks[:2]:
+                    sock.sendall(CRLF.join([
+                        b'GET http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+                        b'Host: 127.0.0.1',
+                        b'Connection: close',
+                        CRLF
+                    ]))
+                    self.assertEqual(read_response(sock, http.loop).body, b'hello world')
+                    sock.close()
+            self.assertEqual(http.admission.queued, 1)
+            self.assertEqual(http.admission.admitted, 2)
+        finally:
+            http.loop.close()
+    
+    def test_http_exports_admission_counters(self):
+        http = HTTP(engine=ENGINE_EVENTLOOP, admission=AdmissionControl(max_connections=1, max_pending=1),
+                    metrics=Metrics())
+        http.loop = EventLoop(on_close=http._closed)
+        try:
+            socks = []
+            for _ in range(3):
+                ours, theirs = socket.socketpair()
+                http.handle(Client(ours, ('127.0.0.1', 0)))
+                socks.append(theirs)
+            socks[0].close()
+            for _ in range(10):
+                http.loop.poll(0.01)
+            text = text_(http.metrics.render())
+            self.assertIn('proxy_admitted_connections_total 2\n', text)
+            self.assertIn('proxy_queued_connections_total 1\n', text)
+            self.assertIn('proxy_rejected_connections_total 1\n', text)
+            for sock in socks[1:]:
+                sock.close()
+        finally:
+            http.loop.close()
+
+class TestMetrics(unittest.TestCase):
+    
+    def setUp(self):
+        self.metrics = Metrics(slots=2)
+    
+    def test_observations_are_summed_across_processes(self):
+        self.metrics.observe(b'200', 100, 1000, 0.02, connect=0.003, first_byte=0.01)
+        
+        def observe():
+            self.metrics.slot = 1
+            self.metrics.observe(b'502', 50, 0, 2)
+            self.metrics.reject()
+        proc = multiprocessing.Process(target=observe)
+        proc.start()
+        proc.join()
+        
+        text = text_(self.metrics.render())
+        self.assertIn('proxy_requests_total{code="200"} 1\n', text)
+        self.assertIn('proxy_requests_total{code="502"} 1\n', text)
+        self.assertIn('proxy_received_bytes_total 150\n', text)
+        self.assertIn('proxy_sent_bytes_total 1000\n', text)
+        self.assertIn('proxy_rejected_connections_total 1\n', text)
+        self.assertIn('proxy_upstream_connect_seconds_bucket{le="0.001"} 0\n', text)
+        self.assertIn('proxy_upstream_connect_seconds_bucket{le="0.005"} 1\n', text)
+        self.assertIn('proxy_upstream_connect_seconds_count 1\n', text)
+        self.assertIn('proxy_request_duration_seconds_bucket{le="0.025"} 1\n', text)
+        self.assertIn('proxy_request_duration_seconds_bucket{le="2.5"} 2\n', text)
+        self.assertIn('proxy_request_duration_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('proxy_request_duration_seconds_sum 2.02\n', text)
+    
+    def test_proxy_requests_served_at_admin_endpoint(self):
+        http = HTTP(engine=ENGINE_EVENTLOOP, metrics=self.metrics)
+        http.loop = EventLoop()
+        admin = MetricsServer(self.metrics, port=0)
+        admin.socket = admin.listen()
+        threading.Thread(target=admin.serve, daemon=True).start()
+        try:
+            with LocalOrigin() as origin:
+                ours, theirs = socket.socketpair()
+                http.handle(Client(ours, ('127.0.0.1', 0)))
+                theirs.sendall(CRLF.join([
+                    b'GET http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+                    b'Host: 127.0.0.1',
+                    b'Connection: close',
+                    CRLF
+                ]))
+                self.assertEqual(read_response(theirs, http.loop).body, b'hello world')
+                while http.loop.proxies:
+                    http.loop.poll(0.05)
+            
+            sock = socket.create_connection(admin.socket.getsockname())
+            sock.sendall(b'GET /metrics HTTP/1.1' + CRLF + b'Host: 127.0.0.1' + CRLF * 2)
+            response = read_response(sock)
+            sock.close()
+        finally:
+            http.loop.close()
+            admin.socket.close()
+        self.assertEqual(response.code, b'200')
+        text = text_(bytes(response.body))
+        self.assertIn('proxy_requests_total{code="200"} 1\n', text)
+        self.assertIn('proxy_upstream_connect_seconds_count 1\n', text)
+        self.assertIn('proxy_first_byte_seconds_count 1\n', text)
+        self.assertIn('proxy_request_duration_seconds_count 1\n', text)
+
+    def proxy(self, loop):
+        ours, theirs = socket.socketpair()
+        loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), metrics=self.metrics, splice=False))
+        return theirs
+    
+    def receive(self, sock, loop, done):
+        sock.settimeout(0)
+        data = b''
+        deadline = time.time() + 5
+        while not done(data) and time.time() < deadline:
+            loop.poll(0.01)
+            try:
+                data += sock.recv(65536)
+            except socket.error:
+                pass
+        sock.close()
+        while loop.proxies:
+            loop.poll(0.01)
+        return data
+    
+    def test_sent_bytes_are_those_flushed_to_client(self):
+        loop = EventLoop()
+        try:
+            with LocalOrigin() as origin:
+                sock = self.proxy(loop)
+                sock.sendall(CRLF.join([
+                    b'GET http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+                    b'Host: 127.0.0.1',
+                    CRLF
+                ]) * 2)
+                data = self.receive(sock, loop, lambda data: data.count(b'hello world') == 2)
+        finally:
+            loop.close()
+        totals = self.metrics.totals()
+        self.assertEqual(totals[200], 2)
+        self.assertEqual(totals[Metrics.BYTES_OUT], len(data))
+    
+    def test_tunnels_are_recorded_as_ok(self):
+        loop = EventLoop()
+        try:
+            with LocalEcho() as echo:
+                sock = self.proxy(loop)
+                sock.sendall(CRLF.join([
+                    b'CONNECT 127.0.0.1:%d HTTP/1.1' % echo.port,
+                    b'Host: 127.0.0.1',
+                    CRLF
+                ]))
+                self.assertEqual(read_response(sock, loop, until=HTTP_PARSER_STATE_HEADERS_COMPLETE).code, b'200')
+                sock.sendall(b'ping')
+                self.assertEqual(self.receive(sock, loop, lambda data: data == b'ping'), b'ping')
+        finally:
+            loop.close()
+        totals = self.metrics.totals()
+        self.assertEqual(totals[200], 1)
+        self.assertEqual(totals[0], 0)
+        self.assertEqual(totals[Metrics.BYTES_OUT], len(PROXY_CONNECTION_ESTABLISHED_PKT))
+
+class JsonHandler(OriginHandler):
+    """Serves a compressible json body, chunked at /chunked and too small
+    to be compressed at /small."""
+    
+    body = b'{"items": [' + b', '.join(b'{"id": %d}' % i for i in range(500)) + b']}'
+    
+    def do_GET(self):
+        body = b'{}' if self.path == '/small' else self.body
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('ETag', '"j1"')
+        self.send_header('Cache-Control', 'max-age=60')
+        if self.path == '/chunked':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(body), 1000):
+                self.wfile.write(b'%x\r\n' % len(body[i:i + 1000]) + body[i:i + 1000] + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+            return
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class TestCompression(unittest.TestCase):
+    
+    def setUp(self):
+        self.compression = Compression()
+        self.loop = EventLoop()
+    
+    def tearDown(self):
+        self.loop.close()
+    
+    def parse(self, type, data):
+        parser = HttpParser(type)
+        parser.parse(data)
+        return parser
+    
+    def get(self, sock, port, path, accept=b'gzip, deflate'):
+        sock.sendall(CRLF.join([
+            b'GET http://127.0.0.1:%d%s HTTP/1.1' % (port, path),
+            b'Host: 127.0.0.1',
+            b'Accept-Encoding: ' + accept,
+            CRLF
+        ]))
+        return read_response(sock, self.loop)
+    
+    def test_encoder_holds_back_data_until_started(self):
+        encoder = GzipEncoder()
+        encoder.write(memoryview(b'hello '))
+        encoder.start()
+        encoder.write(memoryview(b'world'))
+        chunks = HttpParser(HTTP_RESPONSE_PARSER)
+        chunks.parse(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' + encoder.read() + encoder.read(True))
+        self.assertEqual(chunks.state, HTTP_PARSER_STATE_COMPLETE)
+        self.assertEqual(zlib.decompress(bytes(chunks.body), 16 + zlib.MAX_WBITS), b'hello world')
+    
+    def test_accepts(self):
+        request = lambda accept: self.parse(HTTP_REQUEST_PARSER, CRLF.join([
+            b'GET http://example.com/ HTTP/1.1', b'Accept-Encoding: ' + accept, CRLF]))
+        self.assertTrue(self.compression.accepts(request(b'br, gzip;q=0.5')))
+        self.assertFalse(self.compression.accepts(request(b'gzip;q=0')))
+        self.assertFalse(self.compression.accepts(request(b'deflate')))
+        self.assertFalse(self.compression.accepts(self.parse(HTTP_REQUEST_PARSER, CRLF.join([
+            b'GET http://example.com/ HTTP/1.0', b'Accept-Encoding: gzip', CRLF]))))
+    
+    def test_is_compressible(self):
+        response = lambda *headers: self.parse(HTTP_RESPONSE_PARSER, CRLF.join([b'HTTP/1.1 200 OK'] + list(headers) + [CRLF]))
+        self.assertTrue(self.compression.is_compressible(response(b'Content-Type: text/html', b'Content-Length: 2048')))
+        self.assertTrue(self.compression.is_compressible(response(b'Content-Type: text/html', b'Transfer-Encoding: chunked')))
+        self.assertFalse(self.compression.is_compressible(response(b'Content-Type: text/html', b'Content-Length: 100')))
+        self.assertFalse(self.compression.is_compressible(response(b'Content-Type: image/png', b'Content-Length: 2048')))
+        self.assertFalse(self.compression.is_compressible(response(b'Content-Type: text/html')))
+        self.assertFalse(self.compression.is_compressible(response(
+            b'Content-Type: text/html', b'Content-Length: 2048', b'Content-Encoding: br')))
+        self.assertFalse(self.compression.is_compressible(response(
+            b'Content-Type: text/html', b'Content-Length: 2048', b'Cache-Control: no-transform')))
+    
+    def test_responses_compressed_over_persistent_connection(self):
+        with LocalOrigin(JsonHandler) as origin:
+            ours, theirs = socket.socketpair()
+            self.loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), compression=self.compression))
+            for path in (b'/', b'/chunked'):
+                response = self.get(theirs, origin.port, path)
+                self.assertEqual(response.code, b'200')
+                self.assertEqual(response.headers[b'content-encoding'][1], b'gzip')
+                self.assertEqual(response.headers[b'vary'][1], b'Accept-Encoding')
+                self.assertEqual(response.headers[b'etag'][1], b'W/"j1"')
+                self.assertNotIn(b'content-length', response.headers)
+                self.assertTrue(response.is_chunked_encoded())
+                self.assertEqual(zlib.decompress(bytes(response.body), 16 + zlib.MAX_WBITS), JsonHandler.body)
+            
+            response = self.get(theirs, origin.port, b'/small')
+            self.assertNotIn(b'content-encoding', response.headers)
+            self.assertEqual(bytes(response.body), b'{}')
+            response = self.get(theirs, origin.port, b'/', accept=b'identity')
+            self.assertNotIn(b'content-encoding', response.headers)
+            self.assertEqual(bytes(response.body), JsonHandler.body)
+            theirs.close()
+        self.assertEqual(self.compression.compressed, 2)
+    
+    def test_cached_response_compressed(self):
+        cache = ResponseCache()
+        with LocalOrigin(JsonHandler) as origin:
+            for accept in (b'identity', b'gzip'):
+                ours, theirs = socket.socketpair()
+                self.loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), cache=cache, compression=self.compression))
+                response = self.get(theirs, origin.port, b'/', accept=accept)
+                theirs.close()
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(response.headers[b'content-encoding'][1], b'gzip')
+        self.assertEqual(zlib.decompress(bytes(response.body), 16 + zlib.MAX_WBITS), JsonHandler.body)
+
+class BackendHandler(OriginHandler):
+    
+    def do_GET(self):
+        body = ('%d %s %s' % (self.server.server_address[1], self.path,
+                              self.headers.get('X-Forwarded-For'))).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class TestReverseProxy(unittest.TestCase):
+    
+    def setUp(self):
+        self.loop = EventLoop()
+    
+    def tearDown(self):
+        self.loop.close()
+    
+    def get(self, sock, path=b'/', host=b'www.example.com'):
+        sock.sendall(CRLF.join([
+            b'GET %s HTTP/1.1' % path,
+            b'Host: ' + host,
+            CRLF
+        ]))
+        return read_response(sock, self.loop)
+    
+    def test_round_robin(self):
+        pool = BackendPool([('a', 1), ('b', 2), ('c', 3)])
+        selected = [pool.select() for _ in range(6)]
+        self.assertEqual([backend.addr[0] for backend in selected], ['a', 'b', 'c', 'a', 'b', 'c'])
+        self.assertEqual([backend.active for backend in pool.backends], [2, 2, 2])
+        for backend in selected:
+            pool.release(backend)
+        self.assertEqual([backend.active for backend in pool.backends], [0, 0, 0])
+    
+    def test_least_connections(self):
+        pool = BackendPool([('a', 1), ('b', 2)], BackendPool.LEAST_CONNECTIONS)
+        busy = pool.select()
+        for _ in range(3):
+            backend = pool.select()
+            self.assertIsNot(backend, busy)
+            pool.release(backend)
+        self.assertEqual(sorted(backend.active for backend in pool.backends), [0, 1])
+    
+    def test_consistent_hash_keeps_key_to_backend(self):
+        pool = BackendPool([('a', 1), ('b', 2), ('c', 3)], BackendPool.CONSISTENT_HASH)
+        keys = ['10.0.0.%d' % i for i in range(30)]
+        selected = dict((key, pool.select(key)) for key in keys)
+        self.assertEqual(len(set(selected.values())), 3)
+        for key in keys:
+            self.assertIs(pool.select(key), selected[key])
+        # keys of other backends stay put once one is excluded
+        excluded = pool.backends[0]
+        for key in keys:
+            backend = pool.select(key, exclude=[excluded])
+            self.assertIsNot(backend, excluded)
+            if selected[key] is not excluded:
+                self.assertIs(backend, selected[key])
+    
+    def test_weighted_round_robin(self):
+        pool = BackendPool([('a', 1, 5), ('b', 2), ('c', 3)])
+        selected = [pool.select().addr[0] for _ in range(14)]
+        self.assertEqual(selected[:7], ['a', 'a', 'b', 'a', 'c', 'a', 'a'])
+        self.assertEqual(selected[7:], selected[:7])
+    
+    def test_probes_ejected_backend_once(self):
+        pool = BackendPool([('a', 1), ('b', 2)], max_failures=2, eject_timeout=0.1)
+        failing = pool.backends[0]
+        pool.failed(failing)
+        pool.failed(failing)
+        time.sleep(0.1)
+        # a single request probes the backend, its failure ejects it again
+        self.assertIs(pool.select(), failing)
+        self.assertFalse(failing.is_available(monotonic()))
+        pool.failed(failing)
+        self.assertEqual(pool.ejections, 2)
+        time.sleep(0.1)
+        self.assertIs(pool.select(exclude=[pool.backends[1]]), failing)
+        pool.succeeded(failing)
+        self.assertEqual(failing.ejected_until, 0)
+        pool.failed(failing)
+        self.assertTrue(failing.is_available(monotonic()))
+    
+    def test_ejects_failing_backend(self):
+        pool = BackendPool([('a', 1), ('b', 2)], max_failures=2, eject_timeout=0.2)
+        failing = pool.backends[0]
+        pool.failed(failing)
+        pool.succeeded(failing)
+        pool.failed(failing)
+        self.assertTrue(failing.is_available(monotonic()))
+        pool.failed(failing)
+        self.assertEqual(pool.ejections, 1)
+        self.assertEqual(set(pool.select() for _ in range(4)), set([pool.backends[1]]))
+        pool.failed(pool.backends[1])
+        pool.failed(pool.backends[1])
+        self.assertIsNone(pool.select())
+        time.sleep(0.2)
+        self.assertIs(pool.select(exclude=[pool.backends[1]]), failing)
+    
+    def test_router(self):
+        router = Router()
+        default, api, static = BackendPool([('a', 1)]), BackendPool([('b', 2)]), BackendPool([('c', 3)])
+        router.add(None, b'/', default)
+        router.add(None, b'/api', api)
+        router.add(b'Static.Example.com', b'/', static)
+        route = lambda url, host=b'www.example.com': router.route(self.parse(url, host))
+        self.assertIs(route(b'/index.html'), default)
+        self.assertIs(route(b'/api/users'), api)
+        self.assertIs(route(b'/api/users', b'static.example.com:8080'), static)
+        self.assertIs(route(b'http://static.example.com/api'), static)
+        self.assertIsNone(router.route(self.parse(b'static.example.com:443', b'', b'CONNECT')))
+        self.assertEqual(Router.parse('static.example.com/img=10.0.0.1:80, 10.0.0.2:8080:3'),
+                         (b'static.example.com', b'/img', [('10.0.0.1', 80, 1), ('10.0.0.2', 8080, 3)]))
+        self.assertEqual(Router.parse('=127.0.0.1:80'), (None, b'/', [('127.0.0.1', 80, 1)]))
+        self.assertRaises(ValueError, Router.parse, '/api=127.0.0.1')
+        self.assertRaises(ValueError, Router.parse, '/api=127.0.0.1:80:0')
+    
+    def parse(self, url, host, method=b'GET'):
+        request = HttpParser(HTTP_REQUEST_PARSER)
+        request.parse(CRLF.join([b'%s %s HTTP/1.1' % (method, url), b'Host: ' + host, CRLF]))
+        return request
+    
+    def test_balances_requests_across_backends(self):
+        with LocalOrigin(BackendHandler) as first, LocalOrigin(BackendHandler) as second:
+            router = Router()
+            router.add(None, b'/', BackendPool([('127.0.0.1', first.port), ('127.0.0.1', second.port)]))
+            ours, theirs = socket.socketpair()
+            self.loop.add(Proxy(Client(ours, ('10.0.0.1', 0)), router=router))
+            ports = []
+            for _ in range(4):
+                response = self.get(theirs, b'/page?q=1')
+                self.assertEqual(response.code, b'200')
+                port, path, forwarded = response.body.split()
+                self.assertEqual((path, forwarded), (b'/page?q=1', b'10.0.0.1'))
+                ports.append(int(port))
+            self.assertEqual(sorted(ports), sorted([first.port, second.port] * 2))
+            theirs.close()
+    
+    def test_fails_over_to_available_backend(self):
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+        with LocalOrigin(BackendHandler) as origin:
+            pool = BackendPool([('127.0.0.1', closed_port), ('127.0.0.1', origin.port)], max_failures=1)
+            router = Router()
+            router.add(None, b'/', pool)
+            for _ in range(2):
+                ours, theirs = socket.socketpair()
+                self.loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), router=router))
+                response = self.get(theirs)
+                self.assertEqual(response.code, b'200')
+                self.assertEqual(int(response.body.split()[0]), origin.port)
+                theirs.close()
+            self.assertEqual(pool.ejections, 1)
+            self.assertFalse(pool.backends[0].is_available(monotonic()))
+            self.assertEqual([backend.active for backend in pool.backends], [0, 0])
+    
+    def test_unrouted_and_unavailable(self):
+        router = Router()
+        pool = BackendPool([('127.0.0.1', 1)])
+        pool.backends[0].ejected_until = monotonic() + 60
+        router.add(b'down.example.com', b'/', pool)
+        ours, theirs = socket.socketpair()
+        self.loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), router=router))
+        self.assertEqual(self.get(theirs).code, b'404')
+        ours, theirs = socket.socketpair()
+        self.loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), router=router))
+        self.assertEqual(self.get(theirs, host=b'down.example.com').code, b'503')
+
+class RecordingProxy(Proxy):
+    """Proxy recording request lines it receives."""
+    
+    def __init__(self, client, requests):
+        super(RecordingProxy, self).__init__(client)
+        self.requests = requests
+    
+    def _open_server(self, host, port):
+        self.requests.append(self.request.build_line(absolute=self.request.url.hostname is not None))
+        super(RecordingProxy, self)._open_server(host, port)
+
+class LocalParent(object):
+    """Serves RecordingProxy on an ephemeral local port, a thread per
+    connection."""
+    
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+    
+    def serve(self):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=RecordingProxy(Client(conn, addr), self.requests).run)
+            thread.daemon = True
+            thread.start()
+    
+    def __enter__(self):
+        self.thread.start()
+        return self
+    
+    def __exit__(self, *args):
+        self.listener.close()
+
+class TestParentProxy(unittest.TestCase):
+    
+    def setUp(self):
+        self.loop = EventLoop()
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        self.closed_port = closed.getsockname()[1]
+        closed.close()
+    
+    def tearDown(self):
+        self.loop.close()
+    
+    def add(self, parents):
+        ours, theirs = socket.socketpair()
+        self.loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), parents=parents))
+        return theirs
+    
+    def test_chains_requests_through_parent(self):
+        with LocalOrigin() as origin, LocalParent() as parent:
+            parents = BackendPool([('127.0.0.1', self.closed_port), ('127.0.0.1', parent.port)], max_failures=1)
+            for url in (b'http://127.0.0.1:%d/' % origin.port, b'/'):
+                sock = self.add(parents)
+                sock.sendall(CRLF.join([
+                    b'GET %s HTTP/1.1' % url,
+                    b'Host: 127.0.0.1:%d' % origin.port,
+                    b'Proxy-Authorization: Basic dXNlcjpwYXNz',
+                    CRLF
+                ]))
+                response = read_response(sock, self.loop)
+                self.assertEqual(response.code, b'200')
+                self.assertEqual(response.body, b'hello world')
+                sock.close()
+            self.assertEqual(parent.requests, [b'GET http://127.0.0.1:%d/ HTTP/1.1' % origin.port] * 2)
+            self.assertEqual(parents.ejections, 1)
+            self.assertEqual([backend.active for backend in parents.backends], [0, 0])
+    
+    def test_access_log_records_requested_server(self):
+        class Log(object):
+            records = []
+            def record(self, *args):
+                self.records.append(args)
+        
+        with LocalOrigin() as origin, LocalParent() as parent:
+            ours, sock = socket.socketpair()
+            self.loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), parents=BackendPool([('127.0.0.1', parent.port)]),
+                                access_log=Log()))
+            sock.sendall(CRLF.join([
+                b'GET http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+                b'Host: 127.0.0.1',
+                CRLF
+            ]))
+            self.assertEqual(read_response(sock, self.loop).code, b'200')
+            sock.close()
+            while self.loop.proxies:
+                self.loop.poll(0.01)
+        self.assertEqual(Log.records[0][1:5], (b'GET', b'127.0.0.1', origin.port, b'/'))
+    
+    def test_tunnels_through_parent(self):
+        with LocalEcho() as echo, LocalParent() as parent:
+            sock = self.add(BackendPool([('127.0.0.1', parent.port)]))
+            sock.sendall(CRLF.join([
+                b'CONNECT 127.0.0.1:%d HTTP/1.1' % echo.port,
+                b'Host: 127.0.0.1:%d' % echo.port,
+                CRLF
+            ]))
+            response = read_response(sock, self.loop, until=HTTP_PARSER_STATE_HEADERS_COMPLETE)
+            self.assertEqual(response.code, b'200')
+            self.assertEqual(response.reason, b'Connection established')
+            sock.sendall(b'ping')
+            received = b''
+            deadline = time.time() + 5
+            while received != b'ping' and time.time() < deadline:
+                self.loop.poll(0.05)
+                try:
+                    received += sock.recv(4)
+                except socket.error:
+                    pass
+            self.assertEqual(received, b'ping')
+            self.assertEqual(parent.requests, [b'CONNECT 127.0.0.1:%d HTTP/1.1' % echo.port])
+            sock.close()
+    
+    def test_unavailable_parents(self):
+        parents = BackendPool([('127.0.0.1', self.closed_port)], max_failures=1, eject_timeout=60)
+        for code in (b'502', b'503'):
+            sock = self.add(parents)
+            sock.sendall(CRLF.join([b'GET http://127.0.0.1/ HTTP/1.1', b'Host: 127.0.0.1', CRLF]))
+            self.assertEqual(read_response(sock, self.loop).code, code)
+            sock.close()
+
+class TestAccessLog(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'access.log')
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def read(self, path=None):
+        with open(path or self.path) as f:
+            return f.read().splitlines()
+    
+    def test_text_lines_written_in_background(self):
+        log = AccessLog(self.path)
+        log.start()
+        log.record(('10.0.0.1', 5000), b'GET', b'example.com', 80, b'/index.html', b'200', b'OK', 11, 0.0125)
+        log.record(('10.0.0.1', 5001), b'CONNECT', b'example.com', 443, None, None, None, 0, 2)
+        log.close()
+        lines = self.read()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith(' 10.0.0.1:5000 - GET example.com:80/index.html - 200 OK - 11 bytes - 0.013s'))
+        self.assertTrue(lines[1].endswith(' 10.0.0.1:5001 - CONNECT example.com:443 - 0 bytes - 2.000s'))
+    
+    def test_json_lines(self):
+        log = AccessLog(self.path, format='json')
+        log.start()
+        log.record(('10.0.0.1', 5000), b'GET', b'example.com', 80, b'/', b'404', b'Not Found', 9, 0.5)
+        log.close()
+        record = json.loads(self.read()[0])
+        self.assertEqual(record['status'], '404')
+        self.assertEqual(record['url'], '/')
+        self.assertEqual(record['duration'], 0.5)
+        self.assertTrue(record['time'].endswith('Z'))
+    
+    def test_rotation_keeps_backups(self):
+        log = AccessLog(self.path, max_bytes=100, backups=2, batch_size=1)
+        log.start()
+        for i in range(6):
+            log.record(('10.0.0.1', 5000), b'GET', b'example.com', 80, b'/%d' % i, b'200', b'OK', 0, 0)
+            time.sleep(0.05)
+        log.close()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['access.log', 'access.log.1', 'access.log.2'])
+        self.assertIn('/5 - ', self.read()[-1])
+        self.assertIn('/4 - ', self.read(self.path + '.1')[-1])
+    
+    def test_proxy_requests_logged(self):
+        log = AccessLog(self.path)
+        log.start()
+        loop = EventLoop()
+        try:
+            with LocalOrigin() as origin:
+                ours, theirs = socket.socketpair()
+                loop.add(Proxy(Client(ours, ('127.0.0.1', 0)), access_log=log))
+                theirs.sendall(CRLF.join([
+                    b'GET http://127.0.0.1:%d/path HTTP/1.1' % origin.port,
+                    b'Host: 127.0.0.1',
+                    b'Connection: close',
+                    CRLF
+                ]))
+                self.assertEqual(read_response(theirs, loop).body, b'hello world')
+                while loop.proxies:
+                    loop.poll(0.05)
+        finally:
+            loop.close()
+            log.close()
+        self.assertIn(' - GET 127.0.0.1:%d/path - 200 OK - ' % origin.port, self.read()[0])
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.http = HTTP(port=0, workers=2, metrics=Metrics(slots=2))
+        self.http.socket = self.http.listen()
+        self.http.port = self.http.socket.getsockname()[1]
+
+    def tearDown(self):
+        for worker in self.http.processes:
+            worker.terminate()
+            worker.join()
+        self.http.socket.close()
+
+    def request(self, origin):
+        sock = socket.create_connection(('127.0.0.1', self.http.port))
+        sock.sendall(CRLF.join([
+            b'GET http://127.0.0.1:%d/ HTTP/1.1' % origin.port,
+            b'Host: 127.0.0.1',
+            CRLF
+        ]))
+        response = read_response(sock)
+        sock.close()
+        return response
+
+    def test_workers_share_socket_and_respawn(self):
+        with LocalOrigin() as origin:
+            self.http.processes = [self.http._spawn_worker(i) for i in range(self.http.workers)]
+            self.assertEqual(self.request(origin).body, b'hello world')
+            
+            crashed = self.http.processes[0]
+            crashed.terminate()
+            crashed.join()
+            self.http._supervise()
+            self.assertNotEqual(self.http.processes[0], crashed)
+            self.assertTrue(all(worker.is_alive() for worker in self.http.processes))
+            for _ in range(4):
+                self.assertEqual(self.request(origin).body, b'hello world')
+        time.sleep(0.1)
+        self.assertIn(b'proxy_requests_total{code="200"} 5\n', self.http.metrics.render())
+
+    def test_workers_stopped_with_master(self):
+        http = HTTP(port=self.http.port, workers=2)
+        self.http.socket.close()
+        master = multiprocessing.Process(target=http.run)
+        master.start()
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', http.port)).close()
+                break
+            except socket.error:
+                time.sleep(0.05)
+        
+        os.kill(master.pid, signal.SIGTERM)
+        master.join(HTTP.WORKER_STOP_TIMEOUT * 2)
+        self.assertEqual(master.exitcode, 0)
+        self.assertRaises(socket.error, socket.create_connection, ('127.0.0.1', http.port))
+
+    def test_worker_exits_once_master_dies(self):
+        self.http.supervise_interval = 0.1
+        # the test process stands in for a master which has died
+        worker = multiprocessing.Process(target=self.http._run_worker, args=(0, os.getppid()))
+        worker.start()
+        worker.join(5)
+        self.assertEqual(worker.exitcode, 0)
+
+@unittest.skipIf(proxy.asyncio is None, 'asyncio is not available')
+class TestAsyncHTTP(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = proxy.asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.http = AsyncHTTP(port=0, connect_timeout=1)
+        self.server = proxy.asyncio.run_coroutine_threadsafe(self.http.start(self.loop), self.loop).result(5)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def test_http_get(self):
+        with LocalOrigin() as origin:
+            sock = socket.create_connection(('127.0.0.1', self.port))
+            sock.sendall(b'GET http://127.0.0.1:%d/ HTTP/1.1' % origin.port + CRLF)
+            sock.sendall(b'Host: 127.0.0.1' + CRLF * 2)
+            response = read_response(sock)
+            sock.close()
+        self.assertEqual(response.code, b'200')
+        self.assertEqual(response.body, b'hello world')
+
+    def test_body_held_until_request_head_written(self):
+        class Transport(object):
+            def __init__(self):
+                self.written = []
+            def write(self, data):
+                self.written.append(bytes(data))
+            def get_extra_info(self, name):
+                return ('127.0.0.1', 0)
+        
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        
+        async def relay():
+            p = AsyncProxy()
+            p.connection_made(Transport())
+            p.data_received(CRLF.join([
+                b'PUT http://127.0.0.1:%d/ HTTP/1.1' % port,
+                b'Content-Length: 10',
+                CRLF
+            ]) + b'01234')
+            # server connected, done callback of connecting not run yet
+            server = Transport()
+            AsyncUpstream(p).connection_made(server)
+            p.data_received(b'56789')
+            self.assertEqual(server.written, [])
+            
+            future = self.loop.create_future()
+            future.set_result(None)
+            p._connected(future)
+            p.closed = True
+            p.inactivity_timer.cancel()
+            return server.written
+        
+        written = proxy.asyncio.run_coroutine_threadsafe(relay(), self.loop).result(5)
+        self.assertTrue(written[0].startswith(b'PUT / HTTP/1.1\r\n'))
+        self.assertEqual(b''.join(written[1:]), b'0123456789')
+
+    def test_connect_failure_returns_bad_gateway(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.sendall(b'CONNECT 127.0.0.1:%d HTTP/1.1' % port + CRLF)
+        sock.sendall(b'Host: 127.0.0.1' + CRLF * 2)
+        response = read_response(sock)
+        sock.close()
+        self.assertEqual(response.code, b'502')
+
 if __name__ == '__main__':
     unittest.main()